@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the TS3 escape/unescape codec
+
+Compares the codec in ts3.protocol against the original loop which called
+str.replace once per ts3_escape entry. The current codec still chains
+str.replace, but returns values needing no escaping untouched and only
+replaces the characters which are present. The gain therefore depends on
+the sample, values full of spaces gain little or nothing.
+"""
+
+import timeit
+from ts3.protocol import TS3Proto, ts3_escape
+
+
+def legacy_escape(value):
+    for i, j in ts3_escape:
+        value = value.replace(i, j)
+    return value
+
+
+def legacy_unescape(value):
+    for i, j in ts3_escape:
+        value = value.replace(j, i)
+    return value
+
+
+SAMPLES = {
+    'plain': 'client_nickname_without_specials',
+    'spaces': 'query from 87.163.52.195:9 issued: logview limitcount=30',
+    'mixed': 'C:\\sounds\\ | tab\there / ' * 20,
+}
+
+
+def bench(number=20000):
+    print("%-8s %-10s %10s %10s %8s" % ('sample', 'direction', 'legacy', 'current', 'speedup'))
+    for name, raw in sorted(SAMPLES.items()):
+        escaped = TS3Proto._escape_str(raw)
+        for direction, old, new, value in (
+                ('escape', legacy_escape, TS3Proto._escape_str, raw),
+                ('unescape', legacy_unescape, TS3Proto._unescape_str, escaped)):
+            t_old = min(timeit.repeat(lambda: old(value), number=number, repeat=3))
+            t_new = min(timeit.repeat(lambda: new(value), number=number, repeat=3))
+            print("%-8s %-10s %9.1fms %9.1fms %7.1fx" % (name, direction, t_old * 1000, t_new * 1000, t_old / t_new))
+
+
+if __name__ == '__main__':
+    bench()
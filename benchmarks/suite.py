@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for python-ts3
+
+Runs the codec and parser microbenchmarks and end to end round trips against
+a local L{ts3.emulator.ServerQueryEmulator}, then stores the results as JSON
+so that later runs can be compared against them.
+
+    PYTHONPATH=. python benchmarks/suite.py --save
+    PYTHONPATH=. python benchmarks/suite.py --compare benchmarks/results/0.1-abc1234.json
+
+Every benchmark reports the best of several repeats in microseconds per
+operation, lower is better.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+import ts3
+from ts3.emulator import ServerQueryEmulator, format_row, client_rows
+from ts3.protocol import TS3Proto, TS3Response
+from ts3.server import TS3Server
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+ROW_COUNTS = (10, 1000, 10000)
+
+ESCAPE_SAMPLES = {
+    'plain': 'client_nickname_without_specials',
+    'mixed': 'C:\\sounds\\ | tab\there / ' * 20,
+}
+
+
+class Suite():
+
+    def __init__(self, quick=False, pattern=None):
+        self.quick = quick
+        self.pattern = pattern
+        self.results = {}
+
+    def measure(self, name, func, number, repeat=3, per=1):
+        """
+        Records the best time per call of func in microseconds, divided by
+        per when each call performs several operations
+        """
+        if self.pattern and self.pattern not in name:
+            return
+        if self.quick:
+            number = max(1, number // 10)
+        best = min(timeit.repeat(func, number=number, repeat=repeat)) / number / per
+        self.results[name] = best * 1e6
+        print("%-40s %12.2f us" % (name, best * 1e6))
+
+    def bench_codec(self):
+        for name, raw in sorted(ESCAPE_SAMPLES.items()):
+            escaped = TS3Proto._escape_str(raw)
+            self.measure('escape.%s' % name, lambda: TS3Proto._escape_str(raw), 20000)
+            self.measure('unescape.%s' % name, lambda: TS3Proto._unescape_str(escaped), 20000)
+
+    def bench_construct(self):
+        proto = TS3Proto()
+        self.measure('construct_command.bare', lambda: proto.construct_command('whoami'), 20000)
+        keys = {'clid': 5, 'msg': 'Change your name | please', 'cid': 12}
+        self.measure('construct_command.keys', lambda: proto.construct_command('clientpoke', keys=keys), 20000)
+        nested = {'clid': list(range(1, 101)), 'cid': 3}
+        self.measure('construct_command.list100', lambda: proto.construct_command('clientmove', keys=nested, opts=['continueonerror']), 2000)
+
+        # Prepared commands against construct_command plus the encoding
+        # send_command does, for the same lines
+        move = {'cid': 405, 'clid': 7}
+        self.measure('construct_command.encoded', lambda: proto.construct_command('clientmove', keys=move).encode('utf-8') + b"\n\r", 20000)
+        prepared = proto.prepare('clientmove', keys={'cid': 405, 'clid': None})
+        self.measure('prepared.render', lambda: prepared.render(clid=7), 20000)
+        poke = proto.prepare('clientpoke', keys={'clid': None, 'msg': 'Change your name | please'})
+        self.measure('prepared.render_escaped', lambda: poke.render(clid=5), 20000)
+        moves = proto.prepare('clientmove', keys={'clid': None, 'cid': 3}, opts=['continueonerror'])
+        self.measure('prepared.render_list100', lambda: moves.render(clid=nested['clid']), 2000)
+
+    def bench_parse(self):
+        for count in ROW_COUNTS:
+            data = '|'.join(format_row(row) for row in client_rows(count))
+            self.measure('parse_data.rows%d' % count, lambda: TS3Proto.parse_data(data), max(1, 100000 // count))
+            raw = data.encode('utf-8')
+            self.measure('response.rows%d.two_fields' % count,
+                         lambda: [(row['clid'], row['cid']) for row in TS3Response(b'error id=0 msg=ok', raw).rows],
+                         max(1, 100000 // count))
+            self.measure('response.rows%d.all_fields' % count,
+                         lambda: TS3Response(b'error id=0 msg=ok', raw).data,
+                         max(1, 100000 // count))
+
+    def bench_network(self):
+        server = ServerQueryEmulator().populate(clients=max(ROW_COUNTS))
+        try:
+            ts3 = TS3Server(server.host, server.port)
+            server.received = _Discard()
+            self.measure('send_command.roundtrip', lambda: ts3.send_command('whoami'), 2000)
+            for count in ROW_COUNTS:
+                server.populate(clients=count)
+                self.measure('send_command.clientlist%d' % count, lambda: ts3.send_command('clientlist'), max(2, 20000 // count))
+                self.measure('stream_command.clientlist%d' % count, lambda: list(ts3.stream_command('clientlist')), max(2, 20000 // count))
+
+            def pipelined():
+                with ts3.pipeline() as pipe:
+                    for i in range(1000):
+                        pipe.send_command('whoami')
+            # Reported per command so it reads as the inverse of throughput
+            self.measure('pipeline.whoami1000', pipelined, 5, per=1000)
+            ts3.disconnect()
+        finally:
+            server.close()
+
+    def bench_multiplex(self, rtt=0.002, threads=16):
+        """
+        Commands from many threads over a link with a round trip time,
+        taking turns on the connection and multiplexed
+        """
+        server = ServerQueryEmulator(rtt=rtt)
+        try:
+            ts3 = TS3Server(server.host, server.port)
+            server.received = _Discard()
+            name = 'threads%d.rtt%gms' % (threads, rtt * 1000)
+            with ThreadPoolExecutor(threads) as executor:
+                send = lambda i: ts3.send_command('whoami')
+                self.measure('locked.%s' % name, lambda: list(executor.map(send, range(200))), 1, per=200)
+                with ts3.multiplex():
+                    self.measure('multiplex.%s' % name, lambda: list(executor.map(send, range(200))), 5, per=200)
+            ts3.disconnect()
+        finally:
+            server.close()
+
+    def bench_paginate(self, rtt=0.002, rows=5000, page_size=250):
+        """
+        Walking the client database page by page over a link with a round
+        trip time, with and without requesting the next page in advance
+        """
+        server = ServerQueryEmulator(rtt=rtt).populate(dbclients=rows)
+        try:
+            ts3 = TS3Server(server.host, server.port)
+            server.received = _Discard()
+            name = 'clientdblist%d.page%d.rtt%gms' % (rows, page_size, rtt * 1000)
+
+            def walk(prefetch):
+                for row in ts3.iter_clientdblist(page_size=page_size, prefetch=prefetch):
+                    row['client_nickname']
+
+            self.measure('paginate.%s' % name, lambda: walk(False), 3, per=rows)
+            self.measure('prefetch.%s' % name, lambda: walk(True), 3, per=rows)
+            ts3.disconnect()
+        finally:
+            server.close()
+
+    def bench_file_transfer(self, size=32 * 1024 * 1024):
+        """
+        Uploading a file with sendfile and downloading it into a buffer,
+        per megabyte
+        """
+        server = ServerQueryEmulator()
+        server.enable_file_transfer()
+        source = tempfile.NamedTemporaryFile()
+        try:
+            source.write(os.urandom(size))
+            source.flush()
+            ts3 = TS3Server(server.host, server.port)
+            buffer = bytearray(size)
+            megabytes = size // (1024 * 1024)
+            self.measure('file_transfer.upload%dmb' % megabytes,
+                         lambda: ts3.upload_file(source.name, '/bench'), 3, per=megabytes)
+            self.measure('file_transfer.download%dmb' % megabytes,
+                         lambda: ts3.download_file('/bench', buffer), 3, per=megabytes)
+            ts3.disconnect()
+        finally:
+            source.close()
+            server.close()
+
+    def run(self):
+        self.bench_codec()
+        self.bench_construct()
+        self.bench_parse()
+        self.bench_network()
+        self.bench_multiplex()
+        self.bench_paginate()
+        self.bench_file_transfer()
+        return self.results
+
+
+class _Discard(list):
+    """
+    Stops the emulator from keeping every command sent during a benchmark
+    """
+
+    def append(self, item):
+        pass
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each result against the baseline and returns the names of those
+    which got slower by more than threshold
+    """
+    regressions = []
+    print("\n%-40s %12s %12s %8s" % ('benchmark', 'baseline', 'current', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        change = results[name] / baseline[name] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' !'
+        print("%-40s %12.2f %12.2f %+7.1f%%%s" % (name, baseline[name], results[name], change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--quick', action='store_true', help='run a tenth of the iterations')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', nargs='?', const='', metavar='PATH',
+                        help='store the results, by default in benchmarks/results/<version>-<revision>.json')
+    parser.add_argument('--compare', metavar='PATH', help='compare against previously stored results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression, default 0.1 (10%%)')
+    args = parser.parse_args(argv)
+
+    revision = git_revision()
+    results = Suite(quick=args.quick, pattern=args.filter).run()
+    document = {
+        'version': ts3.__version__,
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'unit': 'us',
+        'results': results,
+    }
+
+    if args.save is not None:
+        path = args.save
+        if not path:
+            path = os.path.join(RESULTS_DIR, '%s-%s.json' % (ts3.__version__, revision or 'unknown'))
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        print("\nSaved results to %s" % path)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("\nBaseline: version %s revision %s" % (baseline.get('version'), baseline.get('revision')))
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
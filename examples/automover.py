@@ -1,11 +1,14 @@
-from time import sleep
+import time
+from threading import Lock
 from ts3 import TS3Server
 
 """
 Automover
 
-Automatically moves a list of Client DB IDs to a specified room, and checks for
-them every 5 seconds
+Automatically moves a list of Client DB IDs to a specified room. Instead of
+polling the client list it registers for server and channel notifications and
+reacts as clients join or move. ServerQuery is not told about nickname
+changes, so clients which were warned are looked up again every few seconds.
 """
 
 # List of people to move
@@ -23,32 +26,92 @@ server.login('serveradmin', 'supersecretpassword')
 
 print("Logged In")
 
-poke = []
+# clid -> client details, notifyclientmoved only carries the clid
+clients = {}
+poke = {}
+# Handlers run on the dispatcher thread, the re-check on the main thread
+lock = Lock()
 
+
+def check_client(clid):
+    client = clients.get(clid)
+    if not client or client['cldbid'] not in moveids:
+        return
+
+    clinfo = moveids[client['cldbid']]
+    print("Found ID %s: %s" % (client['cldbid'], client['nickname']))
+
+    # If we have a channel defined and they're not in it, move them
+    if 'destination' in clinfo and not client['cid'] == clinfo['destination']:
+        if server.send_command('clientmove', keys={'clid': clid, 'cid': clinfo['destination']}).is_successful:
+            print("Moved %s to Channel %s" % (client['nickname'], clinfo['destination']))
+
+    # If we have a fixed name defined, tell them to change it or kick them
+    if 'name' in clinfo and not client['nickname'] == clinfo['name']:
+        poke[clid] = poke.get(clid, 0) + 1
+        print("Warning %s out of 3" % poke[clid])
+        server.send_command('clientpoke', keys={'clid': clid, 'msg': 'Change your name to "%s"! Warning %s of 3' % (clinfo['name'], poke[clid])})
+        if poke[clid] > 3:
+            server.send_command('clientkick', keys={'clid': clid, 'reasonid': 5})
+    else:
+        poke[clid] = 0
+
+
+def on_enter(event):
+    with lock:
+        for client in event.data:
+            clid = int(client['clid'])
+            clients[clid] = {
+                'cldbid': int(client['client_database_id']),
+                'nickname': client['client_nickname'],
+                'cid': int(client['ctid']),
+            }
+            check_client(clid)
+
+
+def on_moved(event):
+    with lock:
+        for client in event.data:
+            clid = int(client['clid'])
+            if clid in clients:
+                clients[clid]['cid'] = int(event.data[0]['ctid'])
+                check_client(clid)
+
+
+def on_left(event):
+    with lock:
+        for client in event.data:
+            clients.pop(int(client['clid']), None)
+            poke.pop(int(client['clid']), None)
+
+
+# Records carry the numeric fields already converted to int
+for clid, client in server.clientlist(records=True).items():
+    clients[clid] = {
+        'cldbid': client.client_database_id,
+        'nickname': client.client_nickname,
+        'cid': client.cid,
+    }
+
+server.on('notifycliententerview', on_enter)
+server.on('notifyclientmoved', on_moved)
+server.on('notifyclientleftview', on_left)
+server.servernotifyregister('server')
+server.servernotifyregister('channel', id=0)
+server.start_event_listener()
+
+with lock:
+    for clid in list(clients):
+        check_client(clid)
+
+# Events are handled on background threads, warned clients are checked here
+# until they change their name or are kicked
 while True:
-    clientlist = server.clientlist()
-
-    for client in clientlist.values():
-        # Check if the client is in the Move IDs
-        if int(client['client_database_id']) in moveids:
-            clinfo = moveids[int(client['client_database_id'])]
-            print("Found ID %s: %s" % (client['client_database_id'], client['client_nickname']))
-
-            # If we have a channel defined and they're not in it, move them
-            if 'destination' in clinfo and not int(client['cid']) == clinfo['destination']:
-                if server.send_command('clientmove', keys={'clid': client['clid'], 'cid': clinfo['destination']}).is_successful:
-                    print("Moved %s to Channel %s" % (client['client_nickname'], clinfo['destination']))
-
-            # If we have a fixed name defined, tell them to change it or kick them
-            if 'name' in clinfo and not client['client_nickname'] == clinfo['name']:
-                if not client['clid'] in poke:
-                    poke[client['clid']] = 0
-                poke[client['clid']] += 1
-                print("Warning %s out of 3" % poke[client['clid']])
-                server.send_command('clientpoke', keys={'clid': client['clid'], 'msg': 'Change your name to "%s"! Warning %s of 3' % (clinfo['name'], poke[client['clid']])})
-                if poke > 3:
-                    server.send_command('clientkick', keys={'clid': client['clid'], 'reasonid': 5})
-            else:
-                poke[client['clid']] = 0
-
-    sleep(5)
+    time.sleep(5)
+    with lock:
+        for clid in [clid for clid, count in poke.items() if count and clid in clients]:
+            response = server.send_command('clientinfo', keys={'clid': clid})
+            if response.is_successful:
+                clients[clid]['nickname'] = response.data[0]['client_nickname']
+                clients[clid]['cid'] = int(response.data[0]['cid'])
+                check_client(clid)
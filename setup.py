@@ -1,13 +1,9 @@
 #!/usr/bin/env python
 
-import sys
 from setuptools import setup
 from ts3 import __version__
 
 tests_require = ['mock']
-if sys.version < '2.7':
-      tests_require.append('unittest2')
-      tests_require.append('ordereddict')
 
 setup(
     name="python-ts3",
@@ -21,11 +17,16 @@ setup(
     scripts=['examples/gents3privkey.py'],
     test_suite='ts3.test.suite',
     tests_require=tests_require,
+    python_requires='>=3.5',
     classifiers=[
         'License :: OSI Approved :: BSD License',
         'Topic :: Internet',
         'Topic :: Communications',
         'Intended Audience :: Developers',
         'Development Status :: 3 - Alpha',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: Implementation :: CPython',
+        'Programming Language :: Python :: Implementation :: PyPy',
     ]
 )
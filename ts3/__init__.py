@@ -25,8 +25,21 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from .protocol import TS3Proto, TS3Response, ConnectionError, NoConnectionError, InvalidArguments
+from .protocol import TS3Proto, TS3Response, TS3Row, TS3Event, TS3Pipeline, TS3Multiplexer, TS3Pager, PreparedCommand, ConnectionError, NoConnectionError, InvalidArguments
 from .server import TS3Server
+from .records import Record, record_type, ClientRecord, ChannelRecord, ServerRecord, ClientDBRecord
+from .cache import ResponseCache
+from .ratelimit import RateLimiter, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from .reconnect import ReconnectPolicy
+from .keepalive import KeepaliveScheduler
+from .instrument import Collector, CounterCollector, HistogramCollector, CommandSample
+from .mirror import ServerStateMirror
+from .permissions import PermissionResolver
+from .filetransfer import FileTransfer, FileTransfers, FileTransferError
+from .diff import SnapshotDiff, Change
+from .pool import TS3ServerPool, PoolError, PoolExhaustedError
+from .fanout import FanOut, FanOutResult
+from .shard import ShardedRunner, ShardMessage
 from .defines import *
 
 __version__ = "0.1"
@@ -0,0 +1,300 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+asyncio based ServerQuery client, allowing a single event loop to drive many
+query connections. Requires Python 3.5 or later.
+"""
+
+import asyncio
+import logging
+from .protocol import TS3Proto, TS3Response, TS3Event, ConnectionError, NoConnectionError, InvalidArguments
+from .defines import *
+
+
+class AsyncTS3Proto():
+
+    # Command construction and reply parsing are shared with the blocking client
+    construct_command = TS3Proto.construct_command
+    parse_response = staticmethod(TS3Proto.parse_response)
+    parse_data = staticmethod(TS3Proto.parse_data)
+    _escape_str = staticmethod(TS3Proto._escape_str)
+    _unescape_str = staticmethod(TS3Proto._unescape_str)
+
+    def __init__(self, limit=2 ** 24):
+        """
+        @param limit: Maximum length of a single reply line in bytes
+        @type limit: int
+        """
+        # Created on connect, before Python 3.10 a lock is bound to the loop
+        # current when it is created
+        self.io_lock = None
+        self._connected = False
+        self._timeout = 0
+        self._limit = limit
+        self._reader = None
+        self._writer = None
+        self._handlers = {}
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def on(self, event, handler):
+        """
+        Registers a handler for a notification. Notifications are read while
+        commands are running, handlers are called on the event loop with the
+        L{TS3Event} and coroutine handlers are run as tasks.
+
+        @param event: Notification name such as "notifyclientmoved", or "*"
+        @type event: str
+        @param handler: Called with the L{TS3Event}
+        @type handler: callable
+        """
+        self._handlers.setdefault(event, []).append(handler)
+
+    async def connect(self, ip, port=10011, timeout=5):
+        if self.io_lock is None:
+            self.io_lock = asyncio.Lock()
+
+        async with self.io_lock:
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip, port, limit=self._limit), timeout)
+            except (OSError, asyncio.TimeoutError):
+                raise ConnectionError(ip, port)
+
+            self._timeout = timeout
+            self._connected = False
+
+            data = await self._read_line()
+            if data.endswith(b"TS3\n\r"):
+                # Otherwise read as part of the first reply
+                await self._read_line()
+                self._connected = True
+
+        return self._connected
+
+    async def disconnect(self):
+        self.check_connection()
+
+        await self.send_command("quit")
+        writer, self._writer, self._reader = self._writer, None, None
+        self._connected = False
+
+        writer.close()
+        if hasattr(writer, 'wait_closed'):
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def send_command(self, command, keys=None, opts=None):
+        self.check_connection()
+
+        commandstr = self.construct_command(command, keys=keys, opts=opts)
+        self.logger.debug("send_command - %s" % commandstr)
+
+        async with self.io_lock:
+            self._writer.write(commandstr.encode('utf-8') + b"\n\r")
+            await self._writer.drain()
+            response, data = await self._read_response()
+
+        return TS3Response(response, data)
+
+    async def _read_line(self):
+        """
+        Reads the next line which is not a notification, dispatching any
+        notifications on the way. The caller must hold io_lock.
+        """
+        while True:
+            try:
+                line = await asyncio.wait_for(self._reader.readuntil(b"\n\r"), self._timeout or None)
+            except asyncio.IncompleteReadError as e:
+                return e.partial
+            except asyncio.TimeoutError:
+                return b''
+            if not line.startswith(b"notify"):
+                return line
+            self._dispatch_event(line)
+
+    def _dispatch_event(self, line):
+        event = TS3Event(line.rstrip(b"\n\r").decode('utf-8'))
+        handlers = self._handlers.get(event.name, []) + self._handlers.get('*', [])
+        if not handlers:
+            self.logger.debug("dispatch - unhandled event %s" % event.name)
+        loop = asyncio.get_event_loop()
+        for handler in handlers:
+            # Not called in the middle of reading a reply
+            loop.call_soon(self._call_handler, handler, event)
+
+    def _call_handler(self, handler, event):
+        try:
+            result = handler(event)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+        except Exception:
+            self.logger.exception("dispatch - handler for %s failed" % event.name)
+
+    async def _read_response(self):
+        """
+        Reads the reply to a single command, returning a (response, data)
+        tuple of raw byte strings. The caller must hold io_lock.
+        """
+        data = b''
+        response = await self._read_line()
+
+        if not response.startswith(b"error"):
+            # what we just got was extra data
+            data = response
+            response = await self._read_line()
+
+        return response, data
+
+    def check_connection(self):
+        if not self.is_connected():
+            raise NoConnectionError
+
+    def is_connected(self):
+        return self._connected
+
+
+class AsyncTS3Server(AsyncTS3Proto):
+    """
+    asyncio counterpart of L{TS3Server}. Unlike L{TS3Server} the constructor
+    does not connect, use L{create} or call L{connect} and L{use} directly.
+    """
+
+    def __init__(self, limit=2 ** 24):
+        AsyncTS3Proto.__init__(self, limit=limit)
+        self._logger = logging.getLogger(__name__)
+
+    @classmethod
+    async def create(cls, ip, port=10011, id=0):
+        """
+        Connects to a TS3 Server and optionally selects a Virtual Server
+
+        @param ip: IP Address
+        @type ip: str
+        @param port: Port Number
+        @type port: int
+        @param id: Virtual Server ID
+        @type id: int
+        """
+        server = cls()
+        if await server.connect(ip, port) and id > 0:
+            await server.use(id)
+        return server
+
+    async def login(self, username, password):
+        """
+        Login to the TS3 Server
+
+        @param username: Username
+        @type username: str
+        @param password: Password
+        @type password: str
+        """
+        response = await self.send_command('login', keys={'client_login_name': username, 'client_login_password': password})
+        return response.is_successful
+
+    async def serverlist(self):
+        """
+        Get a list of all Virtual Servers on the connected TS3 instance
+        """
+        return await self.send_command('serverlist')
+
+    async def gm(self, msg):
+        """
+        Send a global message to the current Virtual Server
+
+        @param msg: Message
+        @type msg: str
+        """
+        response = await self.send_command('gm', keys={'msg': msg})
+        return response.is_successful
+
+    async def use(self, id):
+        """
+        Use a particular Virtual Server instance
+
+        @param id: Virtual Server ID
+        @type id: int
+        """
+        response = await self.send_command('use', keys={'sid': id})
+        return response.is_successful
+
+    async def clientlist(self):
+        """
+        Returns a clientlist of the current connected server/vhost
+        """
+        response = await self.send_command('clientlist')
+
+        if response.is_successful:
+            clientlist = {}
+            for client in response.data:
+                clientlist[client['clid']] = client
+            return clientlist
+        else:
+            self.logger.debug("clientlist - error retrieving client list")
+            return {}
+
+    async def clientkick(self, clid=None, cldbid=None, type=REASON_KICK_SERVER, message=None):
+        """
+        Kicks a user identified by either clid or cldbid
+        """
+        client = None
+        if cldbid:
+            clientlist = await self.clientlist()
+            for cl in clientlist.values():
+                if int(cl['client_database_id']) == cldbid:
+                    client = cl['clid']
+                    self.logger.debug("clientkick - identified user from clid (%s = %s)" % (cldbid, client))
+                    break
+
+            if not client:
+                self.logger.debug("clientkick - no client with specified cldbid (%s) was found" % cldbid)
+                return False
+        elif clid:
+            client = clid
+        else:
+            raise InvalidArguments('No clid or cldbid provided')
+
+        # Kick message can only be 40 characters
+        message = (message or '')[:40]
+
+        self.logger.debug("clientkick - Kicking clid %s" % client)
+        response = await self.send_command('clientkick', keys={'clid': client, 'reasonid': type, 'reasonmsg': message})
+        return response.is_successful
+
+    async def clientpoke(self, clid, message):
+        """
+        Poke a client with the specified message
+        """
+        response = await self.send_command('clientpoke', keys={'clid': clid, 'msg': message})
+        return response.is_successful
@@ -0,0 +1,148 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+from threading import Lock
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class ResponseCache():
+    """
+    Size bounded LRU cache of successful replies to read-only commands.
+
+    Entries are keyed by the selected Virtual Server and the constructed
+    command string and expire after the TTL configured for the command.
+    Any command which is neither cached nor listed in C{passive_commands}
+    is assumed to change server state and drops the entries of the current
+    Virtual Server, along with instance wide entries.
+    """
+
+    # Read-only commands cached by default, with their TTL in seconds
+    default_ttls = {
+        'serverinfo': 5,
+        'serverlist': 5,
+        'channellist': 2,
+        'channelinfo': 2,
+        'channelgrouplist': 30,
+        'servergrouplist': 30,
+        'permissionlist': 300,
+        'hostinfo': 5,
+        'instanceinfo': 30,
+        'version': 300,
+    }
+
+    # Commands which neither get cached nor invalidate the cache
+    passive_commands = frozenset([
+        'use', 'whoami', 'help', 'quit', 'clientlist', 'clientinfo', 'clientfind',
+        'clientdblist', 'clientdbinfo', 'clientdbfind', 'clientgetids', 'clientgetdbidfromuid',
+        'clientgetnamefromuid', 'clientgetnamefromdbid', 'channelfind', 'banlist',
+        'complainlist', 'logview', 'servernotifyregister', 'servernotifyunregister',
+        'sendtextmessage', 'gm', 'clientpoke', 'ftlist', 'ftinitdownload',
+        'servergroupsbyclientid', 'servergroupclientlist', 'channelgroupclientlist',
+        'permoverview', 'permidgetbyname', 'permfind', 'serverrequestconnectioninfo',
+    ])
+
+    def __init__(self, ttls=None, max_entries=256):
+        """
+        @param ttls: Command to TTL mapping, defaults to L{default_ttls}
+        @type ttls: dict
+        @param max_entries: Maximum number of cached replies
+        @type max_entries: int
+        """
+        self.ttls = dict(self.default_ttls if ttls is None else ttls)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def observe(self, sid, command):
+        """
+        Called for every command sent, invalidating the entries a command
+        which changes server state may affect
+        """
+        if command not in self.ttls and command not in self.passive_commands:
+            self.invalidate(sid)
+
+    def get(self, sid, command, commandstr):
+        """
+        Returns a copy of the cached reply, or None
+        """
+        if command not in self.ttls:
+            return None
+
+        key = (sid, commandstr)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Re-inserting marks the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+
+        return entry[1].copy()
+
+    def store(self, sid, command, commandstr, response):
+        ttl = self.ttls.get(command)
+        if not ttl or not response.is_successful:
+            return
+
+        with self._lock:
+            self._entries.pop((sid, commandstr), None)
+            self._entries[(sid, commandstr)] = (time.time() + ttl, response.copy())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, sid=None):
+        """
+        Drops the entries of a Virtual Server and the instance wide entries,
+        or everything when no sid is given
+        """
+        with self._lock:
+            self.invalidations += 1
+            if sid is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] in (sid, None)]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+            }
@@ -0,0 +1,194 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Change detection between successive listings
+
+L{SnapshotDiff} compares each new C{clientlist} or C{channellist} against
+the previous one and reports what changed, so pollers only act on deltas::
+
+    clients = SnapshotDiff.clients()
+    while True:
+        for change in clients.feed(server.send_command('clientlist').data):
+            if change.kind == 'moved':
+                ...
+        time.sleep(5)
+
+Only the fields the caller asked for are compared. Rows are hashed by key
+and each snapshot keeps one tuple of compared values per row, so a diff is
+O(n) in the size of the listing.
+"""
+
+JOINED = 'joined'
+LEFT = 'left'
+MOVED = 'moved'
+RENAMED = 'renamed'
+CHANGED = 'changed'
+
+
+class Change():
+    """
+    A single difference between two snapshots
+
+    C{old} is None for joined rows and C{new} is None for rows which left.
+    C{fields} holds the names of the compared fields which differ.
+    """
+
+    __slots__ = ('kind', 'key', 'old', 'new', 'fields')
+
+    def __init__(self, kind, key, old, new, fields=()):
+        self.kind = kind
+        self.key = key
+        self.old = old
+        self.new = new
+        self.fields = fields
+
+    def __repr__(self):
+        return '<Change %s %s %s>' % (self.kind, self.key, ','.join(self.fields))
+
+
+class SnapshotDiff():
+    """
+    Keeps the last snapshot of a listing and yields the L{Change}s against
+    each new one. Rows may be dicts, L{ts3.protocol.TS3Row}s or records,
+    only the key and compared fields are read from them.
+    """
+
+    def __init__(self, key='clid', fields=(), moved='cid', renamed='client_nickname'):
+        """
+        @param key: Field identifying a row
+        @type key: str
+        @param fields: Further fields to compare, reported as "changed"
+        @type fields: sequence
+        @param moved: Field reported as "moved" when it changes, or None
+        @type moved: str
+        @param renamed: Field reported as "renamed" when it changes, or None
+        @type renamed: str
+        """
+        self.key = key
+        self.moved = moved
+        self.renamed = renamed
+        self.fields = tuple(f for f in (moved, renamed) if f is not None) + \
+            tuple(f for f in fields if f not in (moved, renamed))
+        self._snapshot = {}
+
+    @classmethod
+    def clients(cls, fields=()):
+        """
+        Differ for "clientlist", keyed by clid
+        """
+        return cls('clid', fields, moved='cid', renamed='client_nickname')
+
+    @classmethod
+    def channels(cls, fields=()):
+        """
+        Differ for "channellist", keyed by cid. Channels moved to another
+        parent are reported as "moved".
+        """
+        return cls('cid', fields, moved='pid', renamed='channel_name')
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __contains__(self, key):
+        return key in self._snapshot
+
+    def get(self, key, default=None):
+        """
+        Returns the row of the given key in the current snapshot
+        """
+        entry = self._snapshot.get(key)
+        return default if entry is None else entry[1]
+
+    def prime(self, rows):
+        """
+        Takes rows as the current snapshot without reporting them as joined
+        """
+        self._snapshot = self._index(rows)
+
+    def reset(self):
+        self._snapshot = {}
+
+    def update(self, rows):
+        """
+        Returns the list of changes against the previous snapshot, see
+        L{feed}
+        """
+        return list(self.feed(rows))
+
+    def feed(self, rows):
+        """
+        Generator consuming a new listing and yielding the changes against
+        the previous snapshot. Joined and changed rows are yielded as the
+        rows are consumed, so the streams of L{TS3Proto.stream_command} can
+        be diffed as they arrive, though no other command can be sent on the
+        connection until the stream is done. Rows which left can only be
+        known at the end and follow last. The snapshot is replaced once all rows have
+        been consumed; abandoning the generator earlier keeps the old one.
+
+        @param rows: The new listing
+        @type rows: iterable
+        """
+        previous = self._snapshot
+        current = {}
+        key = self.key
+        fields = self.fields
+
+        for row in rows:
+            k = row[key]
+            signature = tuple([row.get(f) for f in fields])
+            current[k] = (signature, row)
+
+            entry = previous.get(k)
+            if entry is None:
+                yield Change(JOINED, k, None, row, fields)
+            elif entry[0] != signature:
+                for change in self._changes(k, entry, signature, row):
+                    yield change
+
+        left = [(k, entry) for k, entry in previous.items() if k not in current]
+        self._snapshot = current
+        for k, entry in left:
+            yield Change(LEFT, k, entry[1], None, fields)
+
+    def _changes(self, key, entry, signature, row):
+        changed = tuple(f for f, a, b in zip(self.fields, entry[0], signature) if a != b)
+        other = []
+        for field in changed:
+            if field == self.moved:
+                yield Change(MOVED, key, entry[1], row, (field,))
+            elif field == self.renamed:
+                yield Change(RENAMED, key, entry[1], row, (field,))
+            else:
+                other.append(field)
+        if other:
+            yield Change(CHANGED, key, entry[1], row, tuple(other))
+
+    def _index(self, rows):
+        key = self.key
+        fields = self.fields
+        return dict((row[key], (tuple([row.get(f) for f in fields]), row)) for row in rows)
@@ -0,0 +1,538 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+A scriptable local ServerQuery emulator
+
+L{ServerQueryEmulator} listens on a local port and answers commands the way a
+TS3 server would, which makes it usable both by the test suite and by the
+benchmarks in C{benchmarks/}. It can generate realistic C{clientlist},
+C{channellist}, C{clientdblist} and C{logview} payloads with any number of
+rows, delay replies to simulate network latency and push notify events to
+every connected client. L{FileTransferEmulator} stands in for the file
+transfer port.
+"""
+
+import itertools
+import socket
+import threading
+import time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+from .protocol import TS3Proto
+
+WELCOME = ('Welcome to the TeamSpeak 3 ServerQuery interface, type "help" for a list of '
+           'commands and "help <command>" for information on a specific command.')
+
+OK = 'error id=0 msg=ok'
+EMPTY_RESULT = 'error id=1281 msg=database\\sempty\\sresult\\sset'
+
+
+def format_row(fields):
+    """
+    Formats a sequence of (key, value) pairs as one ServerQuery row
+
+    @param fields: (key, value) pairs, a value of None formats as a bare key
+    @type fields: sequence
+    """
+    out = []
+    for key, value in fields:
+        if value is None:
+            out.append(key)
+        else:
+            out.append('%s=%s' % (key, TS3Proto._escape_str(str(value))))
+    return ' '.join(out)
+
+
+def client_rows(count, channels=10):
+    """
+    Generates C{clientlist -uid} style rows for count clients spread across
+    the given number of channels
+    """
+    for i in range(count):
+        clid = i + 1
+        yield [('clid', clid), ('cid', i % max(channels, 1) + 1),
+               ('client_database_id', clid + 1000),
+               ('client_nickname', 'Client %d [bench]' % clid),
+               ('client_type', 0),
+               ('client_unique_identifier', 'uid%08d/Bench+Client=' % clid)]
+
+
+def channel_rows(count):
+    """
+    Generates C{channellist} style rows
+    """
+    for i in range(count):
+        cid = i + 1
+        yield [('cid', cid), ('pid', 0), ('channel_order', i),
+               ('channel_name', 'Channel %d | Lobby' % cid),
+               ('total_clients', 0), ('channel_needed_subscribe_power', 0)]
+
+
+def clientdb_rows(count):
+    """
+    Generates C{clientdblist} style rows
+    """
+    for i in range(count):
+        cldbid = i + 1001
+        yield [('cldbid', cldbid),
+               ('client_unique_identifier', 'uid%08d/Bench+Client=' % (i + 1)),
+               ('client_nickname', 'Client %d [bench]' % (i + 1)),
+               ('client_created', 1300000000 + i),
+               ('client_lastconnected', 1400000000 + i),
+               ('client_totalconnections', i % 500),
+               ('client_description', ''),
+               ('client_lastip', '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255))]
+
+
+def log_rows(count):
+    """
+    Generates C{logview} style rows
+    """
+    for i in range(count):
+        yield [('l', '2011-06-%02d 12:%02d:%02d.%06d|INFO    |VirtualServer |  1| client '
+                     'connected \'Client %d\'(id:%d) from 10.0.0.%d:%d'
+                     % (i % 28 + 1, i // 60 % 60, i % 60, i, i + 1, i + 1001, i % 255, 50000 + i % 10000))]
+
+
+def parse_line(line):
+    """
+    Splits a command line into its command, keys and options
+
+    Values are left escaped, which is all the emulator needs to match on them.
+
+    @return: (command, keys, options)
+    """
+    parts = line.split(' ')
+    keys = {}
+    opts = set()
+    for part in parts[1:]:
+        if part.startswith('-'):
+            opts.add(part[1:])
+        elif '=' in part:
+            key, value = part.split('=', 1)
+            keys[key] = value
+    return parts[0], keys, opts
+
+
+class ServerQueryEmulator(threading.Thread):
+    """
+    A scriptable TS3 ServerQuery server
+
+    Replies are looked up by command name in C{responses}, either as a list
+    of lines or a callable taking the full command line. Commands without an
+    entry get "error id=0 msg=ok". Every command line received is appended to
+    C{received}.
+    """
+
+    def __init__(self, responses=None, latency=0.0, host='127.0.0.1', rtt=0.0):
+        """
+        Binds to a free port on host and starts accepting connections
+
+        @param responses: command name to reply lines or callable
+        @type responses: dict
+        @param latency: Seconds to wait before sending each reply, either a
+        float or a dict of command name to float
+        @type latency: float or dict
+        @param rtt: Network round trip time in seconds. Unlike latency,
+        which is time spent by the server on each command, it does not hold
+        up the commands behind it, so pipelined commands overlap.
+        @type rtt: float
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.responses = responses or {}
+        self.latency = latency
+        self.rtt = rtt
+        self.received = []
+        self.conns = []
+        self.file_transfer = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(64)
+        self.host = host
+        self.port = self.sock.getsockname()[1]
+        self.start()
+
+    def populate(self, clients=0, channels=0, dbclients=0, logs=0, max_duration=None):
+        """
+        Installs generated replies for the listing commands
+
+        C{clientdblist} honours C{start}, C{duration} and C{-count} and
+        C{logview} honours C{lines}, so paging code can be exercised as well.
+        Payloads are formatted once up front so that serving them costs as
+        little as possible during benchmarks.
+
+        @param clients: Rows returned by C{clientlist}
+        @type clients: int
+        @param channels: Rows returned by C{channellist}
+        @type channels: int
+        @param dbclients: Rows in the client database
+        @type dbclients: int
+        @param logs: Lines in the server log
+        @type logs: int
+        @param max_duration: Most rows C{clientdblist} returns per page, as
+        real servers cap C{duration}
+        @type max_duration: int
+        """
+        if clients:
+            rows = list(client_rows(clients, channels or 10))
+            # The unique identifier is only sent for clientlist -uid
+            full = ['|'.join(format_row(row) for row in rows), OK]
+            plain = ['|'.join(format_row(row[:-1]) for row in rows), OK]
+            self.responses['clientlist'] = lambda line: full if '-uid' in line.split(' ') else plain
+        if channels:
+            self.responses['channellist'] = ['|'.join(format_row(row) for row in channel_rows(channels)), OK]
+        if dbclients:
+            self.responses['clientdblist'] = self._pager([format_row(row) for row in clientdb_rows(dbclients)], max_duration)
+        if logs:
+            self.responses['logview'] = self._log_view([format_row(row) for row in log_rows(logs)])
+        return self
+
+    @staticmethod
+    def _pager(rows, max_duration=None):
+        def reply(line):
+            command, keys, opts = parse_line(line)
+            start = int(keys.get('start', 0))
+            duration = int(keys.get('duration', 25))
+            if max_duration is not None:
+                duration = min(duration, max_duration)
+            page = rows[start:start + duration]
+            if not page:
+                return [EMPTY_RESULT]
+            if 'count' in opts:
+                page = ['count=%d %s' % (len(rows), page[0])] + page[1:]
+            return ['|'.join(page), OK]
+        return reply
+
+    @staticmethod
+    def _log_view(rows):
+        size = sum(len(row) for row in rows)
+
+        def reply(line):
+            command, keys, opts = parse_line(line)
+            page = rows[-int(keys.get('lines', 100)):]
+            return ['last_pos=0 file_size=%d %s' % (size, '|'.join(page)), OK]
+        return reply
+
+    def enable_file_transfer(self, delay=0.0):
+        """
+        Starts a L{FileTransferEmulator} and answers "ftinitupload",
+        "ftinitdownload", "ftlist" and "ftgetfilelist" with it
+
+        @param delay: Seconds each data connection waits before moving data
+        @type delay: float
+        """
+        self.file_transfer = FileTransferEmulator(self.host, delay=delay)
+        self.responses['ftinitupload'] = self.file_transfer.init_upload
+        self.responses['ftinitdownload'] = self.file_transfer.init_download
+        self.responses['ftlist'] = self.file_transfer.list_transfers
+        self.responses['ftgetfilelist'] = self.file_transfer.list_files
+        return self.file_transfer
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conns.append(conn)
+            threading.Thread(target=self.serve, args=(conn,)).start()
+
+    def serve(self, conn):
+        conn.sendall(b"TS3\n\r" + WELCOME.encode('utf-8') + b"\n\r")
+        send = conn.sendall
+        if self.rtt:
+            send = self._delayed_sender(conn)
+        buf = b''
+        while True:
+            try:
+                chunk = conn.recv(65536)
+            except (socket.error, OSError):
+                break
+            if not chunk:
+                break
+            buf += chunk
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                line = line.strip(b"\r").decode('utf-8')
+                if not line:
+                    continue
+                self.received.append(line)
+                reply = self.reply(line)
+                delay = self.latency
+                if isinstance(delay, dict):
+                    delay = delay.get(line.split(' ', 1)[0], 0)
+                if delay:
+                    time.sleep(delay)
+                if reply:
+                    try:
+                        send(b"".join(l.encode('utf-8') + b"\n\r" for l in reply))
+                    except (socket.error, OSError):
+                        buf = None
+                        break
+                if line == 'quit':
+                    buf = None
+                    break
+            if buf is None:
+                break
+        if self.rtt:
+            send(None)
+        if conn in self.conns:
+            self.conns.remove(conn)
+        conn.close()
+
+    def _delayed_sender(self, conn):
+        """
+        Returns a function queueing data to be sent rtt seconds later from
+        a thread of its own, None stops the thread once the queue is empty
+        """
+        queue = Queue()
+        done = threading.Event()
+
+        def run():
+            while True:
+                due, data = queue.get()
+                if data is None:
+                    break
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    conn.sendall(data)
+                except (socket.error, OSError):
+                    pass
+            done.set()
+
+        def send(data):
+            queue.put((time.time() + self.rtt, data))
+            if data is None:
+                done.wait()
+
+        threading.Thread(target=run).start()
+        return send
+
+    def reply(self, line):
+        """
+        Returns the lines to send in reply to a command line
+        """
+        response = self.responses.get(line.split(' ', 1)[0], [OK])
+        if callable(response):
+            response = response(line)
+        return response
+
+    def push(self, line):
+        """
+        Sends an unsolicited line to every connected client
+        """
+        for conn in list(self.conns):
+            try:
+                conn.sendall(line.encode('utf-8') + b"\n\r")
+            except (socket.error, OSError):
+                pass
+
+    def emit(self, event, rows):
+        """
+        Pushes a notify event to every connected client
+
+        @param event: Event name without the notify prefix, e.g. "clientmoved"
+        @type event: string
+        @param rows: Rows of the event, each a dict or (key, value) pairs
+        @type rows: list
+        """
+        rows = [row.items() if isinstance(row, dict) else row for row in rows]
+        self.push('notify%s %s' % (event, '|'.join(format_row(row) for row in rows)))
+
+    def drop(self):
+        """
+        Closes every client connection while continuing to accept new ones,
+        as when a server restarts or a connection times out
+        """
+        for conn in list(self.conns):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except (socket.error, OSError):
+                pass
+
+    def close(self):
+        # Shutting down wakes up the threads blocked on the sockets, closing
+        # alone leaves them, and the connections, open
+        self.drop()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self.sock.close()
+        for conn in list(self.conns):
+            try:
+                conn.close()
+            except (socket.error, OSError):
+                pass
+        if self.file_transfer is not None:
+            self.file_transfer.close()
+
+
+class FileTransferEmulator(threading.Thread):
+    """
+    Stand-in for the file transfer port of a TS3 server
+
+    Files are kept in C{files}, keyed by (cid, name) with the name as sent,
+    still escaped. A data connection starts with the key handed out by
+    L{init_upload} or L{init_download}, followed by the file contents from
+    C{seekpos} onwards. C{peak} is the largest number of data connections
+    that were open at the same time.
+    """
+
+    key_length = 32
+
+    def __init__(self, host='127.0.0.1', delay=0.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.delay = delay
+        self.files = {}
+        self.pending = {}
+        self.active = {}
+        self.peak = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(64)
+        self.host = host
+        self.port = self.sock.getsockname()[1]
+        self.start()
+
+    def _transfer(self, keys, upload, seekpos, size):
+        serverftfid = next(self._ids)
+        ftkey = ('%x' % serverftfid).rjust(self.key_length, 'f')
+        with self._lock:
+            self.pending[ftkey] = {'upload': upload, 'cid': int(keys.get('cid', 0)), 'name': keys['name'],
+                                   'clientftfid': keys['clientftfid'], 'serverftfid': serverftfid,
+                                   'seekpos': seekpos, 'size': size, 'sizedone': 0}
+        return serverftfid, ftkey
+
+    def init_upload(self, line):
+        command, keys, opts = parse_line(line)
+        existing = self.files.get((int(keys.get('cid', 0)), keys['name']))
+        seekpos = 0
+        if existing is not None:
+            if keys.get('resume') == '1':
+                seekpos = len(existing)
+            elif keys.get('overwrite') != '1':
+                return ['error id=2050 msg=file\\salready\\sexists']
+        serverftfid, ftkey = self._transfer(keys, True, seekpos, int(keys['size']))
+        return ['clientftfid=%s serverftfid=%d ftkey=%s port=%d seekpos=%d' % (
+            keys['clientftfid'], serverftfid, ftkey, self.port, seekpos), OK]
+
+    def init_download(self, line):
+        command, keys, opts = parse_line(line)
+        data = self.files.get((int(keys.get('cid', 0)), keys['name']))
+        if data is None:
+            return ['error id=2051 msg=file\\snot\\sfound']
+        seekpos = int(keys.get('seekpos', 0))
+        serverftfid, ftkey = self._transfer(keys, False, seekpos, len(data))
+        return ['clientftfid=%s serverftfid=%d ftkey=%s port=%d size=%d' % (
+            keys['clientftfid'], serverftfid, ftkey, self.port, len(data)), OK]
+
+    def list_transfers(self, line):
+        with self._lock:
+            rows = [[('clientftfid', t['clientftfid']), ('serverftfid', t['serverftfid']), ('path', '/'),
+                     ('name', t['name'][2:]), ('size', t['size']), ('sizedone', t['seekpos'] + t['sizedone']),
+                     ('sender', int(t['upload']))] for t in self.active.values()]
+        if not rows:
+            return [EMPTY_RESULT]
+        return ['|'.join(format_row(row) for row in rows), OK]
+
+    def list_files(self, line):
+        command, keys, opts = parse_line(line)
+        cid = int(keys.get('cid', 0))
+        rows = [[('cid', cid), ('path', '/'), ('name', name[2:]), ('size', len(data)), ('type', 1)]
+                for (file_cid, name), data in sorted(self.files.items()) if file_cid == cid]
+        if not rows:
+            return [EMPTY_RESULT]
+        return ['|'.join(format_row(row) for row in rows), OK]
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            threading.Thread(target=self.serve, args=(conn,)).start()
+
+    def serve(self, conn):
+        transfer = None
+        try:
+            ftkey = b''
+            while len(ftkey) < self.key_length:
+                chunk = conn.recv(self.key_length - len(ftkey))
+                if not chunk:
+                    return
+                ftkey += chunk
+            with self._lock:
+                transfer = self.pending.pop(ftkey.decode('ascii'), None)
+                if transfer is None:
+                    return
+                self.active[transfer['serverftfid']] = transfer
+                self.peak = max(self.peak, len(self.active))
+            if self.delay:
+                time.sleep(self.delay)
+
+            key = (transfer['cid'], transfer['name'])
+            if transfer['upload']:
+                data = [self.files.get(key, b'')[:transfer['seekpos']]]
+                remaining = transfer['size'] - transfer['seekpos']
+                while remaining > 0:
+                    chunk = conn.recv(min(remaining, 65536))
+                    if not chunk:
+                        break
+                    data.append(chunk)
+                    transfer['sizedone'] += len(chunk)
+                    remaining -= len(chunk)
+                # Partial uploads are kept, so they can be resumed
+                self.files[key] = b''.join(data)
+            else:
+                conn.sendall(self.files[key][transfer['seekpos']:])
+        except (socket.error, OSError):
+            pass
+        finally:
+            if transfer is not None:
+                with self._lock:
+                    self.active.pop(transfer['serverftfid'], None)
+            conn.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self.sock.close()
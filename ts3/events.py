@@ -0,0 +1,115 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+from threading import Lock, Thread
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+class TS3EventDispatcher():
+    """
+    Hands notifications to their registered handlers on a separate thread,
+    so a slow handler (or one sending commands of its own) never holds up
+    the connection reading them.
+
+    Handlers are registered per notification name as sent by the server,
+    such as "notifycliententerview", or for every notification with "*".
+    Each handler is called with the L{ts3.protocol.TS3Event}.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._lock = Lock()
+        self._queue = Queue()
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def add_handler(self, event, handler):
+        """
+        @param event: Notification name, or "*" for all notifications
+        @type event: str
+        @param handler: Called with each matching L{ts3.protocol.TS3Event}
+        @type handler: callable
+        """
+        with self._lock:
+            self._handlers.setdefault(event, []).append(handler)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='ts3-event-dispatcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove_handler(self, event, handler):
+        with self._lock:
+            handlers = self._handlers.get(event, [])
+            if handler in handlers:
+                handlers.remove(handler)
+
+    def has_handlers(self, event):
+        with self._lock:
+            return bool(self._handlers.get(event) or self._handlers.get('*'))
+
+    def dispatch(self, event):
+        """
+        Queues an event for its handlers, events nobody listens for are
+        dropped
+        """
+        if self.has_handlers(event.name):
+            self._queue.put(event)
+        else:
+            self.logger.debug("dispatch - unhandled event %s" % event.name)
+
+    def stop(self):
+        """
+        Stops the dispatcher thread once the queued events are handled
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+
+            with self._lock:
+                handlers = self._handlers.get(event.name, []) + self._handlers.get('*', [])
+
+            for handler in handlers:
+                try:
+                    handler(event)
+                except Exception:
+                    self.logger.exception("dispatch - handler for %s failed" % event.name)
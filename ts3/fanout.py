@@ -0,0 +1,147 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .pool import TS3ServerPool
+
+
+class FanOutResult():
+    """
+    Outcome of a fan-out task for one target
+    """
+
+    __slots__ = ('target', 'value', 'error', 'latency')
+
+    def __init__(self, target, value=None, error=None, latency=0.0):
+        self.target = target
+        self.value = value
+        self.error = error
+        self.latency = latency
+
+    @property
+    def is_successful(self):
+        """
+        True when the task raised nothing and, for commands, the server
+        accepted it
+        """
+        if self.error is not None:
+            return False
+        return getattr(self.value, 'is_successful', True)
+
+    def __repr__(self):
+        return 'FanOutResult(%r, error=%r, latency=%.3f)' % (self.target, self.error, self.latency)
+
+
+class FanOut():
+    """
+    Runs a command or callable against many (ip, port, sid) targets at once
+    over a bounded thread pool, taking connections from a L{TS3ServerPool}.
+    Results are yielded as each target finishes::
+
+        with FanOut('serveradmin', 'secretpassword', max_workers=32) as fanout:
+            for result in fanout.run(targets, 'gm', keys={'msg': 'Restart in 5 minutes'}):
+                print(result.target, result.is_successful, result.latency)
+    """
+
+    def __init__(self, username=None, password=None, max_workers=16, pool=None, **pool_kwargs):
+        """
+        @param username: ServerQuery login name
+        @type username: str
+        @param password: ServerQuery password
+        @type password: str
+        @param max_workers: Targets worked on at the same time
+        @type max_workers: int
+        @param pool: Pool to take connections from, by default one is
+            created from username, password and pool_kwargs
+        @type pool: L{TS3ServerPool}
+        """
+        self._own_pool = pool is None
+        self.pool = pool if pool is not None else TS3ServerPool(username, password, **pool_kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._own_pool:
+            self.pool.close()
+
+    def run(self, targets, task, keys=None, opts=None):
+        """
+        Runs the task on every target, yielding a L{FanOutResult} per target
+        in the order they finish. Stopping early cancels the targets not
+        started yet.
+
+        @param targets: (ip, port, sid) tuples, a sid of 0 leaves the
+            selection untouched
+        @type targets: iterable
+        @param task: Command name, or a callable taking the L{TS3Server}
+        @type task: str/callable
+        @param keys: Key/Value pairs when task is a command
+        @type keys: dict
+        @param opts: Options when task is a command
+        @type opts: list
+        """
+        if not callable(task):
+            command = task
+            task = lambda server: server.send_command(command, keys=keys, opts=opts)
+
+        futures = [self._executor.submit(self._run_one, tuple(target), task) for target in targets]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def map(self, targets, task, keys=None, opts=None):
+        """
+        Like L{run}, but waits for all targets and returns a dict of target
+        to L{FanOutResult}
+        """
+        return dict((result.target, result) for result in self.run(targets, task, keys=keys, opts=opts))
+
+    def _run_one(self, target, task):
+        start = time.time()
+        try:
+            with self.pool.connection(*target) as server:
+                value = task(server)
+        except Exception as e:
+            self.logger.debug("fanout - %s:%s sid %s failed: %s" % (target + (e,)))
+            return FanOutResult(target, error=e, latency=time.time() - start)
+        return FanOutResult(target, value=value, latency=time.time() - start)
@@ -0,0 +1,305 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+File transfers through the TS3 file transfer port
+
+"ftinitupload" and "ftinitdownload" return a key and a port. The data is
+then moved over a separate TCP connection to that port, which starts with
+the key and carries the raw file contents from C{seekpos} onwards. Uploads
+are written with C{socket.sendfile}, which hands regular files to the
+kernel, and downloads are received into a preallocated buffer, so large
+transfers do not copy data through Python objects.
+
+Transfers do not hold the ServerQuery connection, so several can run at the
+same time from different threads, see L{FileTransfers}.
+"""
+
+import io
+import itertools
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# Size of the buffer downloads are received into
+CHUNK_SIZE = 256 * 1024
+
+_clientftfids = itertools.count(1)
+_clientftfids_lock = Lock()
+
+
+def next_clientftfid():
+    """
+    Returns a transfer ID unique within this process, the server requires
+    the IDs of the transfers running on one connection to differ
+    """
+    with _clientftfids_lock:
+        return next(_clientftfids)
+
+
+def file_size(source):
+    """
+    Returns the size of a path, file object or bytes to upload
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    if not hasattr(source, 'read'):
+        return os.path.getsize(source)
+    try:
+        return os.fstat(source.fileno()).st_size
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        position = source.tell()
+        size = source.seek(0, io.SEEK_END)
+        source.seek(position)
+        return size
+
+
+class FileTransferError(Exception):
+    """
+    Raised when the server refuses a transfer or the data connection ends
+    before the whole file was moved
+    """
+
+    def __init__(self, msg, response=None):
+        Exception.__init__(self, msg)
+        self.response = response
+
+
+class FileTransfer():
+    """
+    A transfer initiated by "ftinitupload" or "ftinitdownload", moved by
+    calling L{upload} or L{download} once
+    """
+
+    __slots__ = ('clientftfid', 'serverftfid', 'ftkey', 'host', 'port', 'size', 'seekpos',
+                 'transferred', 'duration', 'timeout')
+
+    def __init__(self, clientftfid, serverftfid, ftkey, host, port, size, seekpos=0, timeout=10):
+        self.clientftfid = clientftfid
+        self.serverftfid = serverftfid
+        self.ftkey = ftkey
+        self.host = host
+        self.port = port
+        self.size = size
+        self.seekpos = seekpos
+        self.transferred = 0
+        self.duration = None
+        self.timeout = timeout
+
+    @classmethod
+    def from_response(cls, response, host, clientftfid, size=None, seekpos=None, timeout=10):
+        """
+        Builds a transfer from the reply to "ftinitupload" or
+        "ftinitdownload", raising L{FileTransferError} if it was refused.
+        Newer servers report a refusal in a "status" field instead of the
+        error line.
+
+        @param host: Address of the ServerQuery connection, used unless the
+            reply names a specific one
+        @type host: str
+        @param size: File size, for uploads
+        @type size: int
+        @param seekpos: Offset requested, for downloads
+        @type seekpos: int
+        """
+        if not response.is_successful or not response.data:
+            raise FileTransferError('Transfer refused: %s' % response.response.get('msg'), response.response)
+        row = response.data[0]
+        if row.get('status') and row['status'] != '0':
+            raise FileTransferError('Transfer refused: %s' % row.get('msg'), dict(row))
+
+        # "ip" lists the addresses the server listens on, wildcards meaning
+        # the ServerQuery address
+        ip = (row.get('ip') or '').split(',')[0]
+        if ip and ip not in ('0.0.0.0', '::'):
+            host = ip
+        if size is None:
+            size = int(row['size'])
+        if seekpos is None:
+            seekpos = int(row.get('seekpos') or 0)
+        return cls(clientftfid, int(row['serverftfid']), row['ftkey'], host, int(row['port']), size,
+                   seekpos=seekpos, timeout=timeout)
+
+    def __repr__(self):
+        return '<FileTransfer %s %s:%s %d/%d>' % (self.clientftfid, self.host, self.port,
+                                                  self.seekpos + self.transferred, self.size)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.sendall(self.ftkey.encode('ascii'))
+        return sock
+
+    def upload(self, source):
+        """
+        Sends the file from C{seekpos} onwards
+
+        @param source: Path, file object opened in binary mode, or bytes
+        @type source: str/file/bytes
+        """
+        opened = None
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        elif not hasattr(source, 'read'):
+            source = opened = open(source, 'rb')
+
+        count = self.size - self.seekpos
+        start = time.time()
+        try:
+            sock = self._connect()
+            try:
+                if count > 0:
+                    self.transferred = sock.sendfile(source, self.seekpos, count)
+                # The server closes the connection once it has the whole file
+                sock.shutdown(socket.SHUT_WR)
+                while sock.recv(1024):
+                    pass
+            finally:
+                sock.close()
+        finally:
+            if opened is not None:
+                opened.close()
+        self.duration = time.time() - start
+
+        if self.transferred != count:
+            raise FileTransferError('Upload ended after %d of %d bytes' % (self.transferred, count))
+        return self
+
+    def download(self, target, chunk_size=CHUNK_SIZE):
+        """
+        Receives the file from C{seekpos} onwards. A writable buffer such as
+        a C{bytearray} of the remaining size is received into directly,
+        anything else gets the data through its C{write} method.
+
+        @param target: Path, file object opened in binary mode, or buffer
+        @type target: str/file/bytearray
+        @param chunk_size: Size of the receive buffer for files
+        @type chunk_size: int
+        """
+        opened = None
+        if isinstance(target, str):
+            target = opened = open(target, 'r+b' if self.seekpos else 'wb')
+            target.seek(self.seekpos)
+
+        count = self.size - self.seekpos
+        start = time.time()
+        try:
+            sock = self._connect()
+            try:
+                if hasattr(target, 'write'):
+                    self.transferred = self._receive_to_file(sock, target, count, chunk_size)
+                else:
+                    self.transferred = self._receive_into(sock, memoryview(target), count)
+            finally:
+                sock.close()
+        finally:
+            if opened is not None:
+                opened.close()
+        self.duration = time.time() - start
+
+        if self.transferred != count:
+            raise FileTransferError('Download ended after %d of %d bytes' % (self.transferred, count))
+        return self
+
+    @staticmethod
+    def _receive_into(sock, view, count):
+        if len(view) < count:
+            raise ValueError('Buffer of %d bytes is too small for %d' % (len(view), count))
+        received = 0
+        while received < count:
+            n = sock.recv_into(view[received:count])
+            if not n:
+                break
+            received += n
+        return received
+
+    @staticmethod
+    def _receive_to_file(sock, target, count, chunk_size):
+        view = memoryview(bytearray(min(chunk_size, max(count, 1))))
+        received = 0
+        while received < count:
+            n = sock.recv_into(view, min(len(view), count - received))
+            if not n:
+                break
+            target.write(view[:n])
+            received += n
+        return received
+
+
+class FileTransfers():
+    """
+    Runs several transfers of one connection at the same time. Initiating a
+    transfer takes a command on the connection, moving the data does not::
+
+        with FileTransfers(server, max_workers=4) as transfers:
+            futures = [transfers.upload(path, '/' + os.path.basename(path)) for path in paths]
+        results = [f.result() for f in futures]
+    """
+
+    def __init__(self, server, max_workers=4):
+        """
+        @param server: Connection to initiate the transfers on
+        @type server: L{TS3Server}
+        @param max_workers: Transfers running at the same time
+        @type max_workers: int
+        """
+        self._server = server
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def upload(self, source, name, **kwargs):
+        """
+        Uploads in the background, returning a Future resolving to the
+        L{FileTransfer}. Arguments are those of L{TS3Server.upload_file}.
+        """
+        return self._executor.submit(self._server.upload_file, source, name, **kwargs)
+
+    def download(self, name, target, **kwargs):
+        """
+        Downloads in the background, returning a Future resolving to the
+        L{FileTransfer}. Arguments are those of L{TS3Server.download_file}.
+        """
+        return self._executor.submit(self._server.download_file, name, target, **kwargs)
+
+    def close(self):
+        """
+        Waits for the running transfers to finish
+        """
+        self._executor.shutdown(wait=True)
+
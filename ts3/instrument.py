@@ -0,0 +1,233 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Per-command instrumentation
+
+Collectors registered with L{TS3Proto.add_instrument} receive a
+L{CommandSample} for every command sent, splitting its latency into the
+phases below so a slow bot can be pinned on the network, the server or the
+client:
+
+    - lock_wait: waiting for the connection's io_lock
+    - write: writing the command to the socket
+    - ttfb: from the end of the write until the first byte of the reply
+    - read: from the first byte until the trailing "error" line
+    - parse: parsing the reply. Rows are only decoded once read, which is
+      not measured, except for streams which parse each row they return
+
+Without collectors none of this is measured.
+"""
+
+import bisect
+import time
+from threading import Lock
+
+clock = getattr(time, 'perf_counter', time.time)
+
+PHASES = ('lock_wait', 'write', 'ttfb', 'read', 'parse', 'total')
+
+# Bucket upper bounds in seconds, roughly three per decade from 50us to 10s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01,
+                   0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+
+class CommandSample():
+    """
+    Timings in seconds and sizes in bytes of one command. Each attempt of a
+    command retried for flooding is a separate sample.
+    """
+
+    __slots__ = ('command', 'lock_wait', 'write', 'ttfb', 'read', 'parse',
+                 'bytes_out', 'bytes_in', 'rows', 'error_id', 'attempt')
+
+    def __init__(self, command, lock_wait=0.0, write=0.0, ttfb=0.0, read=0.0, parse=0.0,
+                 bytes_out=0, bytes_in=0, rows=0, error_id=None, attempt=0):
+        self.command = command
+        self.lock_wait = lock_wait
+        self.write = write
+        self.ttfb = ttfb
+        self.read = read
+        self.parse = parse
+        self.bytes_out = bytes_out
+        self.bytes_in = bytes_in
+        self.rows = rows
+        self.error_id = error_id
+        self.attempt = attempt
+
+    @property
+    def total(self):
+        return self.lock_wait + self.write + self.ttfb + self.read + self.parse
+
+    def __repr__(self):
+        return '<CommandSample %s %.3fms error_id=%s>' % (self.command, self.total * 1000, self.error_id)
+
+
+class Collector():
+    """
+    Base class for collectors, subclasses override L{record}. It is called
+    on the thread which sent the command, after the connection is released.
+    """
+
+    def record(self, sample):
+        """
+        @param sample: Measurements of a finished command
+        @type sample: L{CommandSample}
+        """
+        raise NotImplementedError
+
+
+class CounterCollector(Collector):
+    """
+    Counts commands, errors, bytes and rows per command name
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._errors = {}
+
+    def record(self, sample):
+        with self._lock:
+            counters = self._counters.get(sample.command)
+            if counters is None:
+                counters = self._counters[sample.command] = {
+                    'commands': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0, 'rows': 0}
+            counters['commands'] += 1
+            counters['bytes_in'] += sample.bytes_in
+            counters['bytes_out'] += sample.bytes_out
+            counters['rows'] += sample.rows
+            if sample.error_id != '0':
+                counters['errors'] += 1
+                self._errors[sample.error_id] = self._errors.get(sample.error_id, 0) + 1
+
+    def stats(self):
+        """
+        Returns the counters per command name and the number of replies per
+        error id other than 0 under 'error_ids'
+        """
+        with self._lock:
+            stats = dict((command, dict(counters)) for command, counters in self._counters.items())
+            stats['error_ids'] = dict(self._errors)
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._errors = {}
+
+
+class HistogramCollector(Collector):
+    """
+    Keeps a fixed bucket latency histogram per command name and phase,
+    see L{PHASES}. Samples are also added to the histograms of "*", which
+    cover every command.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        @param buckets: Ascending bucket upper bounds in seconds, slower
+            samples go into an overflow bucket
+        @type buckets: sequence
+        """
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self._histograms = {}
+
+    def record(self, sample):
+        with self._lock:
+            for command in (sample.command, '*'):
+                histograms = self._histograms.get(command)
+                if histograms is None:
+                    histograms = self._histograms[command] = dict(
+                        (phase, {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'max': 0.0})
+                        for phase in PHASES)
+                for phase in PHASES:
+                    value = getattr(sample, phase)
+                    histogram = histograms[phase]
+                    histogram['counts'][bisect.bisect_left(self.buckets, value)] += 1
+                    histogram['sum'] += value
+                    if value > histogram['max']:
+                        histogram['max'] = value
+
+    def percentile(self, command, phase, q):
+        """
+        Returns the upper bound of the bucket holding the q-th percentile,
+        the largest sample for the overflow bucket or None without samples
+
+        @param command: Command name or "*"
+        @type command: string
+        @param phase: One of L{PHASES}
+        @type phase: string
+        @param q: Percentile between 0 and 100
+        @type q: float
+        """
+        with self._lock:
+            histogram = self._histograms.get(command, {}).get(phase)
+            if histogram is None:
+                return None
+            return self._percentile(histogram, q)
+
+    def _percentile(self, histogram, q):
+        total = sum(histogram['counts'])
+        if not total:
+            return None
+        rank = total * q / 100.0
+        seen = 0
+        for index, count in enumerate(histogram['counts']):
+            seen += count
+            if count and seen >= rank:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], histogram['max'])
+                break
+        return histogram['max']
+
+    def stats(self):
+        """
+        Returns count, sum, mean, max, p50, p90 and p99 in seconds per
+        command name and phase
+        """
+        stats = {}
+        with self._lock:
+            for command, histograms in self._histograms.items():
+                stats[command] = {}
+                for phase, histogram in histograms.items():
+                    count = sum(histogram['counts'])
+                    stats[command][phase] = {
+                        'count': count,
+                        'sum': histogram['sum'],
+                        'mean': histogram['sum'] / count if count else 0.0,
+                        'max': histogram['max'],
+                        'p50': self._percentile(histogram, 50),
+                        'p90': self._percentile(histogram, 90),
+                        'p99': self._percentile(histogram, 99),
+                    }
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
@@ -0,0 +1,171 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import socket
+import time
+from threading import Event, Lock, Thread
+
+
+class KeepaliveScheduler():
+    """
+    Keeps idle connections from being dropped by the server's idle timeout,
+    about 10 minutes by default, by sending a cheap command on every
+    connection which has not sent one for C{interval} seconds.
+
+    A single background thread serves all connections added to it. A
+    connection busy with a command, or whose rate limiter has no token to
+    spare, is skipped until the next round rather than waited for. The round
+    trip time of each keepalive is kept in the connection's C{idle_rtt} as a
+    cheap health signal.
+    """
+
+    def __init__(self, interval=300, command='whoami'):
+        """
+        @param interval: Idle seconds after which a keepalive is sent
+        @type interval: float
+        @param command: Command sent, "whoami" or "version"
+        @type command: str
+        """
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+
+        self.interval = interval
+        self.command = command
+        self._lock = Lock()
+        self._connections = {}
+        self._changed = Event()
+        self._running = False
+        self._thread = None
+        self._stats = {'sent': 0, 'skipped': 0, 'failed': 0, 'rtt_total': 0.0, 'rtt_max': 0.0}
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def add(self, proto):
+        """
+        Starts keeping a connection alive, starting the thread on first use
+
+        @param proto: Connection
+        @type proto: L{TS3Proto}
+        """
+        with self._lock:
+            self._connections[id(proto)] = proto
+            if self._thread is None:
+                self._running = True
+                self._thread = Thread(target=self._run, name='ts3-keepalive')
+                self._thread.daemon = True
+                self._thread.start()
+        self._changed.set()
+
+    def remove(self, proto):
+        with self._lock:
+            self._connections.pop(id(proto), None)
+
+    def __len__(self):
+        return len(self._connections)
+
+    def stop(self):
+        """
+        Stops the thread, it is started again by the next L{add}
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._running = False
+        self._changed.set()
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        """
+        Returns the keepalives sent, skipped because the connection was busy
+        and failed, along with the average and largest round trip time
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['connections'] = len(self._connections)
+        stats['rtt_avg'] = stats['rtt_total'] / stats['sent'] if stats['sent'] else 0.0
+        return stats
+
+    def _run(self):
+        while self._running:
+            now = time.time()
+            with self._lock:
+                connections = list(self._connections.values())
+
+            next_due = now + self.interval
+            for proto in connections:
+                due = proto.last_command + self.interval
+                if due <= now:
+                    due = self._ping(proto)
+                next_due = min(next_due, due)
+
+            self._changed.wait(max(next_due - time.time(), 0.01))
+            self._changed.clear()
+
+    def _ping(self, proto):
+        """
+        Sends a keepalive on a connection, returning when the next one is due
+        """
+        try:
+            rtt = proto.keepalive(self.command)
+        except (socket.error, EOFError):
+            rtt = None
+            with self._lock:
+                self._stats['failed'] += 1
+            self.logger.debug("keepalive - connection lost")
+            self._recover(proto)
+            return time.time() + self.interval
+
+        if rtt is None:
+            with self._lock:
+                self._stats['skipped'] += 1
+            if not proto.is_connected():
+                self._recover(proto)
+            # Busy connections are either not idle or will be shortly
+            return time.time() + min(self.interval, 1.0)
+
+        with self._lock:
+            self._stats['sent'] += 1
+            self._stats['rtt_total'] += rtt
+            self._stats['rtt_max'] = max(self._stats['rtt_max'], rtt)
+        return time.time() + self.interval
+
+    def _recover(self, proto):
+        """
+        Reconnects a lost connection with a reconnect policy, which saves
+        the next command from doing so, and forgets any other
+        """
+        if proto.reconnect_policy is not None:
+            try:
+                proto.check_connection()
+                return
+            except Exception:
+                self.logger.debug("keepalive - unable to reconnect")
+        self.remove(proto)
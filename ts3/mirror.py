@@ -0,0 +1,283 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+from threading import RLock
+
+
+class ServerStateMirror():
+    """
+    In-memory copy of the clients and channels of a Virtual Server, indexed
+    so that lookups need no network round trip.
+
+    The lists are loaded once by L{load} and then kept current from
+    notifications once L{attach} has been called, or by calling L{refresh}
+    periodically to apply the difference to a fresh listing::
+
+        mirror = ServerStateMirror(server)
+        mirror.load()
+        mirror.attach()
+        server.start_event_listener()
+
+        for client in mirror.clients_in_channel(405):
+            ...
+
+    Rows are the dicts as returned by "clientlist -uid" and "channellist",
+    kept current in place, and should be treated as read-only.
+    """
+
+    # Keys of the notifications which are not client or channel properties
+    event_keys = ('cfid', 'ctid', 'reasonid', 'reasonmsg', 'invokerid', 'invokername', 'invokeruid', 'bantime')
+
+    # Channel properties named differently in the notifications than in "channellist"
+    channel_renames = {'cpid': 'pid', 'order': 'channel_order'}
+
+    def __init__(self, server):
+        """
+        @param server: Connection to mirror the selected Virtual Server of
+        @type server: L{TS3Server}
+        """
+        self._server = server
+        self._lock = RLock()
+        self._logger = logging.getLogger(__name__)
+        self._reset()
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def _reset(self):
+        self._clients = {}
+        self._channels = {}
+        self._by_cldbid = {}
+        self._by_uid = {}
+        self._by_nickname = {}
+        self._by_channel = {}
+
+    def load(self):
+        """
+        Loads the full client and channel lists, replacing the current state
+        """
+        lists = self._fetch()
+        if lists is None:
+            return False
+
+        clients, channels = lists
+        with self._lock:
+            self._reset()
+            for row in channels:
+                self._channels[int(row['cid'])] = row
+            for row in clients:
+                self._add_client(row)
+        return True
+
+    def refresh(self):
+        """
+        Fetches fresh lists and applies the differences, for use when not
+        attached to notifications or to correct for missed ones
+        """
+        lists = self._fetch()
+        if lists is None:
+            return False
+
+        clients, channels = lists
+        with self._lock:
+            self._channels = dict((int(row['cid']), row) for row in channels)
+
+            fresh = dict((int(row['clid']), row) for row in clients)
+            left = [self._clients[clid] for clid in set(self._clients) - set(fresh)]
+            for row in left:
+                self._remove_client(int(row['clid']))
+
+            for clid, row in fresh.items():
+                if clid in self._clients:
+                    self._update_client(clid, row)
+                else:
+                    self._add_client(row)
+        return True
+
+    def attach(self, register=True):
+        """
+        Keeps the mirror current from notifications. Notifications are read
+        by the next command or by L{TS3Proto.start_event_listener}.
+
+        @param register: Also register for the server and channel
+            notifications
+        @type register: bool
+        """
+        server = self._server
+        server.on('notifycliententerview', self._on_client_enter)
+        server.on('notifyclientleftview', self._on_client_left)
+        server.on('notifyclientmoved', self._on_client_moved)
+        server.on('notifychannelcreated', self._on_channel_changed)
+        server.on('notifychanneledited', self._on_channel_changed)
+        server.on('notifychannelmoved', self._on_channel_changed)
+        server.on('notifychanneldeleted', self._on_channel_deleted)
+        server.mirror = self
+
+        if register:
+            server.servernotifyregister('server')
+            server.servernotifyregister('channel', id=0)
+
+    # Lookups
+
+    def client(self, clid):
+        with self._lock:
+            return self._clients.get(int(clid))
+
+    def clients(self):
+        with self._lock:
+            return list(self._clients.values())
+
+    def clients_by_cldbid(self, cldbid):
+        """
+        Returns the connected clients of a database ID, one identity can be
+        connected more than once
+        """
+        return self._lookup(self._by_cldbid, int(cldbid))
+
+    def clients_by_uid(self, uid):
+        return self._lookup(self._by_uid, uid)
+
+    def client_by_nickname(self, nickname):
+        with self._lock:
+            clid = self._by_nickname.get(nickname)
+            return self._clients.get(clid) if clid is not None else None
+
+    def clients_in_channel(self, cid):
+        return self._lookup(self._by_channel, int(cid))
+
+    def channel(self, cid):
+        with self._lock:
+            return self._channels.get(int(cid))
+
+    def channels(self):
+        with self._lock:
+            return list(self._channels.values())
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _lookup(self, index, key):
+        with self._lock:
+            return [self._clients[clid] for clid in index.get(key, ())]
+
+    def _fetch(self):
+        clients = self._server.send_command('clientlist', opts=['uid'])
+        channels = self._server.send_command('channellist')
+        if not clients.is_successful or not channels.is_successful:
+            self.logger.debug("mirror - error retrieving client or channel list")
+            return None
+        return clients.data, channels.data
+
+    # Index maintenance, called with the lock held
+
+    def _add_client(self, row):
+        clid = int(row['clid'])
+        self._clients[clid] = row
+        self._index(clid, row)
+
+    def _remove_client(self, clid):
+        row = self._clients.pop(clid, None)
+        if row is not None:
+            self._unindex(clid, row)
+        return row
+
+    def _update_client(self, clid, values):
+        row = self._clients[clid]
+        self._unindex(clid, row)
+        row.update(values)
+        self._index(clid, row)
+
+    def _index(self, clid, row):
+        if row.get('client_database_id'):
+            self._by_cldbid.setdefault(int(row['client_database_id']), set()).add(clid)
+        if row.get('client_unique_identifier'):
+            self._by_uid.setdefault(row['client_unique_identifier'], set()).add(clid)
+        if row.get('client_nickname') is not None:
+            self._by_nickname[row['client_nickname']] = clid
+        if row.get('cid'):
+            self._by_channel.setdefault(int(row['cid']), set()).add(clid)
+
+    def _unindex(self, clid, row):
+        for index, key in ((self._by_cldbid, row.get('client_database_id')),
+                           (self._by_uid, row.get('client_unique_identifier')),
+                           (self._by_channel, row.get('cid'))):
+            if key is None:
+                continue
+            if index is not self._by_uid:
+                key = int(key)
+            clids = index.get(key)
+            if clids is not None:
+                clids.discard(clid)
+                if not clids:
+                    del index[key]
+        if self._by_nickname.get(row.get('client_nickname')) == clid:
+            del self._by_nickname[row['client_nickname']]
+
+    # Notification handlers
+
+    def _client_row(self, data, cid):
+        row = dict((k, v) for k, v in data.items() if k not in self.event_keys)
+        row['cid'] = cid
+        return row
+
+    def _on_client_enter(self, event):
+        with self._lock:
+            for data in event.data:
+                clid = int(data['clid'])
+                self._remove_client(clid)
+                self._add_client(self._client_row(data, data.get('ctid')))
+
+    def _on_client_left(self, event):
+        with self._lock:
+            for data in event.data:
+                self._remove_client(int(data['clid']))
+
+    def _on_client_moved(self, event):
+        # Only the first row of a multi client move carries the target
+        ctid = event.data[0].get('ctid')
+        with self._lock:
+            for data in event.data:
+                clid = int(data['clid'])
+                if clid in self._clients:
+                    self._update_client(clid, {'cid': ctid})
+
+    def _on_channel_changed(self, event):
+        with self._lock:
+            for data in event.data:
+                cid = int(data['cid'])
+                values = dict((self.channel_renames.get(k, k), v) for k, v in data.items() if k not in self.event_keys)
+                if cid in self._channels:
+                    self._channels[cid].update(values)
+                else:
+                    self._channels[cid] = values
+
+    def _on_channel_deleted(self, event):
+        with self._lock:
+            for data in event.data:
+                self._channels.pop(int(data['cid']), None)
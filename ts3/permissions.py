@@ -0,0 +1,388 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+from threading import RLock
+from .protocol import InvalidArguments, ERROR_EMPTY_RESULT
+from .defines import PERMGROUP_TYPE_SERVERGROUP, PERMGROUP_TYPE_GLOBALCLIENT, PERMGROUP_TYPE_CHANNEL, \
+    PERMGROUP_TYPE_CHANNELGROUP, PERMGROUP_TYPE_CHANNELCLIENT
+
+
+class PermissionResolver():
+    """
+    Resolves the effective permissions of clients without asking the server
+    each time.
+
+    L{load} fetches the permission list and the permissions of every server
+    group and channel group, and which channel group each client has in
+    which channel. The tables specific to a client or channel are fetched
+    the first time they are needed, after which checks are dictionary
+    lookups::
+
+        perms = PermissionResolver(server)
+        perms.load()
+        perms.attach()
+
+        if perms.check('b_client_kick_from_channel', cldbid, cid=405):
+            ...
+        if perms.has_power('i_channel_join_power', 'i_channel_needed_join_power', cldbid, 405):
+            ...
+
+    The layers are applied in the order of the C{PERMGROUP_TYPE_*}
+    constants, each one present replacing the value of the previous ones:
+    server groups, client, channel, channel group and channel client
+    permissions. Of several server groups the highest value wins, unless
+    some of them negate the permission, in which case the lowest negated
+    value wins. The skip flag on a server group or client permission keeps
+    the channel layers from replacing it.
+
+    Permission changes are not announced to ServerQuery clients, so after
+    editing permissions call the matching C{refresh_*} method.
+    """
+
+    def __init__(self, server):
+        """
+        @param server: Connection to the Virtual Server to resolve for
+        @type server: L{TS3Server}
+        """
+        self._server = server
+        self._lock = RLock()
+        self._logger = logging.getLogger(__name__)
+        self._reset()
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def _reset(self):
+        # Permission tables map permsid to (value, negated, skip)
+        self._ids = {}
+        self._names = {}
+        self._servergroups = {}
+        self._channelgroups = {}
+        self._clients = {}
+        self._channels = {}
+        self._channelclients = {}
+        # Group memberships, cldbid -> sgids and (cid, cldbid) -> cgid
+        self._client_servergroups = {}
+        self._client_channelgroups = {}
+        self._default_channelgroup = None
+
+    def load(self):
+        """
+        Loads the permission list, the group permissions and the channel
+        group memberships, replacing the current state
+        """
+        with self._server.pipeline() as pipe:
+            permissions = pipe.send_command('permissionlist')
+            info = pipe.send_command('serverinfo')
+            servergroups = pipe.send_command('servergrouplist')
+            channelgroups = pipe.send_command('channelgrouplist')
+            members = pipe.send_command('channelgroupclientlist')
+
+        for future in (permissions, info, servergroups, channelgroups):
+            if not future.result().is_successful:
+                self.logger.debug("permissions - error retrieving %s" % future.result().response.get('msg'))
+                return False
+
+        sgids = [int(row['sgid']) for row in servergroups.result().data]
+        cgids = [int(row['cgid']) for row in channelgroups.result().data]
+        with self._server.pipeline() as pipe:
+            sgperms = [pipe.send_command('servergrouppermlist', keys={'sgid': sgid}, opts=['permsid'])
+                       for sgid in sgids]
+            cgperms = [pipe.send_command('channelgrouppermlist', keys={'cgid': cgid}, opts=['permsid'])
+                       for cgid in cgids]
+
+        with self._lock:
+            self._reset()
+            for row in permissions.result().data:
+                self._ids[row['permname']] = int(row['permid'])
+                self._names[int(row['permid'])] = row['permname']
+            default = info.result().data[0].get('virtualserver_default_channel_group')
+            self._default_channelgroup = int(default) if default else None
+            for sgid, future in zip(sgids, sgperms):
+                self._servergroups[sgid] = self._table(future.result()) or {}
+            for cgid, future in zip(cgids, cgperms):
+                self._channelgroups[cgid] = self._table(future.result()) or {}
+            self._load_members(members.result())
+        return True
+
+    def attach(self):
+        """
+        Keeps the group memberships of connecting clients current from
+        "notifycliententerview", which carries their server groups and the
+        channel group in the channel they join
+        """
+        self._server.on('notifycliententerview', self._on_client_enter)
+
+    # Incremental refreshes
+
+    def refresh_servergroup(self, sgid):
+        """
+        Reloads the permissions of a server group, or forgets it if it no
+        longer exists
+        """
+        table = self._fetch('servergrouppermlist', {'sgid': sgid})
+        with self._lock:
+            if table is None:
+                self._servergroups.pop(int(sgid), None)
+            else:
+                self._servergroups[int(sgid)] = table
+
+    def refresh_channelgroup(self, cgid):
+        """
+        Reloads the permissions of a channel group, or forgets it if it no
+        longer exists
+        """
+        table = self._fetch('channelgrouppermlist', {'cgid': cgid})
+        with self._lock:
+            if table is None:
+                self._channelgroups.pop(int(cgid), None)
+            else:
+                self._channelgroups[int(cgid)] = table
+
+    def refresh_memberships(self):
+        """
+        Reloads which channel group each client has in each channel
+        """
+        response = self._server.send_command('channelgroupclientlist')
+        with self._lock:
+            self._load_members(response)
+
+    def refresh_client(self, cldbid):
+        """
+        Forgets the server groups and permissions of a client, they are
+        fetched again by the next check
+        """
+        cldbid = int(cldbid)
+        with self._lock:
+            self._client_servergroups.pop(cldbid, None)
+            self._clients.pop(cldbid, None)
+            for key in [key for key in self._channelclients if key[1] == cldbid]:
+                del self._channelclients[key]
+
+    def refresh_channel(self, cid):
+        """
+        Forgets the permissions of a channel, they are fetched again by the
+        next check
+        """
+        cid = int(cid)
+        with self._lock:
+            self._channels.pop(cid, None)
+            for key in [key for key in self._channelclients if key[0] == cid]:
+                del self._channelclients[key]
+
+    # Lookups
+
+    def permission_id(self, name):
+        return self._ids.get(name)
+
+    def permission_name(self, permid):
+        return self._names.get(int(permid))
+
+    def resolve(self, permission, cldbid, cid=None):
+        """
+        Returns the effective value of a permission and the
+        C{PERMGROUP_TYPE_*} of the layer it came from, or (None, None) when
+        the client does not have it
+
+        @param permission: Permission name such as "b_client_kick_from_channel", or its ID
+        @type permission: str/int
+        @param cldbid: Client database ID
+        @type cldbid: int
+        @param cid: Channel ID, without it only the server wide layers apply
+        @type cid: int
+        """
+        name = self._name(permission)
+        cldbid = int(cldbid)
+        sgids, client = self._client(cldbid)
+
+        value, layer, skip = None, None, False
+        granted = [self._servergroups[sgid][name] for sgid in sgids
+                   if name in self._servergroups.get(sgid, ())]
+        if granted:
+            negated = [entry for entry in granted if entry[1]]
+            value = min(negated)[0] if negated else max(granted)[0]
+            layer = PERMGROUP_TYPE_SERVERGROUP
+            skip = any(entry[2] for entry in granted)
+
+        if name in client:
+            value, negated, skip = client[name]
+            layer = PERMGROUP_TYPE_GLOBALCLIENT
+
+        if cid is None or skip:
+            return value, layer
+
+        cid = int(cid)
+        cgid = self._client_channelgroups.get((cid, cldbid), self._default_channelgroup)
+        for table, type in ((self._channel(cid), PERMGROUP_TYPE_CHANNEL),
+                            (self._channelgroups.get(cgid, {}), PERMGROUP_TYPE_CHANNELGROUP),
+                            (self._channelclient(cid, cldbid), PERMGROUP_TYPE_CHANNELCLIENT)):
+            if name in table:
+                value, layer = table[name][0], type
+        return value, layer
+
+    def effective(self, permission, cldbid, cid=None):
+        """
+        Returns the effective value of a permission, None if the client does
+        not have it. See L{resolve}.
+        """
+        return self.resolve(permission, cldbid, cid)[0]
+
+    def check(self, permission, cldbid, cid=None, needed=1):
+        """
+        Returns whether the effective value of a permission is at least
+        needed, which for boolean permissions means it is granted
+
+        @param needed: Value required
+        @type needed: int
+        """
+        value = self.resolve(permission, cldbid, cid)[0]
+        return value is not None and value >= needed
+
+    def has_power(self, power, needed, cldbid, cid):
+        """
+        Returns whether the client's power is at least the value the channel
+        requires, such as "i_channel_join_power" against the channel's
+        "i_channel_needed_join_power". A channel not setting the needed
+        value requires no power.
+
+        @param power: Power permission of the client
+        @type power: str/int
+        @param needed: Needed power permission of the channel
+        @type needed: str/int
+        """
+        required = self._channel(int(cid)).get(self._name(needed))
+        if required is None or required[0] <= 0:
+            return True
+        value = self.resolve(power, cldbid, cid)[0]
+        return value is not None and value >= required[0]
+
+    # Table loading
+
+    def _name(self, permission):
+        if isinstance(permission, int):
+            if permission not in self._names:
+                raise InvalidArguments('Unknown permission ID %s' % permission)
+            return self._names[permission]
+        return permission
+
+    def _client(self, cldbid):
+        with self._lock:
+            sgids = self._client_servergroups.get(cldbid)
+            table = self._clients.get(cldbid)
+        if sgids is not None and table is not None:
+            return sgids, table
+
+        # Group memberships may already be known from a notification
+        with self._server.pipeline() as pipe:
+            if sgids is None:
+                groups = pipe.send_command('servergroupsbyclientid', keys={'cldbid': cldbid})
+            if table is None:
+                perms = pipe.send_command('clientpermlist', keys={'cldbid': cldbid}, opts=['permsid'])
+
+        if sgids is None:
+            groups = groups.result()
+            if groups.is_successful:
+                sgids = tuple(int(row['sgid']) for row in groups.data)
+            elif groups.response.get('id') == ERROR_EMPTY_RESULT:
+                sgids = ()
+        if table is None:
+            table = self._table(perms.result())
+
+        # Whatever failed is not cached, so the next check tries again
+        if sgids is None or table is None:
+            self.logger.debug("permissions - error retrieving the permissions of client %s" % cldbid)
+        with self._lock:
+            if sgids is not None:
+                self._client_servergroups[cldbid] = sgids
+            if table is not None:
+                self._clients[cldbid] = table
+        return sgids or (), table or {}
+
+    def _channel(self, cid):
+        table = self._channels.get(cid)
+        if table is None:
+            table = self._fetch('channelpermlist', {'cid': cid})
+            if table is None:
+                return {}
+            with self._lock:
+                self._channels[cid] = table
+        return table
+
+    def _channelclient(self, cid, cldbid):
+        table = self._channelclients.get((cid, cldbid))
+        if table is None:
+            table = self._fetch('channelclientpermlist', {'cid': cid, 'cldbid': cldbid})
+            if table is None:
+                return {}
+            with self._lock:
+                self._channelclients[(cid, cldbid)] = table
+        return table
+
+    def _fetch(self, command, keys):
+        table = self._table(self._server.send_command(command, keys=keys, opts=['permsid']))
+        if table is None:
+            self.logger.debug("permissions - error retrieving %s %s" % (command, keys))
+        return table
+
+    def _table(self, response):
+        """
+        Indexes the rows of a permission listing by permission name. Returns
+        None if the listing failed, an empty table if it has no rows.
+        """
+        if not response.is_successful:
+            return {} if response.response.get('id') == ERROR_EMPTY_RESULT else None
+
+        table = {}
+        for row in response.data:
+            name = row.get('permsid')
+            if name is None:
+                name = self._names.get(int(row['permid']))
+            table[name] = (int(row['permvalue']), row.get('permnegated') == '1', row.get('permskip') == '1')
+        return table
+
+    def _load_members(self, response):
+        # Called with the lock held
+        if not response.is_successful:
+            self.logger.debug("permissions - error retrieving the channel group members")
+            return
+        self._client_channelgroups = dict(((int(row['cid']), int(row['cldbid'])), int(row['cgid']))
+                                          for row in response.data)
+
+    # Notification handlers
+
+    def _on_client_enter(self, event):
+        with self._lock:
+            for data in event.data:
+                if not data.get('client_database_id'):
+                    continue
+                cldbid = int(data['client_database_id'])
+                if data.get('client_servergroups'):
+                    self._client_servergroups[cldbid] = tuple(int(sgid) for sgid in data['client_servergroups'].split(',') if sgid)
+                if data.get('client_channel_group_id') and data.get('ctid'):
+                    self._client_channelgroups[(int(data['ctid']), cldbid)] = int(data['client_channel_group_id'])
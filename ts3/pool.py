@@ -0,0 +1,424 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import socket
+import time
+from threading import Condition
+from .keepalive import KeepaliveScheduler
+from .protocol import ConnectionError, NoConnectionError
+from .server import TS3Server
+
+
+class PoolError(Exception):
+    """
+    Raised when the pool cannot provide a usable connection
+    """
+
+
+class PoolExhaustedError(PoolError):
+    """
+    Raised when no connection became available within the checkout timeout
+    """
+
+
+class _PooledConnection():
+    __slots__ = ('server', 'host', 'last_used', 'last_checked')
+
+    def __init__(self, server, host):
+        self.server = server
+        self.host = host
+        self.last_used = self.last_checked = time.time()
+
+
+class TS3ServerPool():
+    """
+    Thread safe pool of logged in L{TS3Server} connections.
+
+    Connections are kept per (ip, port) and remember the Virtual Server they
+    last selected, so checking out a connection for a sid prefers one that
+    is already using it and only runs "use" when it differs::
+
+        pool = TS3ServerPool('serveradmin', 'secretpassword', max_size=4)
+        with pool.connection('127.0.0.1', 10011, 1) as server:
+            clients = server.clientlist()
+    """
+
+    # Errors after which a connection is closed rather than returned
+    connection_errors = (socket.error, EOFError, NoConnectionError)
+
+    def __init__(self, username=None, password=None, min_size=0, max_size=10,
+                 max_idle=300, check_interval=60, checkout_timeout=10, timeout=5,
+                 keepalive=None, server_class=TS3Server, **server_kwargs):
+        """
+        @param username: ServerQuery login name, None to skip logging in
+        @type username: str
+        @param password: ServerQuery password
+        @type password: str
+        @param min_size: Connections opened per host on its first checkout,
+            and idle connections per host kept regardless of max_idle
+        @type min_size: int
+        @param max_size: Maximum connections per host
+        @type max_size: int
+        @param max_idle: Seconds after which idle connections are closed
+        @type max_idle: float
+        @param check_interval: Idle seconds after which a connection is
+            checked with "whoami" before being handed out
+        @type check_interval: float
+        @param checkout_timeout: Seconds to wait for a free connection
+        @type checkout_timeout: float
+        @param timeout: Connection timeout passed to L{TS3Server.connect}
+        @type timeout: float
+        @param keepalive: Idle seconds after which connections are sent a
+            keepalive from a shared L{KeepaliveScheduler}, None to disable.
+            Needs to be below the server's idle timeout of 10 minutes and
+            is mostly useful with min_size or a large max_idle.
+        @type keepalive: float
+        @param server_class: Class used for new connections
+        @type server_class: class
+        """
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('Pool sizes must satisfy 0 <= min_size <= max_size, max_size >= 1')
+
+        self._username = username
+        self._password = password
+        self._min_size = min_size
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._check_interval = check_interval
+        self._checkout_timeout = checkout_timeout
+        self._timeout = timeout
+        self._server_class = server_class
+        self._server_kwargs = server_kwargs
+        self.keepalive = KeepaliveScheduler(interval=keepalive) if keepalive else None
+        self._logger = logging.getLogger(__name__)
+
+        self._cond = Condition()
+        self._idle = {}
+        self._sizes = {}
+        self._warmed = set()
+        self._checked_out = {}
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'closed': 0,
+            'failed_checks': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def connection(self, ip, port=10011, sid=0):
+        """
+        Context manager checking out a connection and returning it afterwards.
+        Connections which raised a connection error are discarded instead.
+
+        @param ip: IP Address
+        @type ip: str
+        @param port: Port Number
+        @type port: int
+        @param sid: Virtual Server ID, 0 to leave the selection untouched
+        @type sid: int
+        """
+        return _PoolCheckout(self, ip, port, sid)
+
+    def checkout(self, ip, port=10011, sid=0):
+        """
+        Checks out a connection, which must be given back with L{release}
+
+        @param ip: IP Address
+        @type ip: str
+        @param port: Port Number
+        @type port: int
+        @param sid: Virtual Server ID, 0 to leave the selection untouched
+        @type sid: int
+        """
+        host = (ip, port)
+        start = time.time()
+
+        if self._min_size:
+            with self._cond:
+                warm = host not in self._warmed
+                self._warmed.add(host)
+            if warm:
+                self._prewarm(ip, port)
+
+        while True:
+            conn = self._acquire(host, sid, start)
+            if conn is None:
+                # A slot was reserved for a new connection
+                try:
+                    server = self._create(ip, port)
+                except Exception:
+                    with self._cond:
+                        self._sizes[host] -= 1
+                        self._cond.notify()
+                    raise
+                conn = _PooledConnection(server, host)
+            elif not self._check(conn):
+                self._discard(conn)
+                continue
+
+            self._record_wait(time.time() - start)
+            with self._cond:
+                self._checked_out[id(conn.server)] = conn
+
+            if sid and conn.server._sid != sid:
+                try:
+                    selected = conn.server.use(sid)
+                except self.connection_errors:
+                    self.release(conn.server, discard=True)
+                    raise
+                if not selected:
+                    self.release(conn.server)
+                    raise PoolError('Unable to select Virtual Server %s on %s:%s' % (sid, ip, port))
+
+            return conn.server
+
+    def release(self, server, discard=False):
+        """
+        Returns a connection to the pool
+
+        @param server: Connection obtained from L{checkout}
+        @type server: L{TS3Server}
+        @param discard: Close the connection instead of keeping it
+        @type discard: bool
+        """
+        with self._cond:
+            conn = self._checked_out.pop(id(server), None)
+        if conn is None:
+            raise ValueError('Connection was not checked out from this pool')
+
+        if discard or self._closed or not server.is_connected():
+            self._discard(conn)
+            return
+
+        conn.last_used = time.time()
+        with self._cond:
+            self._idle.setdefault(conn.host, []).append(conn)
+            self._cond.notify()
+
+    def evict_idle(self):
+        """
+        Closes connections idle for longer than max_idle, keeping min_size
+        per host. Also done on every checkout for the host concerned.
+        """
+        with self._cond:
+            expired = [conn for host in list(self._idle) for conn in self._expire(host)]
+        for conn in expired:
+            self._close_server(conn.server)
+
+    def close(self):
+        """
+        Closes all idle connections, connections still checked out are
+        closed when released
+        """
+        with self._cond:
+            self._closed = True
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle = {}
+        for conn in idle:
+            self._discard(conn)
+        if self.keepalive is not None:
+            self.keepalive.stop()
+
+    def stats(self):
+        """
+        Returns a dict of pool counters, including the checkout wait times
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['wait_avg'] = stats['wait_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+            stats['idle'] = sum(len(conns) for conns in self._idle.values())
+            stats['size'] = sum(self._sizes.values())
+            stats['in_use'] = stats['size'] - stats['idle']
+        if self.keepalive is not None:
+            stats['keepalive'] = self.keepalive.stats()
+        return stats
+
+    def _acquire(self, host, sid, start):
+        """
+        Returns an idle connection, or None after reserving a slot for a new
+        one, waiting while the host is at max_size
+        """
+        expired = []
+        try:
+            return self._wait_for_slot(host, sid, start, expired)
+        finally:
+            for conn in expired:
+                self._close_server(conn.server)
+
+    def _wait_for_slot(self, host, sid, start, expired):
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError('Pool is closed')
+
+                expired.extend(self._expire(host))
+                idle = self._idle.get(host)
+                if idle:
+                    # Prefer a connection already using the sid, then the
+                    # most recently used one, leaving old ones to expire
+                    for i in range(len(idle) - 1, -1, -1):
+                        if idle[i].server._sid == sid:
+                            return idle.pop(i)
+                    return idle.pop()
+
+                if self._sizes.get(host, 0) < self._max_size:
+                    self._sizes[host] = self._sizes.get(host, 0) + 1
+                    return None
+
+                remaining = self._checkout_timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise PoolExhaustedError('No connection to %s:%s available after %.1fs' % (host[0], host[1], self._checkout_timeout))
+                self._cond.wait(remaining)
+
+    def _prewarm(self, ip, port):
+        """
+        Opens idle connections until the host has min_size
+        """
+        host = (ip, port)
+        with self._cond:
+            count = max(0, self._min_size - self._sizes.get(host, 0))
+            self._sizes[host] = self._sizes.get(host, 0) + count
+
+        for i in range(count):
+            try:
+                server = self._create(ip, port)
+            except Exception:
+                with self._cond:
+                    self._sizes[host] -= count - i
+                    # Try again on the next checkout
+                    self._warmed.discard(host)
+                    self._cond.notify(count - i)
+                raise
+            conn = _PooledConnection(server, host)
+            with self._cond:
+                closed = self._closed
+                if not closed:
+                    self._idle.setdefault(host, []).append(conn)
+                    self._cond.notify()
+            if closed:
+                self._discard(conn)
+
+    def _create(self, ip, port):
+        server = self._server_class(**self._server_kwargs)
+        if not server.connect(ip, port, self._timeout):
+            raise ConnectionError(ip, port)
+
+        try:
+            logged_in = self._username is None or server.login(self._username, self._password)
+        except Exception:
+            self._close_server(server)
+            raise
+        if not logged_in:
+            self._close_server(server)
+            raise PoolError('Login to %s:%s failed' % (ip, port))
+
+        if self.keepalive is not None:
+            self.keepalive.add(server)
+        with self._cond:
+            self._stats['created'] += 1
+        self.logger.debug("pool - opened connection to %s:%s" % (ip, port))
+        return server
+
+    def _check(self, conn):
+        if time.time() - conn.last_checked < self._check_interval:
+            return True
+
+        try:
+            healthy = conn.server.is_connected() and conn.server.send_command('whoami').is_successful
+        except self.connection_errors:
+            healthy = False
+
+        if healthy:
+            conn.last_checked = time.time()
+        else:
+            with self._cond:
+                self._stats['failed_checks'] += 1
+            self.logger.debug("pool - health check failed for %s:%s" % conn.host)
+        return healthy
+
+    def _discard(self, conn):
+        self._close_server(conn.server)
+
+        with self._cond:
+            self._sizes[conn.host] -= 1
+            self._stats['closed'] += 1
+            self._cond.notify()
+
+    def _expire(self, host):
+        """
+        Removes and returns the expired idle connections of a host, oldest
+        first. Called with the condition held.
+        """
+        idle = self._idle.get(host)
+        expired = []
+        cutoff = time.time() - self._max_idle
+        while idle and len(idle) > self._min_size and idle[0].last_used < cutoff:
+            expired.append(idle.pop(0))
+            self._sizes[host] -= 1
+            self._stats['closed'] += 1
+        if expired:
+            self._cond.notify(len(expired))
+        return expired
+
+    def _close_server(self, server):
+        if self.keepalive is not None:
+            self.keepalive.remove(server)
+        try:
+            if server.is_connected():
+                server.disconnect()
+        except Exception:
+            # "quit" failed, close the socket without it
+            server._close_transport()
+
+    def _record_wait(self, wait):
+        with self._cond:
+            self._stats['checkouts'] += 1
+            self._stats['wait_total'] += wait
+            self._stats['wait_max'] = max(self._stats['wait_max'], wait)
+
+
+class _PoolCheckout():
+
+    def __init__(self, pool, ip, port, sid):
+        self._pool = pool
+        self._args = (ip, port, sid)
+        self._server = None
+
+    def __enter__(self):
+        self._server = self._pool.checkout(*self._args)
+        return self._server
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        discard = exc_type is not None and issubclass(exc_type, self._pool.connection_errors)
+        self._pool.release(self._server, discard=discard)
@@ -26,8 +26,30 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import logging
-import telnetlib
-from threading import Lock
+import re
+import socket
+import time
+from collections import deque
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from concurrent.futures import Future
+from threading import BoundedSemaphore, Event, Lock, RLock, Thread
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+from .cache import ResponseCache
+from .events import TS3EventDispatcher
+from .instrument import CommandSample, clock
+from .keepalive import KeepaliveScheduler
+from .ratelimit import RateLimiter, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from .reconnect import ReconnectPolicy
+from .transport import SocketTransport
+
+# Returned for a page past the end of a listing
+ERROR_EMPTY_RESULT = '1281'
 
 
 class ConnectionError(Exception):
@@ -64,30 +86,288 @@ ts3_escape = [
      (chr(11), r'\v'),   # Vertical tab
 ]
 
+# Matches any character which needs escaping, used to skip clean values
+ts3_escape_re = re.compile('[%s]' % re.escape(''.join(i for i, j in ts3_escape)))
+
+# Unescaping everything but the backslash, spaces are by far the most common
+ts3_unescape = [(j, i) for i, j in ts3_escape if i not in (chr(92), chr(32))]
+
+# End of a row within a reply, either the row separator or the line end
+ts3_row_end = (b"|", b"\n\r")
+
+# Commands changing the session state restored after a reconnect
+session_commands = frozenset(['use', 'login', 'logout', 'clientupdate', 'servernotifyregister', 'servernotifyunregister'])
+
+
+def count_rows(data):
+    """
+    Counts the rows of a raw reply without decoding it, escaped values never
+    contain a "|"
+
+    @param data: The data line, if any
+    @type data: bytes
+    """
+    return data.count(b'|') + 1 if data.strip() else 0
+
 
 class TS3Response():
+    """
+    Reply to a command. The "error" line is parsed straight away, the data
+    is kept as received and only parsed when first accessed, either into
+    dicts through C{data} or into L{TS3Row}s through C{rows}.
+    """
+
     def __init__(self, response, data):
+        """
+        @param response: The "error" line
+        @type response: bytes/string
+        @param data: The data line, if any
+        @type data: bytes/string
+        """
+        if isinstance(response, bytes):
+            response = response.decode('utf-8')
         self.response = TS3Proto.parse_response(response)
-        self.data = TS3Proto.parse_data(data)
+        self._raw = data
+        self._data = None
+        self._rows = None
 
-        if isinstance(self.data, dict):
-            if self.data:
-                self.data = [self.data]
-            else:
-                self.data = []
+    def _split(self):
+        """
+        Returns the escaped text of each row
+        """
+        raw = self._raw
+        if isinstance(raw, bytes):
+            raw = self._raw = raw.decode('utf-8')
+        raw = raw.strip()
+        return raw.split('|') if raw else []
+
+    @property
+    def data(self):
+        """
+        The rows as dicts, parsed in full on first access
+        """
+        if self._data is None:
+            parse_row = TS3Proto.parse_row
+            self._data = [parse_row(row) for row in self._split()]
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._raw = None
+        self._rows = None
+
+    @property
+    def rows(self):
+        """
+        The rows as L{TS3Row}s, which only unescape the fields read and are
+        cheaper when a few fields are picked out of a large listing. They
+        are separate from C{data}, changing one does not change the other.
+        """
+        if self._rows is None:
+            if self._raw is None:
+                return self.data
+            self._rows = [TS3Row(row) for row in self._split()]
+        return self._rows
 
     @property
     def is_successful(self):
         return self.response['msg'] == 'ok'
 
+    def records(self, record):
+        """
+        Returns the rows as typed records
+
+        @param record: Record type, see L{ts3.records}
+        @type record: class
+        """
+        if self._data is None and self._raw is not None:
+            return [record.from_row(row) for row in self._split()]
+        return [record.from_dict(row) for row in self.data]
+
+    def copy(self):
+        """
+        Returns a copy which can be modified without affecting this response
+        """
+        response = TS3Response.__new__(TS3Response)
+        response.response = dict(self.response)
+        response._raw = self._raw
+        response._data = None
+        response._rows = None
+        if self._data is not None:
+            response._data = [dict(row) for row in self._data]
+        return response
+
+
+class TS3Row(MutableMapping):
+    """
+    A row of a reply which behaves like the dict returned by
+    L{TS3Proto.parse_row}, but keeps the escaped text of the row. Single
+    fields are looked up in the text directly, the row is only split into
+    fields when iterated over or modified, and only the values accessed are
+    unescaped.
+    """
+
+    __slots__ = ('_raw', '_fields', '_decoded')
+
+    def __init__(self, raw):
+        """
+        @param raw: Raw text of the row, still escaped
+        @type raw: bytes/string
+        """
+        self._raw = raw
+        self._fields = None
+        self._decoded = None
+
+    @property
+    def text(self):
+        """
+        The escaped text of the row, None once it has been split into fields
+        """
+        raw = self._raw
+        if isinstance(raw, bytes):
+            raw = self._raw = raw.decode('utf-8')
+        return raw
+
+    def _index(self):
+        fields = {}
+        for chunk in self.text.split(' '):
+            if chunk:
+                key, sep, value = chunk.partition('=')
+                # Keys without a value are read as None, like parse_row
+                fields[key] = value if sep else None
+        self._fields = fields
+        self._raw = None
+        return fields
+
+    def __getitem__(self, key):
+        decoded = self._decoded
+        if decoded is not None and key in decoded:
+            return decoded[key]
+
+        fields = self._fields
+        if fields is None:
+            value = self._find(key)
+        else:
+            value = fields[key]
+        if value is None or '\\' not in value:
+            return value
+
+        if decoded is None:
+            decoded = self._decoded = {}
+        value = decoded[key] = TS3Proto._unescape_str(value)
+        return value
+
+    def _find(self, key):
+        """
+        Looks a single field up in the unsplit row, which is much cheaper
+        than splitting it when only a few fields are read. Values never
+        contain a raw space, so " key=" can only match at a field boundary.
+        """
+        text = self.text
+        needle = key + '='
+        if text.startswith(needle):
+            start = len(needle)
+        else:
+            start = text.find(' ' + needle)
+            if start < 0:
+                # Missing, or a key without a value
+                return self._index()[key]
+            start += len(needle) + 1
+        end = text.find(' ', start)
+        return text[start:] if end < 0 else text[start:end]
+
+    def __setitem__(self, key, value):
+        if self._fields is None:
+            self._index()
+        if self._decoded is None:
+            self._decoded = {}
+        self._fields[key] = value
+        self._decoded[key] = value
+
+    def __delitem__(self, key):
+        if self._fields is None:
+            self._index()
+        del self._fields[key]
+        if self._decoded is not None:
+            self._decoded.pop(key, None)
+
+    def __contains__(self, key):
+        fields = self._fields
+        if fields is None:
+            fields = self._index()
+        return key in fields
+
+    def __iter__(self):
+        fields = self._fields
+        if fields is None:
+            fields = self._index()
+        return iter(fields)
+
+    def __len__(self):
+        fields = self._fields
+        if fields is None:
+            fields = self._index()
+        return len(fields)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        """
+        Returns an independent row, still lazy where this one is
+        """
+        row = TS3Row(self._raw)
+        if self._fields is not None:
+            row._fields = dict(self._fields)
+        if self._decoded is not None:
+            row._decoded = dict(self._decoded)
+        return row
+
+
+class TS3Event():
+    """
+    An unsolicited notification, such as "notifycliententerview"
+    """
+
+    def __init__(self, line):
+        self.name, _, data = line.partition(' ')
+        self.data = TS3Proto.parse_data(data)
+
+        if isinstance(self.data, dict):
+            self.data = [self.data]
+
 
 class TS3Proto():
 
-    def __init__(self):
+    def __init__(self, transport=SocketTransport):
+        """
+        @param transport: Transport class used to reach the server, see
+            L{ts3.transport}
+        @type transport: class
+        """
         self.io_lock = Lock()
         self._connected = False
         self._timeout = 0
-        self._telnet = None
+        self._transport_class = transport
+        self._transport = None
+        self._sid = None
+        self.cache = None
+        self.rate_limiter = None
+        self.instruments = []
+        self.reconnect_policy = None
+        self._address = None
+        self._generation = 0
+        self._reconnect_lock = Lock()
+        self._session = OrderedDict()
+        self.last_command = time.time()
+        self.idle_rtt = None
+        self._keepalive = None
+        self._mux = None
+        self._listener = None
+        self._listen_interval = None
+        self._listening = Event()
+        self.events = TS3EventDispatcher()
         self._logger = logging.getLogger(__name__)
 
     @property
@@ -95,52 +375,593 @@ class TS3Proto():
         return self._logger
 
     def connect(self, ip, port=10011, timeout=5):
+        self._connected = self._open(ip, port, timeout)
+        return self._connected
+
+    def _open(self, ip, port, timeout):
+        """
+        Opens a new transport and reads the banner and welcome line,
+        returning whether the other end is a ServerQuery interface
+        """
         with self.io_lock:
             try:
-                self._telnet = telnetlib.Telnet(ip, port)
-            except telnetlib.socket.error:
+                self._transport = self._transport_class(ip, port, timeout)
+            except socket.error:
                 raise ConnectionError(ip, port)
 
             self._timeout = timeout
             self._connected = False
+            self._address = (ip, port)
+            self._generation += 1
 
-            data = self._telnet.read_until(b"\n\r", self._timeout)
-
-        if data.endswith(b"TS3\n\r"):
-            self._connected = True
-
-        return self._connected
+            # A failed attempt must not leave the new transport open
+            try:
+                data = self._transport.read_until(b"\n\r", self._timeout)
+                if data.endswith(b"TS3\n\r"):
+                    # Otherwise read as part of the first reply
+                    self._transport.read_until(b"\n\r", self._timeout)
+            except (socket.error, EOFError):
+                self._close_transport()
+                raise
+            if not data.endswith(b"TS3\n\r"):
+                self._close_transport()
+                return False
+
+        return True
 
     def disconnect(self):
+        # Forget the address first so a failing "quit" is not reconnected
+        self._address = None
         self.check_connection()
 
+        self.stop_keepalive()
+        self.stop_event_listener()
         self.send_command("quit")
-        self._telnet.close()
+        self._transport.close()
 
         self._connected = False
 
-    def send_command(self, command, keys=None, opts=None):
+    def send_command(self, command, keys=None, opts=None, priority=PRIORITY_INTERACTIVE):
         self.check_connection()
 
         commandstr = self.construct_command(command, keys=keys, opts=opts)
+        return self._send(command, keys, commandstr, priority)
+
+    def _send(self, command, keys, commandstr, priority, raw=None):
+        """
+        Sends a constructed command through the cache, see L{send_command}.
+        raw is the encoded command line if the caller already has it.
+        """
+        cache = self.cache
+        if cache is not None:
+            cached = cache.get(self._sid, command, commandstr)
+            if cached is not None:
+                self.logger.debug("send_command - %s (cached)" % commandstr)
+                return cached
+            cache.observe(self._sid, command)
+
         self.logger.debug("send_command - %s" % commandstr)
 
+        response = self._execute(commandstr, priority, raw=raw)
+        self._command_done(command, keys, response)
+
+        if cache is not None:
+            cache.store(self._sid, command, commandstr, response)
+
+        return response
+
+    def _execute(self, commandstr, priority=PRIORITY_INTERACTIVE, replay=True, raw=None):
+        """
+        Writes a command and reads its reply, waiting for the rate limiter
+        and retrying commands rejected for flooding. With a reconnect policy
+        and replay set, idempotent commands whose reply was lost with the
+        connection are sent again once it has been restored.
+        """
+        if raw is None:
+            raw = commandstr.encode('utf-8') + b"\n\r"
+
+        mux = self._mux
+        if mux is not None and replay:
+            return mux.execute(commandstr, priority, raw)
+
+        limiter = self.rate_limiter
+        attempt = 0
+        replays = 0
+
+        while True:
+            if limiter is not None:
+                limiter.acquire(priority)
+
+            if replay and not self._connected:
+                self.check_connection()
+            generation = self._generation
+            try:
+                if self.instruments:
+                    response = self._execute_measured(commandstr, attempt, raw)
+                else:
+                    with self.io_lock:
+                        self._transport.write(raw)
+                        response, data = self._read_response()
+
+                    response = TS3Response(response, data)
+            except (socket.error, EOFError):
+                self._connection_lost(generation)
+                policy = self.reconnect_policy
+                if not replay or policy is None or self._address is None \
+                        or not policy.can_replay(commandstr.partition(' ')[0], replays):
+                    raise
+                self._reconnect()
+                replays += 1
+                policy.record('replays')
+                continue
+
+            if limiter is None or not limiter.should_retry(response, attempt):
+                return response
+            attempt += 1
+
+    def _execute_measured(self, commandstr, attempt, raw):
+        """
+        Same as a single attempt of L{_execute} while recording a
+        L{CommandSample} for the instruments
+        """
+        start = clock()
         with self.io_lock:
-            self._telnet.write(commandstr.encode('utf-8') + b"\n\r")
+            locked = clock()
+            self._transport.write(raw)
+            written = clock()
+            self._transport.has_data(self._timeout)
+            first = clock()
+            response, data = self._read_response()
+            done = clock()
+
+        bytes_in = len(response) + len(data)
+        response = TS3Response(response, data)
+        self._record(CommandSample(
+            commandstr.partition(' ')[0], lock_wait=locked - start, write=written - locked,
+            ttfb=first - written, read=done - first, parse=clock() - done,
+            bytes_out=len(raw), bytes_in=bytes_in, rows=count_rows(data),
+            error_id=response.response.get('id'), attempt=attempt))
+        return response
+
+    def add_instrument(self, collector):
+        """
+        Registers a collector receiving a L{CommandSample} for each command
+        sent on this connection, see L{ts3.instrument}. Returns the collector.
+
+        @param collector: Collector such as L{HistogramCollector}
+        @type collector: L{Collector}
+        """
+        self.instruments = self.instruments + [collector]
+        return collector
+
+    def remove_instrument(self, collector):
+        self.instruments = [c for c in self.instruments if c is not collector]
+
+    def _record(self, sample):
+        for collector in self.instruments:
+            try:
+                collector.record(sample)
+            except Exception:
+                self.logger.exception("instrument - %r failed to record %r" % (collector, sample))
+
+    def keepalive(self, command='whoami'):
+        """
+        Sends a cheap command to keep an idle connection open, unless the
+        connection is busy or the rate limiter has no token to spare.
+        Returns the round trip time in seconds, also kept in C{idle_rtt},
+        or None when skipped.
+
+        @param command: Command to send, "whoami" or "version"
+        @type command: str
+        """
+        if not self._connected or not self.io_lock.acquire(False):
+            return None
+
+        generation = self._generation
+        try:
+            if self.rate_limiter is not None and not self.rate_limiter.try_acquire():
+                return None
+            start = clock()
+            self._transport.write(command.encode('utf-8') + b"\n\r")
+            self._read_response()
+            rtt = clock() - start
+        except (socket.error, EOFError):
+            self._connection_lost(generation)
+            raise
+        finally:
+            self.io_lock.release()
+
+        self.last_command = time.time()
+        self.idle_rtt = rtt
+        return rtt
+
+    def start_keepalive(self, interval=300, command='whoami'):
+        """
+        Sends a keepalive whenever no command was sent for interval seconds,
+        see L{KeepaliveScheduler}. To serve many connections from one
+        thread, add them to a shared scheduler instead. Returns the scheduler.
+
+        @param interval: Idle seconds after which a keepalive is sent
+        @type interval: float
+        @param command: Command sent, "whoami" or "version"
+        @type command: str
+        """
+        self.stop_keepalive()
+        self._keepalive = KeepaliveScheduler(interval=interval, command=command)
+        self._keepalive.add(self)
+        return self._keepalive
+
+    def stop_keepalive(self):
+        keepalive, self._keepalive = self._keepalive, None
+        if keepalive is not None:
+            keepalive.stop()
+
+    def enable_rate_limit(self, commands=10, period=3.0, max_retries=3, backoff=1.0):
+        """
+        Limits the command rate to stay within the server's flood limit, see
+        L{RateLimiter}. The defaults match the server defaults of 10
+        commands per 3 seconds. Returns the limiter.
+
+        @param commands: Commands allowed per period
+        @type commands: int
+        @param period: Period in seconds
+        @type period: float
+        @param max_retries: Retries of a command rejected for flooding
+        @type max_retries: int
+        @param backoff: Initial backoff in seconds, doubled on each retry
+        @type backoff: float
+        """
+        self.rate_limiter = RateLimiter(commands, period, max_retries=max_retries, backoff=backoff)
+        return self.rate_limiter
 
-            data = b''
-            response = self._telnet.read_until(b"\n\r", self._timeout)
+    def enable_cache(self, ttls=None, max_entries=256):
+        """
+        Caches the replies to read-only commands, see L{ResponseCache}.
+        Returns the cache, whose counters are available from C{stats()}.
+
+        @param ttls: Command to TTL in seconds mapping
+        @type ttls: dict
+        @param max_entries: Maximum number of cached replies
+        @type max_entries: int
+        """
+        self.cache = ResponseCache(ttls=ttls, max_entries=max_entries)
+        return self.cache
+
+    def enable_reconnect(self, max_attempts=None, backoff=0.05, max_backoff=5.0, max_replays=2, idempotent=None):
+        """
+        Reconnects automatically when the connection is lost, restoring the
+        login, selected Virtual Server, nickname and notification
+        registrations and sending idempotent commands which lost their reply
+        again, see L{ReconnectPolicy}. Returns the policy.
+
+        @param max_attempts: Reconnect attempts before giving up, None
+            retries forever
+        @type max_attempts: int
+        @param backoff: Delay before the second attempt in seconds, doubled
+            on each further attempt
+        @type backoff: float
+        @param max_backoff: Upper bound of the delay in seconds
+        @type max_backoff: float
+        @param max_replays: Times a single command is sent again
+        @type max_replays: int
+        @param idempotent: Command names safe to replay
+        @type idempotent: iterable
+        """
+        self.reconnect_policy = ReconnectPolicy(max_attempts=max_attempts, backoff=backoff, max_backoff=max_backoff,
+                                                max_replays=max_replays, idempotent=idempotent)
+        return self.reconnect_policy
+
+    def _command_done(self, command, keys, response):
+        """
+        Tracks the session state changed by a command
+        """
+        self.last_command = time.time()
+        if command not in session_commands or not response.is_successful:
+            return
+
+        if command == 'use' and keys:
+            self._sid = keys.get('sid', keys.get('port'))
+            self._session['use'] = self.construct_command(command, keys=keys)
+        elif command == 'login':
+            self._session['login'] = self.construct_command(command, keys=keys)
+        elif command == 'logout':
+            self._session.pop('login', None)
+        elif command == 'clientupdate' and keys and 'client_nickname' in keys:
+            self._session['nickname'] = self.construct_command(command, keys={'client_nickname': keys['client_nickname']})
+        elif command == 'servernotifyregister' and keys:
+            self._session[('notify', keys.get('event'), keys.get('id'))] = self.construct_command(command, keys=keys)
+        elif command == 'servernotifyunregister':
+            for key in [key for key in self._session if isinstance(key, tuple)]:
+                del self._session[key]
+
+    def _connection_lost(self, generation):
+        """
+        Marks the connection as lost after a read or write failed on it,
+        unless it has been replaced since generation was read
+        """
+        if generation != self._generation or not self._connected:
+            return
+        self._connected = False
+        self.logger.warning("connection to %s lost" % (self._address,))
+        if self.reconnect_policy is not None:
+            self.reconnect_policy.record('disconnects')
+        self._close_transport()
+
+    def _close_transport(self):
+        try:
+            self._transport.close()
+        except (socket.error, EOFError, AttributeError):
+            pass
+
+    def _reconnect(self):
+        """
+        Reconnects and restores the session, unless another thread already
+        did so while we waited for the lock. Raises L{ConnectionError} once
+        the policy gives up.
+        """
+        policy = self.reconnect_policy
+        with self._reconnect_lock:
+            if self._connected:
+                return
+            address = self._address
+            if address is None:
+                raise NoConnectionError
+
+            started = time.time()
+            attempt = 0
+            while True:
+                delay = policy.delay(attempt)
+                if delay is None:
+                    raise ConnectionError(*address)
+                if delay:
+                    time.sleep(delay)
+                attempt += 1
+
+                self._close_transport()
+                try:
+                    # Only marked connected once the session is restored,
+                    # other threads wait for us in check_connection meanwhile
+                    if self._open(address[0], address[1], self._timeout or 5):
+                        self._restore_session()
+                        self._connected = True
+                        break
+                except (ConnectionError, socket.error, EOFError):
+                    pass
+                self._connected = False
+                policy.record('failed_attempts')
+                self.logger.debug("reconnect - attempt %d to %s failed" % (attempt, address))
+
+            policy.record('reconnects')
+            policy.record('downtime', time.time() - started)
+            self.logger.info("reconnected to %s after %d attempt(s)" % (address, attempt))
+
+        try:
+            self._session_restored()
+        except Exception:
+            self.logger.exception("reconnect - restoring local state failed")
+
+    def _restore_session(self):
+        """
+        Sends the commands recorded in the session again on a new connection
+        """
+        order = ('login', 'use', 'nickname')
+        commands = [self._session[key] for key in order if key in self._session]
+        commands += [commandstr for key, commandstr in self._session.items() if key not in order]
+
+        for commandstr in commands:
+            response = self._execute(commandstr, replay=False)
+            if not response.is_successful:
+                self.logger.error("reconnect - %s failed: %s" % (commandstr.partition(' ')[0], response.response.get('msg')))
+
+    def _session_restored(self):
+        """
+        Called after a reconnect, once the connection is usable again.
+        Subclasses refresh state which may have missed notifications.
+        """
+
+    def stream_command(self, command, keys=None, opts=None, priority=PRIORITY_INTERACTIVE, record=None):
+        """
+        Sends a command and returns a L{TS3RowStream} yielding the reply rows
+        as they are read from the connection, rather than after the whole
+        reply has arrived
+
+        @param command: Command
+        @type command: string
+        @param keys: Key/Value pairs
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        @param priority: Rate limiter priority, see L{enable_rate_limit}
+        @type priority: int
+        @param record: Yield rows as this record type, see L{ts3.records}
+        @type record: class
+        """
+        self.check_connection()
+
+        commandstr = self.construct_command(command, keys=keys, opts=opts)
+        self.logger.debug("stream_command - %s" % commandstr)
+
+        if self.cache is not None:
+            self.cache.observe(self._sid, command)
+
+        return TS3RowStream(self, commandstr, priority, record)
+
+    def paginate(self, command, keys=None, opts=None, page_size=100, prefetch=True,
+                 priority=PRIORITY_BULK, record=None):
+        """
+        Returns a L{TS3Pager} walking through a listing command which takes
+        "start" and "duration", requesting page_size rows at a time
+
+        @param command: Listing command such as "clientdblist"
+        @type command: string
+        @param keys: Key/Value pairs, a "start" key sets the first row
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        @param page_size: Rows per request, None requests everything at once
+        @type page_size: int
+        @param prefetch: Request the next page while the current one is used
+        @type prefetch: bool
+        @param priority: Rate limiter priority, see L{enable_rate_limit}
+        @type priority: int
+        @param record: Yield rows as this record type, see L{ts3.records}
+        @type record: class
+        """
+        return TS3Pager(self, command, keys=keys, opts=opts, page_size=page_size, prefetch=prefetch,
+                        priority=priority, record=record)
+
+    def on(self, event, handler):
+        """
+        Registers a handler for a notification, see L{TS3EventDispatcher}.
+        The server only sends notifications after "servernotifyregister".
+
+        @param event: Notification name such as "notifyclientmoved", or "*"
+        @type event: str
+        @param handler: Called with the L{TS3Event}
+        @type handler: callable
+        """
+        self.events.add_handler(event, handler)
+
+    def start_event_listener(self, interval=0.5):
+        """
+        Starts a thread reading notifications while no command is running.
+        Without it notifications are only picked up by the next command.
+
+        @param interval: Seconds between checks whether to stop
+        @type interval: float
+        """
+        self.check_connection()
+
+        if self._listener is not None:
+            return
+
+        self._listening.set()
+        self._listen_interval = interval
+        self._listener = Thread(target=self._listen, args=(interval,), name='ts3-event-listener')
+        self._listener.daemon = True
+        self._listener.start()
+
+    def stop_event_listener(self):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            self._listening.clear()
+            listener.join()
+
+    def _listen(self, interval):
+        while self._listening.is_set():
+            generation = self._generation
+            if not self.is_connected():
+                if self.reconnect_policy is None or self._address is None:
+                    return
+                try:
+                    self._reconnect()
+                except (ConnectionError, NoConnectionError):
+                    self.logger.debug("listen - unable to reconnect")
+                    return
+                continue
+
+            try:
+                # Only a hint, commands may consume the data before we get
+                # the lock so check again once we hold it
+                if not self._transport.has_data(interval):
+                    continue
+                with self.io_lock:
+                    while self._transport.has_data(0):
+                        line = self._transport.read_until(b"\n\r", self._timeout)
+                        if line.startswith(b"notify"):
+                            self._dispatch_event(line)
+                        elif line:
+                            self.logger.debug("listen - discarding unexpected line %r" % line)
+            except (socket.error, EOFError, ValueError):
+                self.logger.debug("listen - connection lost")
+                self._connection_lost(generation)
+
+    def prepare(self, command, keys=None, opts=None):
+        """
+        Returns a L{PreparedCommand} for sending the same shape of command
+        many times, with the keys whose value is None filled in per call
+
+        @param command: Command
+        @type command: string
+        @param keys: Key/Value pairs, None marks a slot
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        """
+        return PreparedCommand(self, command, keys=keys, opts=opts)
+
+    def pipeline(self, window=32, priority=PRIORITY_BULK):
+        """
+        Returns a L{TS3Pipeline} which sends queued commands back to back
+        instead of waiting for each reply in turn
+
+        @param window: Maximum number of commands awaiting a reply
+        @type window: int
+        @param priority: Rate limiter priority, see L{enable_rate_limit}
+        @type priority: int
+        """
+        return TS3Pipeline(self, window=window, priority=priority)
+
+    def multiplex(self, window=64):
+        """
+        Starts sharing this connection between threads through a
+        L{TS3Multiplexer}, so commands sent concurrently are pipelined rather
+        than waiting for each other. Returns the multiplexer, which is also a
+        context manager stopping it on exit.
+
+        @param window: Maximum number of commands awaiting a reply
+        @type window: int
+        """
+        return TS3Multiplexer(self, window=window).start()
+
+    def _read_response(self):
+        """
+        Reads the reply to a single command, returning a (response, data)
+        tuple of raw byte strings. The caller must hold io_lock.
+        """
+        data = b''
+        response = self._read_line()
 
         if not response.startswith(b"error"):
             # what we just got was extra data
             data = response
-            response = self._telnet.read_until(b"\n\r", self._timeout)
+            response = self._read_line()
+
+        return response, data
+
+    def _read_line(self):
+        """
+        Reads the next line which is not a notification, dispatching any
+        notifications on the way. The caller must hold io_lock.
+        """
+        while True:
+            line = self._transport.read_until(b"\n\r", self._timeout)
+            if not line.startswith(b"notify"):
+                return line
+            self._dispatch_event(line)
+
+    def _read_row(self, line_start=False):
+        """
+        Reads up to and including the next row separator or line end. At the
+        start of a line notifications are dispatched and skipped. The caller
+        must hold io_lock.
+        """
+        while True:
+            row = self._transport.read_until(ts3_row_end, self._timeout)
+            if not (line_start and row.startswith(b"notify")):
+                return row
+            if not row.endswith(b"\n\r"):
+                row += self._transport.read_until(b"\n\r", self._timeout)
+            self._dispatch_event(row)
 
-        return TS3Response(response.decode('utf-8'), data.decode('utf-8'))
+    def _dispatch_event(self, line):
+        self.events.dispatch(TS3Event(line.rstrip(b"\n\r").decode('utf-8')))
 
     def check_connection(self):
-        if not self.is_connected:
-            raise NoConnectionError
+        if not self.is_connected():
+            if self.reconnect_policy is None or self._address is None:
+                raise NoConnectionError
+            self._reconnect()
 
     def is_connected(self):
         return self._connected
@@ -204,29 +1025,34 @@ class TS3Proto():
         multipart = data.split('|')
 
         if len(multipart) > 1:
-            values = []
+            return [TS3Proto.parse_row(part) for part in multipart]
 
-            for part in multipart:
-                values.append(TS3Proto.parse_data(part))
-            return values
+        return TS3Proto.parse_row(data)
 
-        chunks = data.split(' ')
+    @staticmethod
+    def parse_row(data):
+        """
+        Parses a single row of space separated key=value pairs
+
+        @param data: row string
+        @type data: string
+        """
         parsed_data = {}
 
-        for chunk in chunks:
-            chunk = chunk.strip().split('=')
+        for chunk in data.strip().split(' '):
+            if not chunk:
+                continue
 
-            if len(chunk) > 1:
-                if len(chunk) > 2:
-                    # value can contain '=' which may confuse our parser
-                    chunk = [chunk[0], '='.join(chunk[1:])]
+            # value can contain '=' which may confuse our parser, so only
+            # split on the first one
+            key, sep, value = chunk.partition('=')
 
-                key, value = chunk
+            if sep:
                 parsed_data[key] = TS3Proto._unescape_str(value)
             else:
                 # TS3 Query Server may sometimes return a key without any value
                 # and we default its value to None
-                parsed_data[chunk[0]] = None
+                parsed_data[key] = None
 
         return parsed_data
 
@@ -243,8 +1069,12 @@ class TS3Proto():
         if isinstance(value, int):
             return str(value)
 
+        if ts3_escape_re.search(value) is None:
+            return value
+
         for i, j in ts3_escape:
-            value = value.replace(i, j)
+            if i in value:
+                value = value.replace(i, j)
 
         return value
 
@@ -261,7 +1091,805 @@ class TS3Proto():
         if isinstance(value, int):
             return str(value)
 
-        for i, j in ts3_escape:
-            value = value.replace(j, i)
+        if '\\' not in value:
+            return value
+
+        # Escaped backslashes are swapped for a placeholder first, otherwise an
+        # escaped backslash followed by "s" would be read back as a space
+        placeholder = None
+        if '\\\\' in value:
+            if '\0' in value:
+                return '\\'.join([TS3Proto._unescape_str(part) for part in value.split('\\\\')])
+            placeholder = '\0'
+            value = value.replace('\\\\', placeholder)
+
+        value = value.replace(r'\s', ' ')
+        if '\\' in value:
+            for i, j in ts3_unescape:
+                value = value.replace(i, j)
+
+        if placeholder:
+            value = value.replace(placeholder, '\\')
 
         return value
+
+
+class TS3RowStream():
+    """
+    Iterates over the rows of a reply as they arrive, parsing each one on
+    its own so large listings never have to be held in memory in full.
+
+    The connection is locked from the first row until the trailing "error"
+    line has been read, stopping early discards the remaining rows. While
+    the connection is multiplexed the reply is read in full before the first
+    row is returned. Once iteration has finished the error line is available
+    as C{response}::
+
+        stream = server.stream_command('clientdblist')
+        for row in stream:
+            ...
+        if not stream.is_successful:
+            ...
+    """
+
+    def __init__(self, proto, commandstr, priority=PRIORITY_INTERACTIVE, record=None):
+        self._proto = proto
+        self._commandstr = commandstr
+        self._priority = priority
+        self._record = record
+        self._parse = record.from_row if record is not None else proto.parse_row
+        self._started = False
+        self.response = None
+
+    @property
+    def is_successful(self):
+        return self.response is not None and self.response.get('msg') == 'ok'
+
+    def __iter__(self):
+        if self._started:
+            raise InvalidArguments('A TS3RowStream can only be iterated once')
+        self._started = True
+
+        proto = self._proto
+        mux = proto._mux
+        if mux is not None:
+            # The multiplexer holds io_lock, so its reader reads the reply
+            # in full instead
+            response = mux.execute(self._commandstr, self._priority)
+            self.response = response.response
+            rows = response.records(self._record) if self._record is not None else response.data
+            for row in rows:
+                yield row
+            return
+
+        if proto.rate_limiter is not None:
+            proto.rate_limiter.acquire(self._priority)
+
+        raw = self._commandstr.encode('utf-8') + b"\n\r"
+        read_row = proto._read_row
+        parse = self._parse
+        sample = None
+        if proto.instruments:
+            sample = CommandSample(self._commandstr.partition(' ')[0], bytes_out=len(raw))
+            read_row, parse = self._measured(sample, read_row, parse)
+            start = clock()
+
+        # Rows already handed out cannot be taken back, so a stream is never
+        # replayed after the connection is lost
+        generation = proto._generation
+        try:
+            with proto.io_lock:
+                if sample is not None:
+                    locked = clock()
+                    sample.lock_wait = locked - start
+                proto._transport.write(raw)
+                if sample is not None:
+                    written = clock()
+                    sample.write = written - locked
+                    proto._transport.has_data(proto._timeout)
+                    sample.ttfb = clock() - written
+
+                row = read_row(line_start=True)
+                try:
+                    while not row.startswith(b"error"):
+                        last = not row.endswith(b"|")
+                        data = row.rstrip(b"|\n\r")
+                        if data:
+                            yield parse(data.decode('utf-8'))
+                        row = read_row(line_start=last)
+                        if last:
+                            break
+                finally:
+                    # Drain whatever the caller did not consume so the next
+                    # command gets its own reply
+                    while row and not row.startswith(b"error"):
+                        row = read_row(line_start=row.endswith(b"\n\r"))
+                    self.response = proto.parse_response(row.decode('utf-8'))
+                    proto.last_command = time.time()
+        except (socket.error, EOFError):
+            proto._connection_lost(generation)
+            raise
+        finally:
+            if sample is not None and self.response is not None:
+                sample.error_id = self.response.get('id')
+                proto._record(sample)
+
+    @staticmethod
+    def _measured(sample, read_row, parse):
+        """
+        Wraps the row reader and parser to add their time, the bytes read
+        and the rows parsed to sample. Time spent by the caller between rows
+        is not counted.
+        """
+        def measured_read_row(line_start=False):
+            start = clock()
+            row = read_row(line_start=line_start)
+            sample.read += clock() - start
+            sample.bytes_in += len(row)
+            return row
+
+        def measured_parse(data):
+            start = clock()
+            row = parse(data)
+            sample.parse += clock() - start
+            sample.rows += 1
+            return row
+
+        return measured_read_row, measured_parse
+
+
+class TS3Pager():
+    """
+    Iterates over a listing command one page at a time using its "start" and
+    "duration" keys. While the caller works through a page the next one is
+    already being requested in the background, so at most two pages are held
+    in memory and a long walk is not slowed down by a round trip per page::
+
+        pager = server.paginate('clientdblist', page_size=500)
+        for row in pager:
+            ...
+        if not pager.is_successful:
+            ...
+
+    Servers cap the rows per page, so a short page does not mean the end of
+    the listing. Iteration stops after an empty page, or when the server
+    answers a page with "database empty result set", which is not treated as
+    an error. Any other error ends the iteration and is left in C{response}.
+    """
+
+    def __init__(self, proto, command, keys=None, opts=None, page_size=100, prefetch=True,
+                 priority=PRIORITY_BULK, record=None):
+        if page_size is not None and page_size < 1:
+            raise InvalidArguments('page_size must be at least 1')
+        self._proto = proto
+        self._command = command
+        self._keys = dict(keys or {})
+        self._opts = opts
+        self._page_size = page_size
+        self._prefetch = prefetch
+        self._priority = priority
+        self._record = record
+        self._started = False
+        self.response = None
+        self.pages = 0
+
+    @property
+    def is_successful(self):
+        return self.response is not None and (self.response.get('msg') == 'ok' or
+                                              self.response.get('id') == ERROR_EMPTY_RESULT)
+
+    def __iter__(self):
+        if self._started:
+            raise InvalidArguments('A TS3Pager can only be iterated once')
+        self._started = True
+
+        start = int(self._keys.get('start', 0))
+        page = self._fetch(start, False)
+        while page is not None:
+            response = page.result()
+            page = None
+            self.response = response.response
+            if not response.is_successful:
+                return
+            self.pages += 1
+
+            rows = response.data
+            start += len(rows)
+            more = self._page_size is not None and len(rows) > 0
+            if more and self._prefetch:
+                page = self._fetch(start, True)
+
+            if self._record is not None:
+                rows = response.records(self._record)
+            for row in rows:
+                yield row
+            del rows, response
+
+            if more and page is None:
+                page = self._fetch(start, False)
+
+    def _fetch(self, start, background):
+        """
+        Requests the page beginning at start and returns a Future for its
+        L{TS3Response}. In the background the request goes through the
+        normal command path, so it waits for the connection like any other.
+        """
+        keys = dict(self._keys)
+        if self._page_size is not None:
+            keys['start'] = start
+            keys['duration'] = self._page_size
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self._proto.send_command(self._command, keys=keys, opts=self._opts,
+                                                           priority=self._priority))
+            except Exception as e:
+                future.set_exception(e)
+
+        if background:
+            thread = Thread(target=run, name='ts3-pager')
+            thread.daemon = True
+            thread.start()
+        else:
+            run()
+        return future
+
+
+class PreparedCommand():
+    """
+    A command whose constant keys are escaped and encoded once, for sending
+    the same shape of command many times. Keys given a value of None are
+    slots, filled in on each call::
+
+        move = server.prepare('clientmove', keys={'cid': 405, 'clid': None})
+        for clid in clids:
+            move(clid=clid)
+
+    The command line is the same as L{TS3Proto.construct_command} builds
+    from the keys in the same order, including lists for nested parameters
+    whether they are constant or filled into a slot.
+    """
+
+    def __init__(self, proto, command, keys=None, opts=None):
+        """
+        @param proto: Connection to send the command on
+        @type proto: L{TS3Proto}
+        @param command: Command
+        @type command: string
+        @param keys: Key/Value pairs, None marks a slot
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        """
+        self._proto = proto
+        self.command = command
+        self._keys = keys or {}
+        # The constant text up to each slot with the slot's key and nested
+        # separator, then the text after the last slot
+        self._slots = []
+
+        literal = command
+        for key in self._keys:
+            value = self._keys[key]
+            if value is None:
+                self._slots.append((('%s %s=' % (literal, key)).encode('utf-8'), key, ('|%s=' % key).encode('utf-8')))
+                literal = ''
+            else:
+                literal = proto.construct_command(literal, keys={key: value})
+        literal = proto.construct_command(literal, opts=opts)
+        self._tail = literal.encode('utf-8') + b"\n\r"
+        self._names = frozenset(slot[1] for slot in self._slots)
+
+    def __repr__(self):
+        return '<PreparedCommand %r>' % b'{}'.join([slot[0] for slot in self._slots] + [self._tail.rstrip()])
+
+    def render(self, **values):
+        """
+        Returns the encoded command line, ending in the line terminator,
+        with the slots filled in
+        """
+        if values.keys() != self._names:
+            missing = ', '.join(sorted(self._names.difference(values)))
+            extra = ', '.join(sorted(set(values).difference(self._names)))
+            raise InvalidArguments('%s expects values for its slots (missing: %s, unknown: %s)'
+                                   % (self.command, missing or '-', extra or '-'))
+
+        parts = []
+        append = parts.append
+        for chunk, key, separator in self._slots:
+            append(chunk)
+            value = values[key]
+            if type(value) is int:
+                append(b'%d' % value)
+            elif isinstance(value, list):
+                encode = self._encode
+                append(separator.join([b'%d' % nest if type(nest) is int else encode(nest) for nest in value]))
+            else:
+                append(self._encode(value))
+        append(self._tail)
+        return b"".join(parts)
+
+    @staticmethod
+    def _encode(value):
+        if type(value) is int:
+            return b'%d' % value
+        return TS3Proto._escape_str(value).encode('utf-8')
+
+    def keys(self, **values):
+        """
+        Returns the keys the command is sent with for the given slot values
+        """
+        keys = dict(self._keys)
+        keys.update(values)
+        return keys
+
+    def send(self, priority=PRIORITY_INTERACTIVE, **values):
+        """
+        Fills in the slots and sends the command, see L{TS3Proto.send_command}
+
+        @param priority: Rate limiter priority
+        @type priority: int
+        """
+        proto = self._proto
+        proto.check_connection()
+        raw = self.render(**values)
+        keys = self.keys(**values) if self.command in session_commands else None
+        return proto._send(self.command, keys, raw[:-2].decode('utf-8'), priority, raw=raw)
+
+    __call__ = send
+
+
+class TS3Pipeline():
+    """
+    Queues commands and writes them to the connection back to back, matching
+    each "error" line to its command in the order the commands were sent.
+
+    Usable as a context manager, in which case the queue is executed on exit::
+
+        with server.pipeline() as pipe:
+            futures = [pipe.send_command('clientpoke', keys={'clid': clid, 'msg': 'Hi'}) for clid in clids]
+        responses = [f.result() for f in futures]
+    """
+
+    def __init__(self, proto, window=32, priority=PRIORITY_BULK):
+        """
+        @param proto: Connection to send the commands on
+        @type proto: L{TS3Proto}
+        @param window: Maximum number of commands awaiting a reply
+        @type window: int
+        @param priority: Rate limiter priority
+        @type priority: int
+        """
+        if window < 1:
+            raise InvalidArguments('window must be at least 1')
+
+        self._proto = proto
+        self._window = window
+        self._priority = priority
+        self._queue = []
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            for item in self._queue:
+                item[1].cancel()
+            self._queue = []
+
+    def send_command(self, command, keys=None, opts=None, callback=None):
+        """
+        Queues a command, returning a Future resolving to its L{TS3Response}
+
+        @param command: Command
+        @type command: string
+        @param keys: Key/Value pairs
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        @param callback: Called with the L{TS3Response} once it arrives
+        @type callback: callable
+        """
+        commandstr = self._proto.construct_command(command, keys=keys, opts=opts)
+        self._proto.logger.debug("pipeline send_command - %s" % commandstr)
+
+        if self._proto.cache is not None:
+            self._proto.cache.observe(self._proto._sid, command)
+
+        future = Future()
+        if callback:
+            future.add_done_callback(lambda f: f.exception() is None and callback(f.result()))
+
+        self._queue.append((commandstr.encode('utf-8') + b"\n\r", future, command, keys, 0, 0))
+        return future
+
+    def send_prepared(self, prepared, callback=None, **values):
+        """
+        Queues a L{PreparedCommand} with its slots filled in, returning a
+        Future resolving to its L{TS3Response}
+
+        @param prepared: Command from L{TS3Proto.prepare}
+        @type prepared: L{PreparedCommand}
+        @param callback: Called with the L{TS3Response} once it arrives
+        @type callback: callable
+        """
+        raw = prepared.render(**values)
+        command = prepared.command
+        if self._proto.cache is not None:
+            self._proto.cache.observe(self._proto._sid, command)
+
+        future = Future()
+        if callback:
+            future.add_done_callback(lambda f: f.exception() is None and callback(f.result()))
+
+        keys = prepared.keys(**values) if command in session_commands else None
+        self._queue.append((raw, future, command, keys, 0, 0))
+        return future
+
+    def execute(self):
+        """
+        Writes all queued commands and collects their replies, keeping at
+        most C{window} commands in flight. Returns the list of responses in
+        the order the commands were queued.
+
+        With a rate limiter, commands are only written while tokens are to
+        be had straight away. Otherwise the connection is let go once the
+        replies in flight are read, and the pipeline waits for a token at its
+        priority like any other caller. Commands rejected for flooding are
+        sent again after the backoff and may complete after commands queued
+        behind them.
+        """
+        proto = self._proto
+        proto.check_connection()
+
+        queue, self._queue = deque(self._queue), []
+        futures = [item[1] for item in queue]
+
+        mux = proto._mux
+        if mux is not None:
+            self._submit(mux, queue)
+
+        inflight = deque()
+        limiter = proto.rate_limiter
+
+        # With instruments each command's write time is that of the batch it
+        # was written in, credited to the first command of the batch
+        measure = bool(proto.instruments)
+        samples = []
+        writes = {}
+        # Set once a token was waited for outside of io_lock
+        token = False
+
+        while queue or inflight:
+            generation = proto._generation
+            if measure:
+                lock_wait = clock()
+            try:
+                with proto.io_lock:
+                    if measure:
+                        lock_wait = clock() - lock_wait
+                    while queue or inflight:
+                        batch = []
+                        while queue and len(inflight) < self._window:
+                            if limiter is not None and not token and not limiter.try_acquire():
+                                break
+                            token = False
+                            item = queue.popleft()
+                            batch.append(item[0])
+                            inflight.append(item)
+                        if batch:
+                            if measure:
+                                start = clock()
+                                proto._transport.write(b"".join(batch))
+                                writes[id(inflight[-len(batch)])] = clock() - start
+                            else:
+                                proto._transport.write(b"".join(batch))
+                        if not inflight:
+                            # Out of tokens, wait for one without holding
+                            # up other callers
+                            break
+
+                        if measure:
+                            start = clock()
+                            proto._transport.has_data(proto._timeout)
+                            first = clock()
+                        response, data = proto._read_response()
+                        item = inflight.popleft()
+                        commandstr, future, command, keys, attempt, replays = item
+                        if measure:
+                            done = clock()
+                            bytes_in = len(response) + len(data)
+                        response = TS3Response(response, data)
+                        if measure:
+                            samples.append(CommandSample(
+                                command, lock_wait=lock_wait, write=writes.pop(id(item), 0.0),
+                                ttfb=first - start, read=done - first, parse=clock() - done,
+                                bytes_out=len(commandstr), bytes_in=bytes_in, rows=count_rows(data),
+                                error_id=response.response.get('id'), attempt=attempt))
+                            lock_wait = 0.0
+                        if limiter is not None and limiter.should_retry(response, attempt):
+                            queue.appendleft((commandstr, future, command, keys, attempt + 1, replays))
+                            continue
+                        proto._command_done(command, keys, response)
+                        future.set_result(response)
+            except (socket.error, EOFError) as e:
+                proto._connection_lost(generation)
+                try:
+                    self._replay(inflight, queue, e)
+                except Exception as e:
+                    self._fail(inflight, queue, e)
+                    raise
+            except Exception as e:
+                self._fail(inflight, queue, e)
+                raise
+
+            if queue and not inflight and limiter is not None:
+                try:
+                    limiter.acquire(self._priority)
+                except BaseException as e:
+                    self._fail(inflight, queue, e)
+                    raise
+                token = True
+
+        for sample in samples:
+            proto._record(sample)
+
+        return [future.result() for future in futures]
+
+    def _submit(self, mux, queue):
+        """
+        Hands the queued commands to a running L{TS3Multiplexer}, which holds
+        io_lock and already keeps commands back to back. Commands left once
+        it has stopped stay queued to be sent the usual way.
+        """
+        while queue:
+            raw, future, command, keys = queue[0][:4]
+            try:
+                mux._submit(raw, future, command, keys, self._priority)
+            except NoConnectionError:
+                mux._released.wait()
+                return
+            queue.popleft()
+
+    def _replay(self, inflight, queue, error):
+        """
+        Requeues the in-flight commands which may be sent again after the
+        connection was lost and reconnects, failing the others with error.
+        Raises error itself without a reconnect policy.
+        """
+        proto = self._proto
+        policy = proto.reconnect_policy
+        if policy is None or proto._address is None:
+            raise error
+
+        replay = []
+        for item in inflight:
+            if policy.can_replay(item[2], item[5]):
+                replay.append(item[:5] + (item[5] + 1,))
+                policy.record('replays')
+            else:
+                item[1].set_exception(error)
+        inflight.clear()
+        queue.extendleft(reversed(replay))
+        proto._reconnect()
+
+    @staticmethod
+    def _fail(inflight, queue, error):
+        for item in list(inflight) + list(queue):
+            if not item[1].done():
+                item[1].set_exception(error)
+
+
+class TS3Multiplexer():
+    """
+    Shares one connection between any number of threads. Commands are
+    written as soon as they are submitted, while a reader thread matches the
+    replies to them in order, so the connection stays busy instead of
+    carrying one command at a time::
+
+        with server.multiplex():
+            executor.map(lambda clid: server.clientpoke(clid, 'Hi'), clids)
+
+    While it runs, L{TS3Proto.send_command}, pipelines, streams and the
+    helpers built on them go through the multiplexer. It holds io_lock for
+    its lifetime, so keepalives are skipped until it is stopped, and its
+    reader dispatches notifications in place of the event listener.
+    Instruments only get the time from the write to the reply, as read.
+
+    If the connection fails, pending commands fail with the error and the
+    multiplexer stops, leaving reconnecting to the connection.
+    """
+
+    def __init__(self, proto, window=64):
+        """
+        @param proto: Connection to share
+        @type proto: L{TS3Proto}
+        @param window: Maximum number of commands awaiting a reply
+        @type window: int
+        """
+        if window < 1:
+            raise InvalidArguments('window must be at least 1')
+
+        self._proto = proto
+        self._window = BoundedSemaphore(window)
+        self._write_lock = RLock()
+        self._pending = deque()
+        self._running = False
+        self._detached = True
+        self._released = Event()
+        self._reader = None
+        self._restart_listener = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        proto = self._proto
+        proto.check_connection()
+        if proto._mux is not None:
+            raise InvalidArguments('The connection is already multiplexed')
+
+        if proto._listener is not None:
+            self._restart_listener = proto._listen_interval
+            proto.stop_event_listener()
+
+        proto.io_lock.acquire()
+        self._running = True
+        self._detached = False
+        self._released.clear()
+        proto._mux = self
+        self._reader = Thread(target=self._run, name='ts3-multiplexer')
+        self._reader.daemon = True
+        self._reader.start()
+        return self
+
+    def stop(self):
+        """
+        Stops accepting commands, waits for the replies still pending and
+        hands the connection back
+        """
+        with self._write_lock:
+            self._running = False
+        reader = self._reader
+        if reader is not None:
+            reader.join()
+        self._detach()
+
+        proto = self._proto
+        if self._restart_listener is not None and proto.is_connected():
+            proto.start_event_listener(self._restart_listener)
+
+    def submit(self, command, keys=None, opts=None, priority=PRIORITY_INTERACTIVE):
+        """
+        Sends a command, returning a Future resolving to its L{TS3Response}
+
+        @param command: Command
+        @type command: string
+        @param keys: Key/Value pairs
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        @param priority: Rate limiter priority
+        @type priority: int
+        """
+        proto = self._proto
+        commandstr = proto.construct_command(command, keys=keys, opts=opts)
+        if proto.cache is not None:
+            proto.cache.observe(proto._sid, command)
+        return self._submit(commandstr.encode('utf-8') + b"\n\r", Future(), command, keys, priority)
+
+    def execute(self, commandstr, priority=PRIORITY_INTERACTIVE, raw=None):
+        """
+        Sends a constructed command and waits for its reply, used by
+        L{TS3Proto.send_command} while multiplexed
+        """
+        if raw is None:
+            raw = commandstr.encode('utf-8') + b"\n\r"
+        try:
+            future = self._submit(raw, Future(), None, None, priority)
+        except NoConnectionError:
+            # Stopped meanwhile, send it the usual way once we let go
+            self._released.wait()
+            return self._proto._execute(commandstr, priority, raw=raw)
+        return future.result()
+
+    def _submit(self, raw, future, command, keys, priority, attempt=0):
+        limiter = self._proto.rate_limiter
+        if limiter is not None:
+            limiter.acquire(priority)
+
+        self._window.acquire()
+        with self._write_lock:
+            if not self._running:
+                self._window.release()
+                raise NoConnectionError
+            # Appending and writing under one lock keeps the pending queue in
+            # the order the server sees the commands
+            sent = clock() if self._proto.instruments else 0
+            self._pending.append((raw, future, command, keys, priority, attempt, sent))
+            try:
+                self._proto._transport.write(raw)
+            except (socket.error, EOFError) as e:
+                self._fail(e)
+        return future
+
+    def _run(self):
+        proto = self._proto
+        transport = proto._transport
+        data = b''
+        try:
+            while self._running or self._pending:
+                if not transport.has_data(0.2):
+                    continue
+                line = transport.read_until(b"\n\r", proto._timeout)
+                if line.startswith(b"notify"):
+                    proto._dispatch_event(line)
+                elif not line.startswith(b"error"):
+                    data = line
+                else:
+                    self._complete(line, data)
+                    data = b''
+        except (socket.error, EOFError, ValueError) as e:
+            proto._connection_lost(proto._generation)
+            self._fail(e)
+
+    def _complete(self, line, data):
+        proto = self._proto
+        try:
+            raw, future, command, keys, priority, attempt, sent = self._pending.popleft()
+        except IndexError:
+            # Already failed by a writer
+            return
+        self._window.release()
+
+        response = TS3Response(line, data)
+        if sent:
+            proto._record(CommandSample(
+                command or raw.partition(b' ')[0].strip().decode('utf-8'), read=clock() - sent,
+                bytes_out=len(raw), bytes_in=len(line) + len(data), rows=count_rows(data),
+                error_id=response.response.get('id'), attempt=attempt))
+        limiter = proto.rate_limiter
+        if limiter is not None and limiter.should_retry(response, attempt):
+            # Waiting for the backoff here would hold up every other reply
+            Thread(target=self._retry, args=(raw, future, command, keys, priority, attempt + 1)).start()
+            return
+
+        if command is not None:
+            proto._command_done(command, keys, response)
+        future.set_result(response)
+
+    def _retry(self, raw, future, command, keys, priority, attempt):
+        try:
+            self._submit(raw, future, command, keys, priority, attempt)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    def _fail(self, error):
+        with self._write_lock:
+            self._running = False
+            pending, self._pending = self._pending, deque()
+        for item in pending:
+            self._window.release()
+            if not item[1].done():
+                item[1].set_exception(error)
+        self._detach()
+
+    def _detach(self):
+        with self._write_lock:
+            if self._detached:
+                return
+            self._detached = True
+            proto = self._proto
+            proto._mux = None
+            proto.io_lock.release()
+            self._released.set()
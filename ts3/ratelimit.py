@@ -0,0 +1,183 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import heapq
+import itertools
+import logging
+import re
+import time
+from threading import Condition
+
+# Scheduling priorities, lower is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Error returned by the server when the query client exceeds its flood limit
+ERROR_FLOODING = '524'
+
+flood_wait_re = re.compile(r'(\d+)\s*second')
+
+
+class RateLimiter():
+    """
+    Token bucket keeping a connection below the server's ServerQuery flood
+    limit, set by serverinstance_serverquery_flood_commands and
+    serverinstance_serverquery_flood_time.
+
+    Callers waiting for a token are served by priority, so interactive
+    commands overtake queued bulk work. When the server still reports
+    flooding, all callers are held back for the wait it asks for (or an
+    exponential backoff) and the command is retried.
+    """
+
+    def __init__(self, commands=10, period=3.0, max_retries=3, backoff=1.0):
+        """
+        @param commands: Commands allowed per period
+        @type commands: int
+        @param period: Period in seconds
+        @type period: float
+        @param max_retries: Retries of a command rejected for flooding
+        @type max_retries: int
+        @param backoff: Initial backoff in seconds, doubled on each retry
+        @type backoff: float
+        """
+        if commands < 1 or period <= 0:
+            raise ValueError('commands must be at least 1 and period positive')
+
+        self.capacity = commands
+        self.rate = commands / float(period)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._tokens = float(commands)
+        self._updated = time.time()
+        self._blocked_until = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._stats = {'granted': 0, 'wait_total': 0.0, 'flood_errors': 0, 'retries': 0}
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE):
+        """
+        Blocks until the caller may send a command
+
+        @param priority: L{PRIORITY_INTERACTIVE} or L{PRIORITY_BULK}
+        @type priority: int
+        """
+        start = time.time()
+        entry = (priority, next(self._seq))
+
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    wait = None
+                    if self._waiters[0] == entry:
+                        wait = self._reserve()
+                        if wait <= 0:
+                            heapq.heappop(self._waiters)
+                            break
+                    # Only the first waiter sleeps on the clock, the others
+                    # wait for it to be served
+                    self._cond.wait(wait)
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                raise
+            finally:
+                self._cond.notify_all()
+
+            self._stats['granted'] += 1
+            self._stats['wait_total'] += time.time() - start
+
+    def try_acquire(self):
+        """
+        Takes a token only if one is available right away and nobody is
+        waiting for one, for background commands which are better skipped
+        than delayed. Returns whether a token was taken.
+        """
+        with self._cond:
+            if self._waiters or self._reserve() > 0:
+                return False
+            self._stats['granted'] += 1
+        return True
+
+    def should_retry(self, response, attempt):
+        """
+        Checks a reply for a flood error. If the command should be retried
+        the backoff is applied to every caller and True is returned.
+
+        @param response: Reply to the command
+        @type response: L{TS3Response}
+        @param attempt: Number of retries made so far
+        @type attempt: int
+        """
+        if response.response.get('id') != ERROR_FLOODING:
+            return False
+
+        match = flood_wait_re.search(response.response.get('extra_msg') or '')
+        wait = float(match.group(1)) if match else self.backoff * 2 ** attempt
+
+        with self._cond:
+            self._stats['flood_errors'] += 1
+            self._tokens = 0.0
+            self._updated = time.time()
+            self._blocked_until = max(self._blocked_until, time.time() + wait)
+            if attempt < self.max_retries:
+                self._stats['retries'] += 1
+            self._cond.notify_all()
+
+        self.logger.debug("should_retry - flooding, holding commands back for %.1fs" % wait)
+        return attempt < self.max_retries
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['waiting'] = len(self._waiters)
+        return stats
+
+    def _reserve(self):
+        """
+        Takes a token, returning 0, or returns the seconds until one is due
+        """
+        now = time.time()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
@@ -0,0 +1,121 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+from threading import Lock
+
+# Commands which can safely be sent again when the connection dropped before
+# their reply arrived, either because they only read state or because
+# repeating them leaves the server in the same state
+idempotent_commands = frozenset([
+    'whoami', 'version', 'help', 'hostinfo', 'instanceinfo', 'serverlist', 'serverinfo',
+    'serveridgetbyport', 'serverrequestconnectioninfo', 'channellist', 'channelinfo',
+    'channelfind', 'channelgrouplist', 'channelgroupclientlist', 'servergrouplist',
+    'servergroupclientlist', 'servergroupsbyclientid', 'clientlist', 'clientinfo', 'clientfind',
+    'clientdblist', 'clientdbinfo', 'clientdbfind', 'clientgetids', 'clientgetdbidfromuid',
+    'clientgetnamefromuid', 'clientgetnamefromdbid', 'clientgetuidfromclid', 'banlist',
+    'complainlist', 'logview', 'ftlist', 'permissionlist', 'permidgetbyname', 'permfind',
+    'permoverview', 'servergrouppermlist', 'channelgrouppermlist', 'channelpermlist',
+    'clientpermlist', 'channelclientpermlist', 'login', 'use', 'clientupdate',
+    'servernotifyregister',
+])
+
+
+class ReconnectPolicy():
+    """
+    Controls how a connection recovers after it was lost, see
+    L{TS3Proto.enable_reconnect}.
+
+    The first reconnect attempt is made straight away, later ones back off
+    exponentially. Commands whose reply was lost with the connection are
+    sent again after the session has been restored if they are listed in
+    C{idempotent}, others raise the connection error to the caller.
+    """
+
+    def __init__(self, max_attempts=None, backoff=0.05, max_backoff=5.0, max_replays=2, idempotent=None):
+        """
+        @param max_attempts: Reconnect attempts before giving up, None
+            retries forever
+        @type max_attempts: int
+        @param backoff: Delay before the second attempt in seconds, doubled
+            on each further attempt
+        @type backoff: float
+        @param max_backoff: Upper bound of the delay in seconds
+        @type max_backoff: float
+        @param max_replays: Times a single command is sent again
+        @type max_replays: int
+        @param idempotent: Command names safe to replay, defaults to
+            L{idempotent_commands}
+        @type idempotent: iterable
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_replays = max_replays
+        self.idempotent = frozenset(idempotent_commands if idempotent is None else idempotent)
+        self._lock = Lock()
+        self._stats = {'disconnects': 0, 'reconnects': 0, 'failed_attempts': 0, 'replays': 0, 'downtime': 0.0}
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def delay(self, attempt):
+        """
+        Returns the seconds to wait before the given reconnect attempt,
+        counting from 0, or None once attempts are exhausted
+        """
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            return None
+        if attempt == 0:
+            return 0
+        return min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+
+    def can_replay(self, command, replays):
+        """
+        Returns True when a command which lost its reply may be sent again
+
+        @param command: Command name
+        @type command: str
+        @param replays: Times it has been replayed already
+        @type replays: int
+        """
+        return command in self.idempotent and replays < self.max_replays
+
+    def record(self, counter, value=1):
+        with self._lock:
+            self._stats[counter] += value
+
+    def stats(self):
+        """
+        Returns the number of lost connections, successful and failed
+        reconnect attempts, replayed commands and total seconds spent
+        reconnecting
+        """
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,210 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compact typed rows for the common listings.
+
+Records keep only their schema fields as attributes, converted once when
+the row is parsed. Any other field stays in the raw row text and is only
+unescaped on first access through C{record[key]} or C{record.get(key)}.
+"""
+
+from .protocol import TS3Proto
+
+
+class Record():
+    """
+    Base class for typed rows, see L{record_type}
+    """
+
+    __slots__ = ('_row', '_extra')
+
+    # (name, converter) pairs, set by record_type
+    fields = ()
+    _converters = {}
+
+    def __init__(self, **values):
+        for name, converter in self.fields:
+            setattr(self, name, values.get(name))
+        self._row = None
+        self._extra = None
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds a record from the raw, still escaped, text of a row
+
+        @param row: row string
+        @type row: string
+        """
+        record = cls.__new__(cls)
+        record._row = row
+        record._extra = None
+        converters = cls._converters
+
+        for name, converter in cls.fields:
+            setattr(record, name, None)
+
+        for chunk in row.split(' '):
+            key, sep, value = chunk.partition('=')
+            converter = converters.get(key)
+            if converter is not None and sep:
+                setattr(record, key, converter(value))
+
+        return record
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Builds a record from a row parsed by L{TS3Proto.parse_data}
+
+        @param data: parsed row
+        @type data: dict
+        """
+        record = cls.__new__(cls)
+        record._row = None
+        record._extra = data
+
+        for name, converter in cls.fields:
+            value = data.get(name)
+            if value is not None and converter is not _unescaped:
+                value = converter(value)
+            setattr(record, name, value)
+
+        return record
+
+    def __getitem__(self, key):
+        if key in self._converters:
+            return getattr(self, key)
+        if self._extra is None:
+            self._extra = TS3Proto.parse_row(self._row) if self._row else {}
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        """
+        Returns all fields as a dict, with the schema fields converted
+        """
+        data = dict(self._extra if self._extra is not None else TS3Proto.parse_row(self._row or ''))
+        for name, converter in self.fields:
+            data[name] = getattr(self, name)
+        return data
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, n) == getattr(other, n) for n, c in self.fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # Over the same fields as __eq__, changing them changes the hash
+        return hash((type(self),) + tuple(getattr(self, n) for n, c in self.fields))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (n, getattr(self, n)) for n, c in self.fields))
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _unescaped(value):
+    return TS3Proto._unescape_str(value)
+
+
+def record_type(name, fields):
+    """
+    Creates a L{Record} subclass with a slot per field
+
+    @param name: Class name
+    @type name: str
+    @param fields: (field, type) pairs where type is int or str
+    @type fields: list
+    """
+    converters = dict((field, _int if kind is int else _unescaped) for field, kind in fields)
+    return type(name, (Record,), {
+        '__slots__': tuple(field for field, kind in fields),
+        'fields': tuple((field, converters[field]) for field, kind in fields),
+        '_converters': converters,
+    })
+
+
+ClientRecord = record_type('ClientRecord', [
+    ('clid', int),
+    ('cid', int),
+    ('client_database_id', int),
+    ('client_nickname', str),
+    ('client_type', int),
+])
+
+ChannelRecord = record_type('ChannelRecord', [
+    ('cid', int),
+    ('pid', int),
+    ('channel_order', int),
+    ('channel_name', str),
+    ('total_clients', int),
+    ('channel_needed_subscribe_power', int),
+])
+
+ServerRecord = record_type('ServerRecord', [
+    ('virtualserver_id', int),
+    ('virtualserver_port', int),
+    ('virtualserver_status', str),
+    ('virtualserver_clientsonline', int),
+    ('virtualserver_queryclientsonline', int),
+    ('virtualserver_maxclients', int),
+    ('virtualserver_uptime', int),
+    ('virtualserver_name', str),
+    ('virtualserver_autostart', int),
+])
+
+ClientDBRecord = record_type('ClientDBRecord', [
+    ('cldbid', int),
+    ('client_unique_identifier', str),
+    ('client_nickname', str),
+    ('client_created', int),
+    ('client_lastconnected', int),
+    ('client_totalconnections', int),
+    ('client_description', str),
+    ('client_lastip', str),
+])
+
+# Record type for each listing command
+listing_records = {
+    'clientlist': ClientRecord,
+    'channellist': ChannelRecord,
+    'serverlist': ServerRecord,
+    'clientdblist': ClientDBRecord,
+}
@@ -26,12 +26,34 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import logging
+import os
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 from .protocol import TS3Proto, InvalidArguments
+from .filetransfer import FileTransfer, file_size, next_clientftfid
+from .ratelimit import PRIORITY_BULK
+from .records import ClientRecord, ClientDBRecord, listing_records
+from .transport import SocketTransport
 from .defines import *
 
 
 class TS3Server(TS3Proto):
-    def __init__(self, ip=None, port=10011, id=0):
+
+    # Longest command line the server accepts, used to pack batch commands
+    max_command_length = 8192
+
+    # Error ids of batch commands meaning the target is already in the state
+    # the command puts it in, only trusted when retrying the targets of a
+    # packed command which partly applied
+    batch_applied_errors = {
+        'clientkick': ('512',),             # invalid clientID, already gone
+        'clientmove': ('770',),             # already member of channel
+        'servergroupaddclient': ('2561',),  # duplicate entry
+    }
+
+    def __init__(self, ip=None, port=10011, id=0, transport=SocketTransport):
         """
         Abstraction class for TS3 Servers
 
@@ -39,10 +61,13 @@ class TS3Server(TS3Proto):
         @type ip: str
         @param port: Port Number
         @type port: int
+        @param transport: Transport class, see L{ts3.transport}
+        @type transport: class
 
         """
-        TS3Proto.__init__(self)
+        TS3Proto.__init__(self, transport=transport)
         self._logger = logging.getLogger(__name__)
+        self.mirror = None
         if ip and port:
             if self.connect(ip, port) and id > 0:
                 self.use(id)
@@ -51,6 +76,12 @@ class TS3Server(TS3Proto):
     def logger(self):
         return self._logger
 
+    def _session_restored(self):
+        # Notifications sent while disconnected are lost, so the mirror has
+        # to be brought up to date from the server
+        if self.mirror is not None:
+            self.mirror.refresh()
+
     def login(self, username, password):
         """
         Login to the TS3 Server
@@ -64,6 +95,21 @@ class TS3Server(TS3Proto):
         response = self.send_command('login', keys={'client_login_name': username, 'client_login_password': password})
         return response.is_successful
 
+    def enable_rate_limit_from_instance(self, **kwargs):
+        """
+        Enables the rate limiter using the flood settings reported by
+        "instanceinfo", falling back to the server defaults when they cannot
+        be read. Keyword arguments are passed to L{enable_rate_limit}.
+        """
+        response = self.send_command('instanceinfo')
+        if response.is_successful and response.data:
+            info = response.data[0]
+            kwargs.setdefault('commands', int(info.get('serverinstance_serverquery_flood_commands') or 10))
+            kwargs.setdefault('period', float(info.get('serverinstance_serverquery_flood_time') or 3))
+        else:
+            self.logger.debug("enable_rate_limit_from_instance - unable to read the flood settings")
+        return self.enable_rate_limit(**kwargs)
+
     def serverlist(self):
         """
         Get a list of all Virtual Servers on the connected TS3 instance
@@ -90,11 +136,49 @@ class TS3Server(TS3Proto):
         response = self.send_command('use', keys={'sid': id})
         return response.is_successful
 
-    def clientlist(self):
+    def servernotifyregister(self, event, id=None):
+        """
+        Register for notifications, which are passed to the handlers added
+        with L{on}
+
+        @param event: One of server, channel, textserver, textchannel or
+            textprivate
+        @type event: str
+        @param id: Channel ID, required for the channel event
+        @type id: int
+        """
+        keys = {'event': event}
+        if id is not None:
+            keys['id'] = id
+        elif event == 'channel':
+            raise InvalidArguments('The channel event requires a channel id')
+
+        response = self.send_command('servernotifyregister', keys=keys)
+        return response.is_successful
+
+    def servernotifyunregister(self):
+        """
+        Unregister from all notifications
+        """
+        response = self.send_command('servernotifyunregister')
+        return response.is_successful
+
+    def clientlist(self, records=False):
         """
         Returns a clientlist of the current connected server/vhost
+
+        @param records: Return L{ClientRecord}s keyed by integer clid
+        @type records: bool
         """
 
+        if records:
+            stream = self.stream_command('clientlist', record=ClientRecord)
+            clientlist = dict((client.clid, client) for client in stream)
+            if stream.is_successful:
+                return clientlist
+            self.logger.debug("clientlist - error retrieving client list")
+            return {}
+
         response = self.send_command('clientlist')
 
         if response.is_successful:
@@ -107,20 +191,93 @@ class TS3Server(TS3Proto):
             self.logger.debug("clientlist - error retrieving client list")
             return {}
 
+    def list_records(self, command, record=None, keys=None, opts=None):
+        """
+        Runs a listing command and returns its rows as typed records, parsed
+        as they arrive. Returns an empty list if the command fails.
+
+        @param command: Listing command such as "channellist"
+        @type command: str
+        @param record: Record type, defaults to the one for the command
+        @type record: class
+        @param keys: Key/Value pairs
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        """
+        if record is None:
+            if command not in listing_records:
+                raise InvalidArguments('No record type known for %s' % command)
+            record = listing_records[command]
+
+        stream = self.stream_command(command, keys=keys, opts=opts, record=record)
+        rows = list(stream)
+        if not stream.is_successful:
+            self.logger.debug("list_records - error retrieving %s" % command)
+            return []
+        return rows
+
+    def iter_clientdblist(self, page_size=500, prefetch=True, records=False):
+        """
+        Walks the client database page by page, see L{TS3Pager}
+
+        @param page_size: Clients per request
+        @type page_size: int
+        @param prefetch: Request the next page while the current one is used
+        @type prefetch: bool
+        @param records: Yield L{ClientDBRecord}s instead of rows
+        @type records: bool
+        """
+        return self.paginate('clientdblist', page_size=page_size, prefetch=prefetch,
+                             record=ClientDBRecord if records else None)
+
+    def iter_banlist(self, page_size=500, prefetch=True):
+        """
+        Walks the ban list page by page, see L{TS3Pager}
+
+        @param page_size: Bans per request
+        @type page_size: int
+        @param prefetch: Request the next page while the current one is used
+        @type prefetch: bool
+        """
+        return self.paginate('banlist', page_size=page_size, prefetch=prefetch)
+
+    def iter_complainlist(self, tcldbid=None):
+        """
+        Iterates over the complaints, optionally only those about one client.
+        "complainlist" takes no "start" or "duration" so it is fetched in a
+        single request, but behaves like the other pagers.
+
+        @param tcldbid: Client database ID the complaints are about
+        @type tcldbid: int
+        """
+        keys = {}
+        if tcldbid is not None:
+            keys['tcldbid'] = tcldbid
+        return self.paginate('complainlist', keys=keys, page_size=None)
+
     def clientkick(self, clid=None, cldbid=None, type=REASON_KICK_SERVER, message=None):
         """
-        Kicks a user identified by either clid or cldbid
+        Kicks a user identified by either clid or cldbid. The cldbid is
+        resolved through the attached L{ServerStateMirror} when there is one.
         """
 
         client = None
         if cldbid:
-            clientlist = self.send_command('clientlist')
-            for cl in clientlist.values():
-                if int(cl['client_database_id']) == cldbid:
-                    client = cl['clid']
-                    self.logger.debug("clientkick - identified user from clid (%s = %s)" % (cldbid, client))
-                    break
-            
+            if self.mirror is not None:
+                clients = self.mirror.clients_by_cldbid(cldbid)
+                if clients:
+                    client = clients[0]['clid']
+            else:
+                clientlist = self.clientlist()
+                for cl in clientlist.values():
+                    if int(cl['client_database_id']) == cldbid:
+                        client = cl['clid']
+                        break
+
+            if client:
+                self.logger.debug("clientkick - identified user from clid (%s = %s)" % (cldbid, client))
+
             if not client:
                 # TODO: we should throw an exception here actually
                 self.logger.debug("clientkick - no client with specified cldbid (%s) was found" % cldbid)
@@ -150,3 +307,250 @@ class TS3Server(TS3Proto):
 
         response = self.send_command('clientpoke', keys={'clid': clid, 'msg': message})
         return response.is_successful
+
+    def send_batch(self, command, target_key, targets, keys=None, opts=None):
+        """
+        Sends a command for many targets, packing them into as few piped
+        multi-target commands (key=1|key=2) as max_command_length allows.
+
+        Returns a dict of target to success. When a packed command fails
+        its targets are retried one by one to tell which ones failed. The
+        server may have processed some targets before the failure, so in
+        these retries the errors in L{batch_applied_errors}, such as
+        "already member of channel", count as success. A retried kick
+        failing with "invalid clientID" cannot be told apart from a client
+        the packed command kicked. Elsewhere these errors are failures.
+
+        @param command: Command
+        @type command: string
+        @param target_key: Key taking the targets, such as "clid"
+        @type target_key: string
+        @param targets: Target values
+        @type targets: list
+        @param keys: Key/Value pairs shared by all targets
+        @type keys: dict
+        @param opts: Options
+        @type opts: list
+        """
+        results = {}
+        keys = dict(keys or {})
+        applied = self.batch_applied_errors.get(command, ())
+
+        def is_applied(response):
+            return response.is_successful or response.response['id'] in applied
+
+        for chunk in self._pack_targets(command, target_key, targets, keys, opts):
+            # Targets go first, as in the manual's "clid=1|clid=2 cid=3"
+            batch_keys = OrderedDict([(target_key, chunk)])
+            batch_keys.update(keys)
+            response = self.send_command(command, keys=batch_keys, opts=opts, priority=PRIORITY_BULK)
+
+            if response.is_successful or len(chunk) == 1:
+                for target in chunk:
+                    results[target] = response.is_successful
+                continue
+
+            self.logger.debug("send_batch - %s failed for %d targets, retrying individually" % (command, len(chunk)))
+            with self.pipeline() as pipe:
+                futures = []
+                for target in chunk:
+                    single_keys = dict(keys)
+                    single_keys[target_key] = target
+                    futures.append((target, pipe.send_command(command, keys=single_keys, opts=opts)))
+            for target, future in futures:
+                results[target] = is_applied(future.result())
+
+        return results
+
+    def _pack_targets(self, command, target_key, targets, keys, opts):
+        """
+        Splits targets into chunks whose commands fit max_command_length
+        """
+        # The base command plus the separating space and the line ending
+        base = len(self.construct_command(command, keys=keys, opts=opts).encode('utf-8')) + 3
+        chunk, size = [], base
+
+        for target in targets:
+            # Each target adds "key=value" and a "|" or space
+            part = len(("%s=%s" % (target_key, self._escape_str(target))).encode('utf-8')) + 1
+            if chunk and size + part > self.max_command_length:
+                yield chunk
+                chunk, size = [], base
+            chunk.append(target)
+            size += part
+
+        if chunk:
+            yield chunk
+
+    def clientkick_many(self, clids, type=REASON_KICK_SERVER, message=None):
+        """
+        Kicks many clients, see L{send_batch}
+
+        @param clids: Client IDs
+        @type clids: list
+        """
+        return self.send_batch('clientkick', 'clid', clids, keys={'reasonid': type, 'reasonmsg': (message or '')[:40]})
+
+    def clientmove_many(self, clids, cid, password=None):
+        """
+        Moves many clients into a channel, see L{send_batch}
+
+        @param clids: Client IDs
+        @type clids: list
+        @param cid: Channel ID
+        @type cid: int
+        @param password: Channel password
+        @type password: str
+        """
+        keys = {'cid': cid}
+        if password is not None:
+            keys['cpw'] = password
+        return self.send_batch('clientmove', 'clid', clids, keys=keys)
+
+    def servergroupaddclient_many(self, sgid, cldbids):
+        """
+        Adds many clients to a server group, see L{send_batch}
+
+        @param sgid: Server Group ID
+        @type sgid: int
+        @param cldbids: Client Database IDs
+        @type cldbids: list
+        """
+        return self.send_batch('servergroupaddclient', 'cldbid', cldbids, keys={'sgid': sgid})
+
+    def servergroupdelclient_many(self, sgid, cldbids):
+        """
+        Removes many clients from a server group, see L{send_batch}
+
+        @param sgid: Server Group ID
+        @type sgid: int
+        @param cldbids: Client Database IDs
+        @type cldbids: list
+        """
+        return self.send_batch('servergroupdelclient', 'cldbid', cldbids, keys={'sgid': sgid})
+
+    def clientpoke_many(self, clids, message):
+        """
+        Pokes many clients. clientpoke has no multi-target form, so the
+        commands are pipelined instead. Returns a dict of clid to success.
+
+        @param clids: Client IDs
+        @type clids: list
+        @param message: Message
+        @type message: str
+        """
+        with self.pipeline() as pipe:
+            futures = [(clid, pipe.send_command('clientpoke', keys={'clid': clid, 'msg': message})) for clid in clids]
+        return dict((clid, future.result().is_successful) for clid, future in futures)
+
+    # File transfers
+
+    def ftinitupload(self, name, size, cid=0, cpw='', overwrite=True, resume=False, timeout=10):
+        """
+        Initiates an upload and returns the L{FileTransfer} to send the data
+        with. Raises L{FileTransferError} if the server refuses it.
+
+        @param name: Path of the file on the server, such as "/icon_1234"
+        @type name: str
+        @param size: Size of the whole file
+        @type size: int
+        @param cid: Channel ID, 0 for icons and avatars
+        @type cid: int
+        @param cpw: Channel password
+        @type cpw: str
+        @param overwrite: Replace an existing file
+        @type overwrite: bool
+        @param resume: Continue a partial upload, the server reports where
+            in C{seekpos}
+        @type resume: bool
+        @param timeout: Timeout of the data connection in seconds
+        @type timeout: float
+        """
+        clientftfid = next_clientftfid()
+        response = self.send_command('ftinitupload', keys={
+            'clientftfid': clientftfid, 'name': name, 'cid': cid, 'cpw': cpw, 'size': size,
+            'overwrite': int(overwrite and not resume), 'resume': int(resume)})
+        return FileTransfer.from_response(response, self._address[0], clientftfid, size=size, timeout=timeout)
+
+    def ftinitdownload(self, name, cid=0, cpw='', seekpos=0, timeout=10):
+        """
+        Initiates a download and returns the L{FileTransfer} to receive the
+        data with. Raises L{FileTransferError} if the server refuses it.
+
+        @param name: Path of the file on the server
+        @type name: str
+        @param cid: Channel ID, 0 for icons and avatars
+        @type cid: int
+        @param cpw: Channel password
+        @type cpw: str
+        @param seekpos: Offset to start at, to resume a partial download
+        @type seekpos: int
+        @param timeout: Timeout of the data connection in seconds
+        @type timeout: float
+        """
+        clientftfid = next_clientftfid()
+        response = self.send_command('ftinitdownload', keys={
+            'clientftfid': clientftfid, 'name': name, 'cid': cid, 'cpw': cpw, 'seekpos': seekpos})
+        return FileTransfer.from_response(response, self._address[0], clientftfid, seekpos=seekpos, timeout=timeout)
+
+    def ftlist(self):
+        """
+        Returns the rows of the file transfers running on the server, an
+        empty list if there are none
+        """
+        response = self.send_command('ftlist')
+        if not response.is_successful:
+            return []
+        return response.data
+
+    def ftgetfilelist(self, cid=0, path='/', cpw=''):
+        """
+        Returns the rows of the files in a channel directory, an empty list
+        if there are none
+
+        @param cid: Channel ID
+        @type cid: int
+        @param path: Directory
+        @type path: str
+        @param cpw: Channel password
+        @type cpw: str
+        """
+        response = self.send_command('ftgetfilelist', keys={'cid': cid, 'cpw': cpw, 'path': path})
+        if not response.is_successful:
+            return []
+        return response.data
+
+    def upload_file(self, source, name, cid=0, cpw='', overwrite=True, resume=False, timeout=10):
+        """
+        Uploads a file and returns the finished L{FileTransfer}
+
+        @param source: Path, file object opened in binary mode, or bytes
+        @type source: str/file/bytes
+        @param name: Path of the file on the server
+        @type name: str
+        @param resume: Only send what the server is missing of a partial
+            upload
+        @type resume: bool
+        """
+        transfer = self.ftinitupload(name, file_size(source), cid=cid, cpw=cpw, overwrite=overwrite,
+                                     resume=resume, timeout=timeout)
+        return transfer.upload(source)
+
+    def download_file(self, name, target, cid=0, cpw='', resume=False, timeout=10):
+        """
+        Downloads a file and returns the finished L{FileTransfer}
+
+        @param name: Path of the file on the server
+        @type name: str
+        @param target: Path, file object opened in binary mode, or a buffer
+            as large as the file
+        @type target: str/file/bytearray
+        @param resume: Continue into the partial file at target, which has
+            to be a path
+        @type resume: bool
+        """
+        seekpos = 0
+        if resume and isinstance(target, str) and os.path.exists(target):
+            seekpos = os.path.getsize(target)
+        transfer = self.ftinitdownload(name, cid=cid, cpw=cpw, seekpos=seekpos, timeout=timeout)
+        return transfer.download(target)
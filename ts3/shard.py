@@ -0,0 +1,338 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import multiprocessing
+import time
+from threading import Lock, Thread
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+from .server import TS3Server
+
+# Kinds of message workers send
+RESULT = 'result'
+EVENT = 'event'
+ERROR = 'error'
+METRICS = 'metrics'
+
+
+class ShardMessage():
+    """
+    A result, event or error sent back by a worker process. Errors are
+    sent as text, exceptions do not always survive pickling.
+    """
+
+    __slots__ = ('shard', 'kind', 'target', 'value', 'time')
+
+    def __init__(self, shard, kind, target=None, value=None):
+        self.shard = shard
+        self.kind = kind
+        self.target = target
+        self.value = value
+        self.time = time.time()
+
+    def __repr__(self):
+        return 'ShardMessage(%d, %r, %r)' % (self.shard, self.kind, self.target)
+
+
+def shard_targets(targets, shards):
+    """
+    Splits targets round robin into at most shards lists, none of them empty
+    """
+    targets = [tuple(target) for target in targets]
+    return [part for part in (targets[i::shards] for i in range(shards)) if part]
+
+
+class ShardedRunner():
+    """
+    Runs a task against many (ip, port, sid) targets in several worker
+    processes, so that parsing heavy work is not limited to one core by the
+    GIL. Each worker owns the L{TS3Server} connections of its share of the
+    targets and runs the task on each of them every C{interval} seconds, or
+    once without an interval. Results, forwarded notifications and errors
+    come back over one queue::
+
+        def moderate(server, target):
+            return [c['clid'] for c in server.clientlist().values() if c['client_type'] == '0']
+
+        with ShardedRunner('serveradmin', 'secretpassword', targets, moderate, processes=4, interval=30) as runner:
+            for message in runner.messages():
+                print(message.shard, message.kind, message.target, message.value)
+
+    Workers which die are restarted, up to C{max_restarts} times each.
+    L{stats} reports each shard's load as last sent by its worker.
+
+    The task, and setup if given, are passed to the worker processes, so
+    with the "spawn" start method they have to be importable functions and
+    the main module has to be guarded by C{if __name__ == '__main__'}.
+    """
+
+    def __init__(self, username, password, targets, task, processes=None, interval=None, setup=None,
+                 events=(), max_restarts=5, queue_size=10000, context=None):
+        """
+        @param username: ServerQuery login name, None to skip logging in
+        @type username: str
+        @param password: ServerQuery password
+        @type password: str
+        @param targets: (ip, port, sid) tuples, a sid of 0 leaves the
+            selection untouched
+        @type targets: iterable
+        @param task: Called with the L{TS3Server} and target, its return
+            value is sent back as a result
+        @type task: callable
+        @param processes: Worker processes, defaults to the number of CPUs
+        @type processes: int
+        @param interval: Seconds between runs of the task on a target, None
+            to run it once
+        @type interval: float
+        @param setup: Called with the L{TS3Server} and target once connected,
+            for example to register for notifications
+        @type setup: callable
+        @param events: Notifications to send back, such as
+            "notifyclientmoved"
+        @type events: list
+        @param max_restarts: Times a crashed worker is restarted
+        @type max_restarts: int
+        @param queue_size: Messages queued before workers wait for them to
+            be read
+        @type queue_size: int
+        @param context: multiprocessing context, see
+            L{multiprocessing.get_context}
+        """
+        self._context = context or multiprocessing.get_context()
+        self._shards = shard_targets(targets, processes or multiprocessing.cpu_count())
+        self._args = (username, password, task, interval, setup, tuple(events))
+        self.max_restarts = max_restarts
+        self._queue = self._context.Queue(queue_size)
+        self._stop = self._context.Event()
+        self._lock = Lock()
+        self._processes = [None] * len(self._shards)
+        self._stats = [{'targets': len(shard), 'pid': None, 'restarts': 0, 'state': 'new', 'messages': 0}
+                       for shard in self._shards]
+        self._monitor = None
+        self._stopping = False
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __len__(self):
+        return len(self._shards)
+
+    def start(self):
+        """
+        Starts a worker process per shard
+        """
+        with self._lock:
+            for shard in range(len(self._shards)):
+                self._spawn(shard)
+        self._monitor = Thread(target=self._supervise, name='ts3-shard-monitor')
+        self._monitor.daemon = True
+        self._monitor.start()
+        return self
+
+    def stop(self, timeout=5):
+        """
+        Asks the workers to finish their current round and waits for them,
+        terminating those still running after timeout seconds
+        """
+        self._stopping = True
+        self._stop.set()
+        monitor = self._monitor
+        if monitor is not None:
+            monitor.join()
+        deadline = time.time() + timeout
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        with self._lock:
+            for stats in self._stats:
+                if stats['state'] == 'running':
+                    stats['state'] = 'stopped'
+
+    def messages(self, timeout=None):
+        """
+        Yields the L{ShardMessage}s of the workers as they arrive, until all
+        workers have finished or, with a timeout, no message arrived for
+        that many seconds
+
+        @param timeout: Seconds to wait for a message
+        @type timeout: float
+        """
+        waited = 0.0
+        while True:
+            try:
+                message = self._queue.get(timeout=0.1)
+            except Empty:
+                waited += 0.1
+                if self._finished() or (timeout is not None and waited >= timeout):
+                    return
+                continue
+            waited = 0.0
+            with self._lock:
+                stats = self._stats[message.shard]
+                stats['messages'] += 1
+                if message.kind == METRICS:
+                    stats.update(message.value)
+                    continue
+            yield message
+
+    def stats(self):
+        """
+        Returns per shard dicts with the targets, pid, restarts and state of
+        the worker, and the load it last reported: rounds, tasks, errors,
+        busy and cpu seconds, and the time of its last round
+        """
+        with self._lock:
+            return [dict(stats) for stats in self._stats]
+
+    def _spawn(self, shard):
+        # Called with the lock held
+        process = self._context.Process(target=_worker, name='ts3-shard-%d' % shard,
+                                        args=(shard, self._shards[shard], self._queue, self._stop) + self._args)
+        process.daemon = True
+        process.start()
+        self._processes[shard] = process
+        self._stats[shard]['pid'] = process.pid
+        self._stats[shard]['state'] = 'running'
+
+    def _finished(self):
+        with self._lock:
+            return all(stats['state'] != 'running' for stats in self._stats)
+
+    def _supervise(self):
+        while not self._stop.wait(0.1):
+            with self._lock:
+                for shard, process in enumerate(self._processes):
+                    stats = self._stats[shard]
+                    if stats['state'] != 'running' or process.is_alive():
+                        continue
+                    process.join()
+                    if process.exitcode == 0:
+                        stats['state'] = 'finished'
+                    elif self._stopping:
+                        stats['state'] = 'stopped'
+                    elif stats['restarts'] < self.max_restarts:
+                        self.logger.warning("shard %d exited with %s, restarting" % (shard, process.exitcode))
+                        stats['restarts'] += 1
+                        self._spawn(shard)
+                    else:
+                        self.logger.error("shard %d exited with %s, giving up" % (shard, process.exitcode))
+                        stats['state'] = 'failed'
+            if self._finished():
+                return
+
+
+def _worker(shard, targets, queue, stop, username, password, task, interval, setup, events):
+    """
+    Main function of a worker process
+    """
+    logger = logging.getLogger(__name__)
+    servers = {}
+    metrics = {'rounds': 0, 'tasks': 0, 'errors': 0, 'busy': 0.0, 'cpu': 0.0, 'last_round': None}
+
+    def send(kind, target, value):
+        queue.put(ShardMessage(shard, kind, target, value))
+
+    def forward(target):
+        return lambda event: send(EVENT, target, (event.name, [dict(row) for row in event.data]))
+
+    def connect(target):
+        ip, port, sid = target
+        server = TS3Server(ip, port)
+        try:
+            if not server.is_connected():
+                raise IOError('Unable to connect to %s:%s' % (ip, port))
+            if username is not None and not server.login(username, password):
+                raise IOError('Login to %s:%s failed' % (ip, port))
+            if sid and not server.use(sid):
+                raise IOError('Unable to select virtual server %s' % sid)
+            for event in events:
+                server.on(event, forward(target))
+            if setup is not None:
+                setup(server, target)
+            if events:
+                server.start_event_listener()
+        except Exception:
+            # Not kept in servers, so nothing else would close it
+            try:
+                server.disconnect()
+            except Exception:
+                server._close_transport()
+            raise
+        return server
+
+    try:
+        while True:
+            start = time.time()
+            for target in targets:
+                if stop.is_set():
+                    break
+                busy = time.time()
+                try:
+                    # Lost connections are opened again on the next round
+                    server = servers.get(target)
+                    if server is None or not server.is_connected():
+                        server = servers[target] = connect(target)
+                    value = task(server, target)
+                except Exception as e:
+                    logger.debug("shard %d - %s:%s sid %s failed: %s" % ((shard,) + target + (e,)))
+                    metrics['errors'] += 1
+                    send(ERROR, target, '%s: %s' % (type(e).__name__, e))
+                else:
+                    send(RESULT, target, value)
+                metrics['tasks'] += 1
+                metrics['busy'] += time.time() - busy
+
+            metrics['rounds'] += 1
+            metrics['cpu'] = time.process_time()
+            metrics['last_round'] = time.time() - start
+            send(METRICS, None, dict(metrics))
+
+            if interval is None or stop.wait(max(0, interval - (time.time() - start))):
+                break
+    finally:
+        for server in servers.values():
+            try:
+                server.disconnect()
+            except Exception:
+                pass
+        queue.close()
+        queue.join_thread()
@@ -3,14 +3,43 @@ try:
     import unittest2 as unittest
 except ImportError:
     import unittest
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import shutil
 import socket
+import tempfile
 import threading
 import time
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
-from ts3.protocol import TS3Proto, ConnectionError, NoConnectionError
+from ts3.protocol import TS3Proto, TS3Response, TS3Row, TS3Pipeline, TS3Multiplexer, TS3Pager, PreparedCommand, ConnectionError, NoConnectionError, InvalidArguments
+from ts3.server import TS3Server
+try:
+    import telnetlib
+except ImportError:
+    telnetlib = None
+from ts3.aio import AsyncTS3Server
+from ts3.transport import SocketTransport, TelnetTransport
+from ts3.pool import TS3ServerPool, PoolError, PoolExhaustedError
+from ts3.mirror import ServerStateMirror
+from ts3.fanout import FanOut
+from ts3.emulator import ServerQueryEmulator, parse_line
+from ts3.records import ClientRecord, ChannelRecord, ClientDBRecord, record_type
+from ts3.ratelimit import RateLimiter, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from ts3.instrument import Collector, CounterCollector, HistogramCollector, CommandSample
+from ts3.reconnect import ReconnectPolicy
+from ts3.keepalive import KeepaliveScheduler
+from ts3.diff import SnapshotDiff
+from ts3.permissions import PermissionResolver
+from ts3.filetransfer import FileTransfer, FileTransfers, FileTransferError
+from ts3.shard import ShardedRunner, shard_targets
+from ts3.defines import PERMGROUP_TYPE_SERVERGROUP, PERMGROUP_TYPE_GLOBALCLIENT, PERMGROUP_TYPE_CHANNEL, \
+    PERMGROUP_TYPE_CHANNELGROUP, PERMGROUP_TYPE_CHANNELCLIENT
 
 
 class TS3ProtoTest(unittest.TestCase):
@@ -52,6 +81,18 @@ class TS3ProtoTest(unittest.TestCase):
 
         self.assertEqual(res, teststr)
 
+    def testBackslashSequences(self):
+
+        # a literal backslash followed by "s" must not turn into a space
+        self.assertEqual(self.ts3._escape_str('C:\\sounds'), r'C:\\sounds')
+        self.assertEqual(self.ts3._unescape_str(r'C:\\sounds'), 'C:\\sounds')
+        self.assertEqual(self.ts3._unescape_str(r'\\\s\\p'), '\\ \\p')
+        # unknown sequences are left alone
+        self.assertEqual(self.ts3._unescape_str(r'a\qb'), r'a\qb')
+
+        for teststr in ['\\', '\\\\s', 'tab\\\there\n', 'end\\', 'nul\0\\s']:
+            self.assertEqual(self.ts3._unescape_str(self.ts3._escape_str(teststr)), teststr)
+
     def testConstructBasic(self):
         self.assertEqual(self.ts3.construct_command('testcommand'), 'testcommand')
         self.assertEqual(self.ts3.construct_command('testcommand', opts=['test']), 'testcommand -test')
@@ -88,7 +129,7 @@ def dummy_ts3(event, sock):
     event.set()
     try:
         conn, addr = sock.accept()
-        conn.send(b"TS3\n\r")
+        conn.send(b"TS3\n\rWelcome to the TeamSpeak 3 ServerQuery interface\n\r")
     except socket.timeout:
         pass
     finally:
@@ -112,8 +153,8 @@ class TS3ProtoNetworkTests(unittest.TestCase):
 
     def tearDown(self):
         self.evt.wait()
-        if hasattr(self.ts3._telnet, 'sock'):
-            self.ts3._telnet.sock.close()
+        if hasattr(self.ts3._transport, 'sock'):
+            self.ts3._transport.sock.close()
 
     def testConnect(self):
         self.assertTrue(self.ts3.connect('127.0.0.1', self.port))
@@ -123,15 +164,1882 @@ class TS3ProtoNetworkTests(unittest.TestCase):
     def testConnectFail(self):
         self.assertRaises(ConnectionError, self.ts3.connect, '127.0.0.1', 9911)
 
+    def testConnectWrongBanner(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+
+        def serve():
+            conn, addr = sock.accept()
+            conn.settimeout(3)
+            conn.send(b"SSH-2.0-OpenSSH\n\r")
+            # Reads EOF once the client closes its socket
+            received.append(conn.recv(1))
+            conn.close()
+            sock.close()
+
+        received = []
+        server = threading.Thread(target=serve)
+        server.start()
+        ts3 = TS3Proto()
+        self.assertFalse(ts3.connect('127.0.0.1', sock.getsockname()[1]))
+        self.assertFalse(ts3.is_connected())
+        server.join(5)
+        self.assertEqual(received, [b''])
+
     def testNoConnection(self):
         self.assertFalse(self.ts3.is_connected())
-        self.assertRaises(NoConnectionError, self.ts3.check_connection())
+        self.assertRaises(NoConnectionError, self.ts3.check_connection)
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """
+    Base class for tests talking to a L{ServerQueryEmulator}
+    """
+
+    responses = {}
+    transport = SocketTransport
+
+    def setUp(self):
+        self.server = ServerQueryEmulator(dict(self.responses))
+        self.ts3 = TS3Proto(transport=self.transport)
+        self.assertTrue(self.ts3.connect('127.0.0.1', self.server.port))
+
+    def tearDown(self):
+        self.server.close()
+
+
+def poke_response(line):
+    if 'clid=3' in line:
+        return ['error id=512 msg=invalid\\sclientID']
+    return ['error id=0 msg=ok']
+
+
+class TS3PipelineTests(FakeServerTestCase):
+
+    responses = {
+        'clientpoke': poke_response,
+        'channellist': ['cid=1 channel_name=Lobby|cid=2 channel_name=AFK', 'error id=0 msg=ok'],
+    }
+
+    def testOrderedResponses(self):
+        futures = []
+        with self.ts3.pipeline() as pipe:
+            for clid in range(1, 6):
+                futures.append(pipe.send_command('clientpoke', keys=OrderedDict([('clid', clid), ('msg', 'hi')])))
+            futures.append(pipe.send_command('channellist'))
+
+        results = [f.result() for f in futures]
+        self.assertEqual([r.is_successful for r in results], [True, True, False, True, True, True])
+        self.assertEqual(results[2].response['id'], '512')
+        self.assertEqual(results[5].data, [{'cid': '1', 'channel_name': 'Lobby'}, {'cid': '2', 'channel_name': 'AFK'}])
+        self.assertEqual(self.server.received, ['clientpoke clid=%d msg=hi' % i for i in range(1, 6)] + ['channellist'])
+
+    def testSmallWindow(self):
+        pipe = self.ts3.pipeline(window=2)
+        for clid in range(1, 6):
+            pipe.send_command('clientpoke', keys={'clid': clid})
+        self.assertEqual(len(pipe), 5)
+
+        results = pipe.execute()
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual([r.is_successful for r in results], [True, True, False, True, True])
+
+    def testCallback(self):
+        seen = []
+        with self.ts3.pipeline() as pipe:
+            pipe.send_command('clientpoke', keys={'clid': 3}, callback=seen.append)
+        self.assertEqual(len(seen), 1)
+        self.assertFalse(seen[0].is_successful)
+
+    def testCancelOnError(self):
+        try:
+            with self.ts3.pipeline() as pipe:
+                future = pipe.send_command('clientpoke', keys={'clid': 1})
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertTrue(future.cancelled())
+        self.assertEqual(self.server.received, [])
+
+    def testInvalidWindow(self):
+        self.assertRaises(ValueError, TS3Pipeline, self.ts3, window=0)
+
+
+class AsyncTS3Tests(unittest.TestCase):
+
+    responses = {
+        'clientlist': ['clid=1 cid=1 client_database_id=4306 client_nickname=daley|clid=2 cid=5 client_database_id=12 client_nickname=bob', 'error id=0 msg=ok'],
+        'use': lambda line: ['error id=0 msg=ok'] if line == 'use sid=1' else ['error id=1024 msg=invalid\\sserverID'],
+    }
+
+    def setUp(self):
+        self.server = ServerQueryEmulator(dict(self.responses))
+
+    def tearDown(self):
+        self.server.close()
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def testHelpers(self):
+        async def session():
+            ts3 = await AsyncTS3Server.create('127.0.0.1', self.server.port, 1)
+            self.assertTrue(ts3.is_connected())
+            self.assertTrue(await ts3.login('serveradmin', 'secret'))
+            clients = await ts3.clientlist()
+            kicked = await ts3.clientkick(cldbid=4306, message='bye')
+            bad_use = await ts3.use(2)
+            await ts3.disconnect()
+            return clients, kicked, bad_use
+
+        clients, kicked, bad_use = self.run_async(session())
+        self.assertEqual(sorted(clients), ['1', '2'])
+        self.assertEqual(clients['2']['client_nickname'], 'bob')
+        self.assertTrue(kicked)
+        self.assertFalse(bad_use)
+        self.assertEqual(self.server.received[0], 'use sid=1')
+        self.assertIn('clientkick clid=1 reasonid=5 reasonmsg=bye', self.server.received)
+
+    def testNotifications(self):
+        events = []
+
+        async def handler(event):
+            events.append((event.name, event.data[0]['clid']))
+
+        async def session():
+            await ts3.connect('127.0.0.1', self.server.port)
+            ts3.on('notifyclientmoved', handler)
+            ts3.on('*', lambda event: events.append(('*', event.name)))
+            self.server.push('notifyclientmoved ctid=2 reasonid=0 clid=5')
+            self.server.push('notifycliententerview ctid=2 clid=6')
+            clients = await ts3.clientlist()
+            used = await ts3.use(1)
+            await asyncio.sleep(0)
+            await ts3.disconnect()
+            return clients, used
+
+        # Built outside of the loop running it
+        ts3 = AsyncTS3Server()
+        self.assertIsNone(ts3.io_lock)
+        clients, used = self.run_async(session())
+        # The notifications are not taken for the replies
+        self.assertEqual(sorted(clients), ['1', '2'])
+        self.assertTrue(used)
+        self.assertEqual(sorted(events), [('*', 'notifycliententerview'), ('*', 'notifyclientmoved'),
+                                          ('notifyclientmoved', '5')])
+        self.assertIsNone(ts3._writer)
+        self.assertIsNone(ts3._reader)
+        self.assertFalse(ts3.is_connected())
+
+    def testConcurrentCommands(self):
+        async def session():
+            ts3 = AsyncTS3Server()
+            await ts3.connect('127.0.0.1', self.server.port)
+            return await asyncio.gather(*[ts3.clientpoke(clid, 'hi') for clid in range(20)])
+
+        self.assertEqual(self.run_async(session()), [True] * 20)
+
+    def testConnectFail(self):
+        self.assertRaises(ConnectionError, self.run_async, AsyncTS3Server().connect('127.0.0.1', 9911))
+
+    def testNoConnection(self):
+        self.assertRaises(NoConnectionError, self.run_async, AsyncTS3Server().send_command('whoami'))
+
+
+class TS3RowStreamTests(FakeServerTestCase):
+
+    responses = {
+        'clientdblist': ['|'.join('cldbid=%d client_nickname=user\\s%d' % (i, i) for i in range(1, 501)), 'error id=0 msg=ok'],
+        'clientinfo': ['error id=512 msg=invalid\\sclientID'],
+        'whoami': ['virtualserver_id=1 client_id=7', 'error id=0 msg=ok'],
+    }
+
+    def testStreamRows(self):
+        stream = self.ts3.stream_command('clientdblist')
+        rows = list(stream)
+        self.assertEqual(len(rows), 500)
+        self.assertEqual(rows[0], {'cldbid': '1', 'client_nickname': 'user 1'})
+        self.assertEqual(rows[-1], {'cldbid': '500', 'client_nickname': 'user 500'})
+        self.assertTrue(stream.is_successful)
+        self.assertEqual(rows, self.ts3.send_command('clientdblist').data)
+
+    def testSingleRowAndError(self):
+        self.assertEqual(list(self.ts3.stream_command('whoami')), [{'virtualserver_id': '1', 'client_id': '7'}])
+
+        stream = self.ts3.stream_command('clientinfo', keys={'clid': 1})
+        self.assertEqual(list(stream), [])
+        self.assertFalse(stream.is_successful)
+        self.assertEqual(stream.response['id'], '512')
+
+    def testStopEarly(self):
+        stream = iter(self.ts3.stream_command('clientdblist'))
+        self.assertEqual(next(stream)['cldbid'], '1')
+        stream.close()
+
+        # the rest of the reply was drained, so the next command lines up
+        response = self.ts3.send_command('whoami')
+        self.assertEqual(response.data, [{'virtualserver_id': '1', 'client_id': '7'}])
+
+    def testParseEmpty(self):
+        self.assertEqual(TS3Proto.parse_data(''), {})
+        self.assertEqual(self.ts3.send_command('use', keys={'sid': 1}).data, [])
+
+
+@unittest.skipIf(telnetlib is None, 'telnetlib is not available')
+class TelnetTransportTests(TS3RowStreamTests):
+    """ Runs the streaming tests over the telnetlib fallback """
+
+    transport = TelnetTransport
+
+
+class SocketTransportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.transport = SocketTransport('127.0.0.1', self.sock.getsockname()[1], 1, chunk_size=4)
+        self.conn = self.sock.accept()[0]
+
+    def tearDown(self):
+        self.transport.close()
+        self.conn.close()
+        self.sock.close()
+
+    def testSplitDelimiter(self):
+        self.conn.sendall(b"row1|row2\n")
+        self.conn.sendall(b"\rerror id=0\n\r")
+        self.assertEqual(self.transport.read_until((b"|", b"\n\r")), b"row1|")
+        self.assertEqual(self.transport.read_until((b"|", b"\n\r")), b"row2\n\r")
+        self.assertEqual(self.transport.read_until(b"\n\r"), b"error id=0\n\r")
+
+    def testTimeoutAndEOF(self):
+        self.conn.sendall(b"partial")
+        self.assertEqual(self.transport.read_until(b"\n\r", 0.1), b"partial")
+        self.conn.sendall(b"tail")
+        self.conn.close()
+        self.assertEqual(self.transport.read_until(b"\n\r", 1), b"tail")
+        self.assertRaises(EOFError, self.transport.read_until, b"\n\r", 1)
+
+    def testLargeReply(self):
+        payload = b"|".join(b"clid=" + str(i).encode('ascii') for i in range(5000)) + b"\n\r"
+        threading.Thread(target=self.conn.sendall, args=(payload,)).start()
+        self.assertEqual(self.transport.read_until(b"\n\r", 5), payload)
+
+
+class TS3ServerPoolTests(unittest.TestCase):
+
+    responses = {
+        'login': lambda line: ['error id=0 msg=ok'] if 'client_login_password=secret' in line else ['error id=520 msg=invalid\\slogin'],
+        'use': lambda line: ['error id=1024 msg=invalid\\sserverID'] if line == 'use sid=9' else ['error id=0 msg=ok'],
+    }
+
+    def setUp(self):
+        self.server = ServerQueryEmulator(dict(self.responses))
+        self.pool = TS3ServerPool('serveradmin', 'secret', max_size=2, checkout_timeout=0.2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def testReuseAndAffinity(self):
+        with self.pool.connection('127.0.0.1', self.server.port, 1) as first:
+            pass
+        with self.pool.connection('127.0.0.1', self.server.port, 1) as second:
+            self.assertIs(first, second)
+        with self.pool.connection('127.0.0.1', self.server.port, 2) as third:
+            self.assertIs(first, third)
+
+        self.assertEqual([l.split(' ')[0] for l in self.server.received], ['login', 'use', 'use'])
+        self.assertEqual(self.server.received[1:], ['use sid=1', 'use sid=2'])
+
+    def testPreferMatchingSid(self):
+        one = self.pool.checkout('127.0.0.1', self.server.port, 1)
+        two = self.pool.checkout('127.0.0.1', self.server.port, 2)
+        self.pool.release(one)
+        self.pool.release(two)
+
+        with self.pool.connection('127.0.0.1', self.server.port, 1) as server:
+            self.assertIs(server, one)
+        self.assertEqual(self.server.received.count('use sid=1'), 1)
+
+    def testExhausted(self):
+        held = [self.pool.checkout('127.0.0.1', self.server.port) for i in range(2)]
+        self.assertRaises(PoolExhaustedError, self.pool.checkout, '127.0.0.1', self.server.port)
+
+        threading.Timer(0.05, self.pool.release, args=(held[0],)).start()
+        self.assertIs(self.pool.checkout('127.0.0.1', self.server.port), held[0])
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['in_use'], 2)
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertTrue(stats['wait_max'] >= 0.04)
+
+    def testDiscardOnError(self):
+        try:
+            with self.pool.connection('127.0.0.1', self.server.port) as server:
+                raise socket.error
+        except socket.error:
+            pass
+        self.assertFalse(server.is_connected())
+        self.assertEqual(self.pool.stats()['size'], 0)
+
+    def testIdleEvictionAndHealthCheck(self):
+        pool = TS3ServerPool('serveradmin', 'secret', max_idle=0, check_interval=0)
+        with pool.connection('127.0.0.1', self.server.port) as first:
+            pass
+        with pool.connection('127.0.0.1', self.server.port) as second:
+            self.assertIsNot(first, second)
+        self.assertFalse(first.is_connected())
+
+        pool = TS3ServerPool('serveradmin', 'secret', check_interval=0)
+        with pool.connection('127.0.0.1', self.server.port):
+            pass
+        with pool.connection('127.0.0.1', self.server.port):
+            pass
+        self.assertIn('whoami', self.server.received)
+
+    def testErrors(self):
+        self.assertRaises(PoolError, self.pool.checkout, '127.0.0.1', self.server.port, 9)
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+        self.assertRaises(PoolError, TS3ServerPool('serveradmin', 'wrong').checkout, '127.0.0.1', self.server.port)
+        self.assertRaises(ConnectionError, self.pool.checkout, '127.0.0.1', 9911)
+        self.assertEqual(self.pool.stats()['size'], 1)
+        self.assertRaises(ValueError, TS3ServerPool, max_size=0)
+
+    def testLoginErrorClosesConnection(self):
+        pool = TS3ServerPool('serveradmin', 'secret', server_class=FailingLoginServer)
+        self.assertRaises(RuntimeError, pool.checkout, '127.0.0.1', self.server.port)
+        server = FailingLoginServer.instances.pop()
+        self.assertFalse(server.is_connected())
+        self.assertEqual(server._transport.sock.fileno(), -1)
+        self.assertEqual(self.server.received, ['quit'])
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def testPrewarm(self):
+        pool = TS3ServerPool('serveradmin', 'secret', min_size=2, max_size=3, max_idle=0)
+        with pool.connection('127.0.0.1', self.server.port) as first:
+            stats = pool.stats()
+            self.assertEqual((stats['created'], stats['idle'], stats['in_use']), (2, 1, 1))
+        with pool.connection('127.0.0.1', self.server.port) as second:
+            pass
+        # Only warmed once, and min_size connections are kept despite max_idle
+        self.assertEqual(self.server.received.count('login client_login_name=serveradmin client_login_password=secret'), 2)
+        self.assertEqual(pool.stats()['idle'], 2)
+        pool.close()
+
+        pool = TS3ServerPool('serveradmin', 'wrong', min_size=2)
+        self.assertRaises(PoolError, pool.checkout, '127.0.0.1', self.server.port)
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+class FailingLoginServer(TS3Server):
+
+    instances = []
+
+    def login(self, username, password):
+        FailingLoginServer.instances.append(self)
+        raise RuntimeError('login failed')
+
+
+class TS3EventTests(FakeServerTestCase):
+
+    responses = {
+        'whoami': ['notifyclientmoved ctid=5 reasonid=0 clid=3|clid=4', 'virtualserver_id=1 client_id=7', 'error id=0 msg=ok'],
+        'clientlist': ['clid=1|clid=2', 'notifytextmessage targetmode=3 msg=hello\\sthere invokerid=7', 'error id=0 msg=ok'],
+    }
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.seen = []
+        self.got_event = threading.Event()
+
+    def handler(self, event):
+        self.seen.append(event)
+        self.got_event.set()
+
+    def testNotifyBeforeReply(self):
+        self.ts3.on('notifyclientmoved', self.handler)
+        response = self.ts3.send_command('whoami')
+        self.assertEqual(response.data, [{'virtualserver_id': '1', 'client_id': '7'}])
+
+        self.assertTrue(self.got_event.wait(1))
+        self.assertEqual(self.seen[0].name, 'notifyclientmoved')
+        self.assertEqual(self.seen[0].data, [{'ctid': '5', 'reasonid': '0', 'clid': '3'}, {'clid': '4'}])
+
+    def testNotifyWhileStreaming(self):
+        self.ts3.on('*', self.handler)
+        stream = self.ts3.stream_command('clientlist')
+        self.assertEqual(list(stream), [{'clid': '1'}, {'clid': '2'}])
+        self.assertTrue(stream.is_successful)
+
+        self.assertTrue(self.got_event.wait(1))
+        self.assertEqual(self.seen[0].data, [{'targetmode': '3', 'msg': 'hello there', 'invokerid': '7'}])
+
+    def testListener(self):
+        def failing(event):
+            raise RuntimeError('handler failure')
+
+        self.ts3.on('notifycliententerview', failing)
+        self.ts3.on('notifycliententerview', self.handler)
+        self.ts3.start_event_listener(interval=0.05)
+        try:
+            self.server.push('notifycliententerview cfid=0 ctid=1 reasonid=0 clid=9 client_nickname=bob')
+            self.assertTrue(self.got_event.wait(2))
+            self.assertEqual(self.seen[0].data[0]['client_nickname'], 'bob')
+
+            # commands still work alongside the listener
+            self.assertTrue(self.ts3.send_command('whoami').is_successful)
+        finally:
+            self.ts3.stop_event_listener()
+        self.ts3.events.stop()
+
+    def testServerNotifyRegister(self):
+        server = TS3Server()
+        server.connect('127.0.0.1', self.server.port)
+        self.assertTrue(server.servernotifyregister('server'))
+        self.assertTrue(server.servernotifyregister('channel', id=0))
+        self.assertRaises(InvalidArguments, server.servernotifyregister, 'channel')
+        self.assertEqual(self.server.received, ['servernotifyregister event=server', 'servernotifyregister event=channel id=0'])
+
+
+class ServerStateMirrorTests(FakeServerTestCase):
+
+    responses = {
+        'clientlist': ['clid=1 cid=1 client_database_id=10 client_nickname=alice client_type=0 client_unique_identifier=uidA|'
+                       'clid=2 cid=1 client_database_id=20 client_nickname=bob client_type=0 client_unique_identifier=uidB|'
+                       'clid=3 cid=2 client_database_id=20 client_nickname=bob2 client_type=0 client_unique_identifier=uidB',
+                       'error id=0 msg=ok'],
+        'channellist': ['cid=1 pid=0 channel_name=Lobby|cid=2 pid=0 channel_name=AFK', 'error id=0 msg=ok'],
+    }
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.ts3 = TS3Server()
+        self.ts3.connect('127.0.0.1', self.server.port)
+        self.mirror = ServerStateMirror(self.ts3)
+        self.assertTrue(self.mirror.load())
+
+    def nicknames(self, clients):
+        return sorted(c['client_nickname'] for c in clients)
+
+    def testLookups(self):
+        self.assertEqual(len(self.mirror), 3)
+        self.assertEqual(self.mirror.client(1)['client_nickname'], 'alice')
+        self.assertEqual(self.nicknames(self.mirror.clients_by_cldbid(20)), ['bob', 'bob2'])
+        self.assertEqual(self.nicknames(self.mirror.clients_by_uid('uidA')), ['alice'])
+        self.assertEqual(self.mirror.client_by_nickname('bob2')['clid'], '3')
+        self.assertEqual(self.nicknames(self.mirror.clients_in_channel(1)), ['alice', 'bob'])
+        self.assertEqual(self.mirror.channel(2)['channel_name'], 'AFK')
+        self.assertEqual(self.mirror.clients_by_cldbid(99), [])
+        self.assertEqual(self.server.received, ['clientlist -uid', 'channellist'])
+
+    def testEvents(self):
+        self.mirror.attach()
+        self.server.push('notifycliententerview cfid=0 ctid=2 reasonid=0 clid=4 client_database_id=40 client_nickname=carol client_unique_identifier=uidC')
+        self.server.push('notifyclientmoved ctid=2 reasonid=0 clid=1|clid=2')
+        self.server.push('notifyclientleftview cfid=2 ctid=0 reasonid=8 reasonmsg=bye clid=3')
+        self.server.push('notifychannelcreated cid=3 cpid=0 channel_name=New')
+        self.server.push('notifychanneledited cid=1 reasonid=10 channel_name=Hall')
+        self.server.push('notifychanneldeleted cid=3')
+        self.ts3.send_command('whoami')
+        self.ts3.events.stop()
+
+        self.assertEqual(self.nicknames(self.mirror.clients_in_channel(2)), ['alice', 'bob', 'carol'])
+        self.assertEqual(self.mirror.clients_in_channel(1), [])
+        self.assertEqual(self.nicknames(self.mirror.clients_by_cldbid(20)), ['bob'])
+        self.assertIsNone(self.mirror.client_by_nickname('bob2'))
+        self.assertEqual(self.mirror.client(4)['cid'], '2')
+        self.assertNotIn('ctid', self.mirror.client(4))
+        self.assertEqual(self.mirror.channel(1)['channel_name'], 'Hall')
+        self.assertIsNone(self.mirror.channel(3))
+
+        # the kick resolves the cldbid locally
+        del self.server.received[:]
+        self.assertTrue(self.ts3.clientkick(cldbid=40))
+        self.assertEqual(self.server.received, ['clientkick clid=4 reasonid=5 reasonmsg='])
+
+    def testChannelMoved(self):
+        self.mirror.attach()
+        self.server.push('notifychannelcreated cid=3 cpid=1 channel_name=New channel_order=2 invokerid=1')
+        self.server.push('notifychannelmoved cid=2 cpid=1 order=3 reasonid=1 invokerid=1 invokername=alice')
+        self.ts3.send_command('whoami')
+        self.ts3.events.stop()
+
+        self.assertEqual(self.mirror.channel(3), {'cid': '3', 'pid': '1', 'channel_name': 'New', 'channel_order': '2'})
+        self.assertEqual(self.mirror.channel(2), {'cid': '2', 'pid': '1', 'channel_name': 'AFK', 'channel_order': '3'})
+
+    def testRefresh(self):
+        self.server.responses['clientlist'] = ['clid=2 cid=2 client_database_id=20 client_nickname=bobby client_unique_identifier=uidB|'
+                                               'clid=5 cid=1 client_database_id=50 client_nickname=dave client_unique_identifier=uidD',
+                                               'error id=0 msg=ok']
+        self.assertTrue(self.mirror.refresh())
+        self.assertEqual(self.nicknames(self.mirror.clients()), ['bobby', 'dave'])
+        self.assertEqual(self.nicknames(self.mirror.clients_in_channel(2)), ['bobby'])
+        self.assertIsNone(self.mirror.client_by_nickname('bob'))
+
+        self.server.responses['channellist'] = ['error id=1281 msg=database\\sempty\\sresult\\sset']
+        self.assertFalse(self.mirror.refresh())
+
+
+class ResponseCacheTests(FakeServerTestCase):
+
+    responses = {
+        'serverinfo': lambda line: ['virtualserver_name=Server\\s%d' % len(line), 'error id=0 msg=ok'],
+        'channelinfo': ['error id=768 msg=invalid\\schannelID'],
+    }
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.cache = self.ts3.enable_cache(ttls={'serverinfo': 60, 'channelinfo': 60, 'channellist': 60})
+
+    def count(self, command):
+        return len([l for l in self.server.received if l.startswith(command)])
+
+    def testHitAndCopy(self):
+        first = self.ts3.send_command('serverinfo')
+        first.data[0]['virtualserver_name'] = 'changed'
+        second = self.ts3.send_command('serverinfo')
+        self.assertEqual(second.data, [{'virtualserver_name': 'Server 10'}])
+        self.assertEqual(self.count('serverinfo'), 1)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'invalidations': 0, 'entries': 1})
+
+    def testKeyedBySid(self):
+        self.ts3.send_command('serverinfo')
+        self.ts3.send_command('use', keys={'sid': 2})
+        self.ts3.send_command('serverinfo')
+        self.assertEqual(self.count('serverinfo'), 2)
+        self.ts3.send_command('use', keys={'sid': 2})
+        self.ts3.send_command('serverinfo')
+        self.assertEqual(self.count('serverinfo'), 2)
+
+    def testWriteInvalidates(self):
+        self.ts3.send_command('serverinfo')
+        self.ts3.send_command('clientpoke', keys={'clid': 1, 'msg': 'hi'})
+        self.ts3.send_command('serverinfo')
+        self.assertEqual(self.count('serverinfo'), 1)
+
+        self.ts3.send_command('channeledit', keys={'cid': 1, 'channel_name': 'Hall'})
+        self.ts3.send_command('serverinfo')
+        self.assertEqual(self.count('serverinfo'), 2)
+
+        with self.ts3.pipeline() as pipe:
+            pipe.send_command('servergroupaddclient', keys={'sgid': 6, 'cldbid': 2})
+        self.assertEqual(len(self.cache), 0)
+
+    def testExpiryEvictionAndErrors(self):
+        self.cache.ttls['serverinfo'] = 0.05
+        self.ts3.send_command('serverinfo')
+        time.sleep(0.1)
+        self.ts3.send_command('serverinfo')
+        self.assertEqual(self.count('serverinfo'), 2)
+
+        self.ts3.send_command('channelinfo', keys={'cid': 1})
+        self.ts3.send_command('channelinfo', keys={'cid': 1})
+        self.assertEqual(self.count('channelinfo'), 2)
+
+        self.cache.max_entries = 2
+        self.cache.ttls['serverinfo'] = 60
+        for sid in (1, 2, 3):
+            self.ts3.send_command('use', keys={'sid': sid})
+            self.ts3.send_command('serverinfo')
+        self.assertEqual(len(self.cache), 2)
+        self.ts3.send_command('use', keys={'sid': 1})
+        self.ts3.send_command('serverinfo')
+        self.assertEqual(self.count('serverinfo'), 6)
+
+
+class FloodingResponder():
+    """ Rejects the first few commands as flooding """
+
+    def __init__(self, rejections):
+        self.rejections = rejections
+
+    def __call__(self, line):
+        if self.rejections:
+            self.rejections -= 1
+            return ['error id=524 msg=client\\sis\\sflooding']
+        return ['error id=0 msg=ok']
+
+
+class RateLimiterTests(FakeServerTestCase):
+
+    responses = {
+        'instanceinfo': ['serverinstance_serverquery_flood_commands=50 serverinstance_serverquery_flood_time=5', 'error id=0 msg=ok'],
+    }
+
+    def testPacing(self):
+        limiter = RateLimiter(commands=5, period=0.5)
+        start = time.time()
+        for i in range(10):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.45)
+        self.assertEqual(limiter.stats()['granted'], 10)
+
+    def testPriority(self):
+        limiter = RateLimiter(commands=1, period=0.2)
+        limiter.acquire()
+        order = []
+
+        def worker(priority, name):
+            limiter.acquire(priority)
+            order.append(name)
+
+        threads = [threading.Thread(target=worker, args=(PRIORITY_BULK, 'bulk'))]
+        threads[0].start()
+        time.sleep(0.05)
+        threads.append(threading.Thread(target=worker, args=(PRIORITY_INTERACTIVE, 'interactive')))
+        threads[1].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'bulk'])
+
+    def testFloodRetry(self):
+        limiter = self.ts3.enable_rate_limit(commands=100, period=1, backoff=0.01)
+        self.server.responses['clientpoke'] = FloodingResponder(2)
+        self.assertTrue(self.ts3.send_command('clientpoke', keys={'clid': 1, 'msg': 'hi'}).is_successful)
+        self.assertEqual(self.server.received.count('clientpoke clid=1 msg=hi'), 3)
+        self.assertEqual(limiter.stats()['flood_errors'], 2)
+
+        self.server.responses['clientpoke'] = FloodingResponder(5)
+        response = self.ts3.send_command('clientpoke', keys={'clid': 2, 'msg': 'hi'})
+        self.assertEqual(response.response['id'], '524')
+        self.assertEqual(self.server.received.count('clientpoke clid=2 msg=hi'), 4)
+
+    def testExtraMessageWait(self):
+        limiter = RateLimiter()
+        flooded = TS3Response('error id=524 msg=client\\sis\\sflooding extra_msg=please\\swait\\s1\\sseconds', '')
+        self.assertTrue(limiter.should_retry(flooded, 0))
+        self.assertTrue(limiter._reserve() > 0.9)
+        self.assertFalse(limiter.should_retry(TS3Response('error id=0 msg=ok', ''), 0))
+
+    def testPipelineRetry(self):
+        self.ts3.enable_rate_limit(commands=100, period=1, backoff=0.01)
+        self.server.responses['clientmove'] = FloodingResponder(1)
+        with self.ts3.pipeline() as pipe:
+            futures = [pipe.send_command('clientmove', keys={'clid': clid}) for clid in range(3)]
+        self.assertEqual([f.result().is_successful for f in futures], [True, True, True])
+        self.assertEqual(self.server.received, ['clientmove clid=0', 'clientmove clid=1', 'clientmove clid=2', 'clientmove clid=0'])
+
+    def testPipelineYieldsToInteractive(self):
+        self.ts3.enable_rate_limit(commands=2, period=0.2)
+        pipe = self.ts3.pipeline()
+        for clid in range(10):
+            pipe.send_command('clientmove', keys={'clid': clid})
+        thread = threading.Thread(target=pipe.execute)
+        thread.start()
+        time.sleep(0.05)
+        self.assertTrue(self.ts3.send_command('whoami').is_successful)
+        thread.join()
+        # The pipeline waits for tokens without holding the connection, so
+        # the interactive command is not queued behind all of it
+        self.assertEqual(len(self.server.received), 11)
+        self.assertTrue(self.server.received.index('whoami') < 5)
+
+    def testFromInstance(self):
+        server = TS3Server()
+        server.connect('127.0.0.1', self.server.port)
+        limiter = server.enable_rate_limit_from_instance()
+        self.assertEqual(limiter.capacity, 50)
+        self.assertEqual(limiter.rate, 10)
+
+
+def batch_response(line):
+    if 'clid=13' in line:
+        return ['error id=512 msg=invalid\\sclientID']
+    return ['error id=0 msg=ok']
+
+
+def batch_move_response(line):
+    # The packed command moved 11 and 12 before failing on 13
+    if 'clid=13' in line:
+        return ['error id=512 msg=invalid\\sclientID']
+    if set(line.split(' ')) & set(['clid=11', 'clid=12']):
+        return ['error id=770 msg=already\\smember\\sof\\schannel']
+    return ['error id=0 msg=ok']
+
+
+class BatchCommandTests(FakeServerTestCase):
+
+    responses = {
+        'clientmove': batch_move_response,
+        'clientkick': batch_response,
+        'clientpoke': batch_response,
+        'servergroupaddclient': ['error id=2561 msg=duplicate\\sentry'],
+    }
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.ts3 = TS3Server()
+        self.ts3.connect('127.0.0.1', self.server.port)
+
+    def testPacking(self):
+        self.ts3.max_command_length = 100
+        results = self.ts3.clientmove_many(range(100, 130), 5)
+        self.assertEqual(results, dict((clid, True) for clid in range(100, 130)))
+
+        lines = self.server.received
+        self.assertTrue(len(lines) > 1)
+        self.assertTrue(all(len(line) + 2 <= 100 for line in lines))
+        self.assertTrue(all(line.startswith('clientmove clid=') and line.endswith(' cid=5') for line in lines))
+        sent = [int(part.split('=')[1]) for line in lines for part in line[len('clientmove '):-len(' cid=5')].split('|')]
+        self.assertEqual(sent, list(range(100, 130)))
+
+    def testPerTargetResults(self):
+        results = self.ts3.clientmove_many([11, 12, 13, 14], 5)
+        self.assertEqual(results, {11: True, 12: True, 13: False, 14: True})
+        self.assertEqual(self.server.received, ['clientmove clid=11|clid=12|clid=13|clid=14 cid=5', 'clientmove cid=5 clid=11',
+                                                'clientmove cid=5 clid=12', 'clientmove cid=5 clid=13', 'clientmove cid=5 clid=14'])
+
+    def testKickAlreadyGone(self):
+        # Retried clients may have been kicked by the packed command
+        results = self.ts3.clientkick_many([11, 12, 13, 14], message='x' * 50)
+        self.assertEqual(results, {11: True, 12: True, 13: True, 14: True})
+        self.assertEqual(self.server.received[0], 'clientkick clid=11|clid=12|clid=13|clid=14 reasonid=5 reasonmsg=' + 'x' * 40)
+        self.assertEqual(len(self.server.received), 5)
+
+    def testAppliedErrorsOnlyInRetries(self):
+        # Without a packed command before, nothing can have been applied
+        self.assertEqual(self.ts3.clientkick_many([13]), {13: False})
+        self.assertEqual(self.ts3.clientmove_many([11], 5), {11: False})
+        self.assertEqual(self.ts3.servergroupaddclient_many(6, [1]), {1: False})
+        self.assertEqual(len(self.server.received), 3)
+
+    def testPokeMany(self):
+        self.assertEqual(self.ts3.clientpoke_many([12, 13], 'hi'), {12: True, 13: False})
+        self.assertEqual(self.server.received, ['clientpoke clid=12 msg=hi', 'clientpoke clid=13 msg=hi'])
+
+    def testServerGroups(self):
+        # Both were members already, the packed command failing on the first
+        self.assertEqual(self.ts3.servergroupaddclient_many(6, [1, 2]), {1: True, 2: True})
+        self.assertEqual(self.ts3.servergroupdelclient_many(6, [3]), {3: True})
+        self.assertEqual(self.server.received, ['servergroupaddclient cldbid=1|cldbid=2 sgid=6', 'servergroupaddclient sgid=6 cldbid=1',
+                                                'servergroupaddclient sgid=6 cldbid=2', 'servergroupdelclient cldbid=3 sgid=6'])
+
+
+class RecordTests(FakeServerTestCase):
+
+    responses = {
+        'clientlist': ['clid=5 cid=1 client_database_id=4306 client_nickname=daley\\sjr client_type=0 client_away_message=gone\\sfishing|'
+                       'clid=6 cid=2 client_database_id=12 client_nickname=bob client_type=1', 'error id=0 msg=ok'],
+        'channellist': ['cid=1 pid=0 channel_order=0 channel_name=Lobby total_clients=1', 'error id=0 msg=ok'],
+        'serverlist': ['error id=1281 msg=database\\sempty\\sresult\\sset'],
+    }
+
+    def testFromRow(self):
+        record = ClientRecord.from_row('clid=5 cid=1 client_database_id=4306 client_nickname=daley\\sjr client_away client_away_message=a\\/b')
+        self.assertEqual((record.clid, record.cid, record.client_database_id), (5, 1, 4306))
+        self.assertEqual(record.client_nickname, 'daley jr')
+        self.assertIsNone(record.client_type)
+        self.assertIsNone(record._extra)
+        self.assertEqual(record['client_away_message'], 'a/b')
+        self.assertIsNone(record['client_away'])
+        self.assertEqual(record['clid'], 5)
+        self.assertEqual(record.get('missing', 'x'), 'x')
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(record.as_dict()['client_database_id'], 4306)
+
+    def testFromDict(self):
+        data = {'cldbid': '7', 'client_nickname': 'a b', 'client_lastip': '1.2.3.4', 'extra': 'x'}
+        record = ClientDBRecord.from_dict(data)
+        self.assertEqual(record.cldbid, 7)
+        self.assertEqual(record.client_nickname, 'a b')
+        self.assertEqual(record['extra'], 'x')
+        self.assertEqual(record, ClientDBRecord.from_row('cldbid=7 client_nickname=a\\sb client_lastip=1.2.3.4'))
+        self.assertEqual(repr(record_type('Tiny', [('id', int)]).from_row('id=3')), 'Tiny(id=3)')
+
+    def testHashable(self):
+        first = ClientRecord.from_row('clid=5 cid=1 client_nickname=a')
+        same = ClientRecord.from_dict({'clid': '5', 'cid': '1', 'client_nickname': 'a', 'client_away': None})
+        other = ClientRecord.from_row('clid=6 cid=1 client_nickname=a')
+        self.assertEqual(hash(first), hash(same))
+        self.assertEqual(len(set([first, same, other])), 2)
+        self.assertEqual({first: 'x'}[same], 'x')
+
+    def testServerHelpers(self):
+        server = TS3Server()
+        server.connect('127.0.0.1', self.server.port)
+
+        clients = server.clientlist(records=True)
+        self.assertEqual(sorted(clients), [5, 6])
+        self.assertEqual(clients[5].client_nickname, 'daley jr')
+        self.assertEqual(clients[5]['client_away_message'], 'gone fishing')
+
+        channels = server.list_records('channellist')
+        self.assertEqual([(c.cid, c.channel_name, c.total_clients) for c in channels], [(1, 'Lobby', 1)])
+        self.assertEqual(server.list_records('serverlist'), [])
+        self.assertRaises(InvalidArguments, server.list_records, 'logview')
+
+        response = server.send_command('clientlist')
+        self.assertEqual([c.client_type for c in response.records(ClientRecord)], [0, 1])
+
+
+class FanOutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [ServerQueryEmulator({'serverinfo': ['virtualserver_name=host%d' % i, 'error id=0 msg=ok']}) for i in range(2)]
+        self.targets = [('127.0.0.1', server.port, sid) for server in self.servers for sid in (1, 2)]
+        self.fanout = FanOut('serveradmin', 'secret', max_workers=4)
+
+    def tearDown(self):
+        self.fanout.close()
+        for server in self.servers:
+            server.close()
+
+    def testCommand(self):
+        results = self.fanout.map(self.targets + [('127.0.0.1', 9911, 1)], 'serverinfo')
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(results[t].is_successful for t in self.targets))
+        self.assertEqual(results[self.targets[2]].value.data[0]['virtualserver_name'], 'host1')
+        self.assertIsInstance(results[('127.0.0.1', 9911, 1)].error, ConnectionError)
+        self.assertTrue(all(r.latency >= 0 for r in results.values()))
+
+        for server in self.servers:
+            self.assertEqual(server.received.count('serverinfo'), 2)
+            self.assertIn('use sid=1', server.received)
+            self.assertIn('use sid=2', server.received)
+
+    def testCallableStreaming(self):
+        def slow(server):
+            time.sleep(0.1 if server._sid == 2 else 0)
+            return server._sid
+
+        finished = [result.value for result in self.fanout.run(self.targets, slow)]
+        self.assertEqual(sorted(finished), [1, 1, 2, 2])
+        self.assertEqual(finished[:2], [1, 1])
+
+
+class ServerQueryEmulatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerQueryEmulator(latency={'clientdblist': 0.05})
+        self.server.populate(clients=250, channels=5, dbclients=60, logs=30)
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def testListings(self):
+        clients = self.ts3.clientlist()
+        self.assertEqual(len(clients), 250)
+        self.assertEqual(clients['7']['client_nickname'], 'Client 7 [bench]')
+        self.assertNotIn('client_unique_identifier', clients['7'])
+        response = self.ts3.send_command('clientlist', opts=['uid'])
+        self.assertEqual(response.data[0]['client_unique_identifier'], 'uid00000001/Bench+Client=')
+        self.assertEqual(len(self.ts3.send_command('channellist').data), 5)
+
+        response = self.ts3.send_command('logview', keys={'lines': 10})
+        self.assertEqual(len(response.data), 10)
+        self.assertIn('file_size', response.data[0])
+        self.assertIn("'Client 30'", response.data[-1]['l'])
+
+    def testPagingAndLatency(self):
+        start = time.time()
+        response = self.ts3.send_command('clientdblist', keys={'start': 50}, opts=['count'])
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(response.data[0]['count'], '60')
+        self.assertEqual([row['cldbid'] for row in response.data], [str(i) for i in range(1051, 1061)])
+        response = self.ts3.send_command('clientdblist', keys={'start': 60})
+        self.assertEqual(response.response['id'], '1281')
+        self.assertEqual(parse_line('clientdblist start=5 -count'), ('clientdblist', {'start': '5'}, set(['count'])))
+
+    def testEmit(self):
+        received = threading.Event()
+        events = []
+
+        def handler(event):
+            events.append(event)
+            received.set()
+
+        self.ts3.on('notifyclientmoved', handler)
+        self.ts3.start_event_listener(interval=0.05)
+        try:
+            time.sleep(0.1)
+            self.server.emit('clientmoved', [OrderedDict([('ctid', 2), ('reasonid', 0), ('clid', 5)]), {'clid': 6}])
+            self.assertTrue(received.wait(2))
+        finally:
+            self.ts3.stop_event_listener()
+        self.assertEqual(events[0].data, [{'ctid': '2', 'reasonid': '0', 'clid': '5'}, {'clid': '6'}])
+
+
+class InstrumentTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerQueryEmulator({'clientpoke': poke_response}, latency={'channellist': 0.05})
+        self.server.populate(clients=20, channels=3)
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+        self.histogram = self.ts3.add_instrument(HistogramCollector())
+        self.counter = self.ts3.add_instrument(CounterCollector())
+
+    def tearDown(self):
+        self.server.close()
+
+    def testSendCommand(self):
+        samples = []
+
+        class Recorder(Collector):
+            def record(self, sample):
+                samples.append(sample)
+
+        self.ts3.add_instrument(Recorder())
+        response = self.ts3.send_command('channellist')
+        self.ts3.send_command('clientpoke', keys={'clid': 3, 'msg': 'hi'})
+        # Rows are counted without decoding them
+        self.assertIsNone(response._data)
+        self.assertIsNone(response._rows)
+
+        sample = samples[0]
+        self.assertEqual(sample.command, 'channellist')
+        self.assertTrue(sample.ttfb >= 0.05)
+        self.assertTrue(sample.total >= sample.ttfb)
+        self.assertEqual(sample.rows, 3)
+        self.assertEqual(sample.bytes_out, len(b'channellist\n\r'))
+        self.assertTrue(sample.bytes_in > 100)
+        self.assertEqual(sample.error_id, '0')
+        self.assertEqual(samples[1].error_id, '512')
+
+        counters = self.counter.stats()
+        self.assertEqual(counters['clientpoke']['errors'], 1)
+        self.assertEqual(counters['error_ids'], {'512': 1})
+        stats = self.histogram.stats()
+        self.assertEqual(stats['*']['total']['count'], 2)
+        self.assertTrue(stats['channellist']['ttfb']['p50'] >= 0.05)
+
+    def testStreamAndPipeline(self):
+        rows = list(self.ts3.stream_command('clientlist'))
+        with self.ts3.pipeline() as pipe:
+            for clid in (1, 3, 4):
+                pipe.send_command('clientpoke', keys={'clid': clid, 'msg': 'hi'})
+            channels = pipe.send_command('channellist')
+        self.assertIsNone(channels.result()._data)
+
+        counters = self.counter.stats()
+        self.assertEqual(counters['clientlist']['rows'], len(rows))
+        self.assertEqual(counters['clientlist']['commands'], 1)
+        self.assertEqual(counters['clientpoke']['commands'], 3)
+        self.assertEqual(counters['clientpoke']['errors'], 1)
+        self.assertEqual(counters['channellist']['rows'], 3)
+        self.assertTrue(counters['clientlist']['bytes_in'] > 0)
+        self.assertTrue(self.histogram.stats()['clientlist']['parse']['sum'] > 0)
+
+    def testFailingCollector(self):
+        class Broken(Collector):
+            def record(self, sample):
+                raise RuntimeError
+
+        self.ts3.add_instrument(Broken())
+        self.assertTrue(self.ts3.send_command('whoami').is_successful)
+        self.assertEqual(self.counter.stats()['whoami']['commands'], 1)
+
+        self.ts3.instruments = []
+        self.ts3.send_command('whoami')
+        self.assertEqual(self.counter.stats()['whoami']['commands'], 1)
+
+    def testPercentile(self):
+        histogram = HistogramCollector(buckets=(0.001, 0.01, 0.1))
+        for total in (0.0005, 0.0005, 0.005, 0.05, 0.5):
+            histogram.record(CommandSample('whoami', read=total, error_id='0'))
+        self.assertEqual(histogram.percentile('whoami', 'read', 40), 0.001)
+        self.assertEqual(histogram.percentile('whoami', 'read', 60), 0.01)
+        self.assertEqual(histogram.percentile('whoami', 'read', 99), 0.5)
+        self.assertEqual(histogram.percentile('whoami', 'write', 50), 0.0)
+        self.assertEqual(histogram.percentile('clientlist', 'read', 50), None)
+
+
+class ReconnectTests(unittest.TestCase):
+
+    def setUp(self):
+        self.drops = {}
+        self.server = ServerQueryEmulator({
+            'clientlist': self.dropping(['clid=1 client_nickname=bot', 'error id=0 msg=ok']),
+            'gm': self.dropping(['error id=0 msg=ok']),
+        })
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+        self.policy = self.ts3.enable_reconnect(backoff=0.01)
+        self.ts3.login('serveradmin', 'secret')
+        self.ts3.use(1)
+        self.ts3.send_command('clientupdate', keys={'client_nickname': 'bot'})
+        self.ts3.servernotifyregister('server')
+        self.ts3.servernotifyregister('channel', id=0)
+
+    def tearDown(self):
+        self.server.close()
+
+    def dropping(self, reply):
+        """
+        Drops the connection instead of replying while self.drops has a
+        count left for the command
+        """
+        def respond(line):
+            command = line.split(' ', 1)[0]
+            if self.drops.get(command):
+                self.drops[command] -= 1
+                self.server.drop()
+                return []
+            return reply
+        return respond
+
+    def assertRestored(self, received):
+        self.assertEqual(received[:5], ['login client_login_name=serveradmin client_login_password=secret',
+                                        'use sid=1', 'clientupdate client_nickname=bot',
+                                        'servernotifyregister event=server',
+                                        'servernotifyregister event=channel id=0'])
+
+    def testReconnectOnNextCommand(self):
+        self.server.drop()
+        time.sleep(0.05)
+        del self.server.received[:]
+        self.assertTrue(self.ts3.send_command('whoami').is_successful)
+        self.assertRestored(self.server.received)
+        self.assertEqual(self.server.received[5:], ['whoami'])
+        self.assertEqual(self.policy.stats()['reconnects'], 1)
+        self.assertEqual(self.ts3._sid, 1)
+
+    def testReplayIdempotent(self):
+        self.drops['clientlist'] = 1
+        del self.server.received[:]
+        self.assertEqual(self.ts3.clientlist()['1']['client_nickname'], 'bot')
+        self.assertEqual(self.server.received[0], 'clientlist')
+        self.assertRestored(self.server.received[1:])
+        self.assertEqual(self.server.received[6:], ['clientlist'])
+        self.assertEqual(self.policy.stats()['replays'], 1)
+
+        # Replays are bounded
+        self.drops['clientlist'] = 5
+        self.assertRaises(EOFError, self.ts3.clientlist)
+
+    def testNoReplay(self):
+        self.drops['gm'] = 1
+        self.assertRaises(EOFError, self.ts3.gm, 'hello')
+        self.assertFalse(self.ts3.is_connected())
+        self.assertEqual(self.server.received.count('gm msg=hello'), 1)
+
+        self.assertTrue(self.ts3.gm('hello'))
+        self.assertEqual(self.policy.stats()['reconnects'], 1)
+
+    def testPipelineReplay(self):
+        self.drops['clientlist'] = 1
+        pipe = self.ts3.pipeline()
+        futures = [pipe.send_command('whoami'), pipe.send_command('clientlist'), pipe.send_command('gm', keys={'msg': 'hi'})]
+        self.assertRaises(EOFError, pipe.execute)
+        self.assertTrue(futures[0].result().is_successful)
+        self.assertTrue(futures[1].result().is_successful)
+        self.assertIsInstance(futures[2].exception(), EOFError)
+
+    def testListenerReconnects(self):
+        self.ts3.start_event_listener(interval=0.05)
+        try:
+            del self.server.received[:]
+            self.server.drop()
+            for i in range(40):
+                if len(self.server.received) >= 5:
+                    break
+                time.sleep(0.05)
+            self.assertRestored(self.server.received)
+            self.assertTrue(self.ts3.is_connected())
+        finally:
+            self.ts3.stop_event_listener()
+
+    def testGiveUp(self):
+        self.ts3.enable_reconnect(max_attempts=2, backoff=0.01)
+        self.server.close()
+        time.sleep(0.05)
+        self.assertRaises(ConnectionError, self.ts3.send_command, 'whoami')
+        self.assertEqual(self.ts3.reconnect_policy.stats()['failed_attempts'], 2)
+
+        # Explicitly disconnected connections stay down
+        self.assertRaises(NoConnectionError, self.ts3.disconnect)
+
+    def testPolicy(self):
+        policy = ReconnectPolicy(max_attempts=4, backoff=0.1, max_backoff=0.3)
+        self.assertEqual([policy.delay(i) for i in range(5)], [0, 0.1, 0.2, 0.3, None])
+        self.assertTrue(policy.can_replay('clientlist', 1))
+        self.assertFalse(policy.can_replay('clientlist', 2))
+        self.assertFalse(policy.can_replay('clientkick', 0))
+
+
+class KeepaliveTests(FakeServerTestCase):
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.02)
+        return condition()
+
+    def testIdle(self):
+        keepalive = self.ts3.start_keepalive(interval=0.1)
+        try:
+            self.assertTrue(self.wait_for(lambda: self.server.received.count('whoami') >= 2))
+        finally:
+            self.ts3.stop_keepalive()
+        self.assertTrue(self.ts3.idle_rtt > 0)
+        self.assertTrue(keepalive.stats()['sent'] >= 2)
+        self.assertTrue(keepalive.stats()['rtt_avg'] > 0)
+
+    def testActiveConnection(self):
+        self.ts3.start_keepalive(interval=0.2, command='version')
+        try:
+            for i in range(8):
+                self.ts3.send_command('clientlist')
+                time.sleep(0.05)
+        finally:
+            self.ts3.stop_keepalive()
+        self.assertNotIn('version', self.server.received)
+
+    def testSkipBusy(self):
+        with self.ts3.io_lock:
+            self.assertEqual(self.ts3.keepalive(), None)
+        limiter = self.ts3.enable_rate_limit(commands=1, period=10)
+        self.assertTrue(self.ts3.keepalive() > 0)
+        self.assertEqual(self.ts3.keepalive(), None)
+        self.assertEqual(limiter.stats()['granted'], 1)
+        self.assertEqual(self.server.received, ['whoami'])
+
+    def testReconnect(self):
+        policy = self.ts3.enable_reconnect(backoff=0.01)
+        scheduler = KeepaliveScheduler(interval=0.1)
+        scheduler.add(self.ts3)
+        try:
+            self.server.drop()
+            self.assertTrue(self.wait_for(lambda: policy.stats()['reconnects'] == 1))
+            self.assertTrue(self.ts3.is_connected())
+        finally:
+            scheduler.stop()
+        self.assertEqual(len(scheduler), 1)
+
+        # Without a policy lost connections are forgotten
+        self.ts3.reconnect_policy = None
+        scheduler.add(self.ts3)
+        try:
+            self.server.drop()
+            self.assertTrue(self.wait_for(lambda: len(scheduler) == 0))
+        finally:
+            scheduler.stop()
+        self.assertTrue(scheduler.stats()['failed'] >= 1)
+
+    def testPool(self):
+        pool = TS3ServerPool(keepalive=0.1)
+        try:
+            with pool.connection('127.0.0.1', self.server.port):
+                pass
+            self.assertTrue(self.wait_for(lambda: pool.stats()['keepalive']['sent'] >= 1))
+            self.assertEqual(pool.stats()['keepalive']['connections'], 1)
+        finally:
+            pool.close()
+        self.assertEqual(len(pool.keepalive), 0)
+
+
+class TS3RowTests(unittest.TestCase):
+
+    data = (b'clid=1 cid=2 client_nickname=Bob\\sthe\\sBuilder client_unique_identifier=abc/def= client_away'
+            b'|clid=12 cpid=3 cid=4 client_nickname=C:\\\\s\\p|\n\r')
+
+    def setUp(self):
+        self.response = TS3Response(b'error id=0 msg=ok', self.data)
+
+    def testAccess(self):
+        rows = self.response.rows
+        self.assertEqual(len(rows), 3)
+        self.assertIsInstance(rows[0], TS3Row)
+        self.assertEqual(rows[0]['clid'], '1')
+        self.assertEqual(rows[0]['client_nickname'], 'Bob the Builder')
+        self.assertEqual(rows[0]['client_unique_identifier'], 'abc/def=')
+        self.assertEqual(rows[0]['client_away'], None)
+        self.assertRaises(KeyError, lambda: rows[0]['client_type'])
+        self.assertEqual(rows[0].get('client_type', 5), 5)
+        self.assertEqual(rows[1]['cid'], '4')
+        self.assertEqual(rows[1]['client_nickname'], 'C:\\s|')
+        self.assertTrue('cpid' in rows[1])
+        self.assertFalse('pid' in rows[1])
+        self.assertEqual(len(rows[2]), 0)
+
+    def testMatchesEagerParsing(self):
+        expected = TS3Proto.parse_data(self.data.decode('utf-8'))
+        self.assertEqual(self.response.rows, expected)
+        self.assertEqual(expected, self.response.rows)
+        self.assertEqual(sorted(self.response.rows[0].keys()), sorted(expected[0].keys()))
+        self.assertEqual(TS3Response('error id=0 msg=ok', self.data.decode('utf-8')).rows, expected)
+        self.assertEqual(TS3Response(b'error id=0 msg=ok', b'').rows, [])
+
+    def testDataIsDicts(self):
+        # data keeps returning plain dicts, the lazy rows are opt-in
+        expected = TS3Proto.parse_data(self.data.decode('utf-8'))
+        self.assertEqual(self.response.data, expected)
+        self.assertTrue(all(type(row) is dict for row in self.response.data))
+        self.assertEqual(json.loads(json.dumps(self.response.data)), expected)
+        self.assertEqual(TS3Response(b'error id=0 msg=ok', b'clid=1\n\r').data, [{'clid': '1'}])
+        self.assertEqual(TS3Response(b'error id=0 msg=ok', b'').data, [])
+
+        # Both views are parsed from the reply on their own
+        self.response.data[0]['clid'] = '7'
+        self.assertEqual(self.response.rows[0]['clid'], '1')
+        self.response.data = [{'clid': '9'}]
+        self.assertEqual(self.response.rows, [{'clid': '9'}])
+        self.assertEqual(self.response.records(ClientRecord)[0].clid, 9)
+
+    def testModify(self):
+        row = self.response.rows[0]
+        row['client_nickname'] = 'C:\\s'
+        row['extra'] = '1'
+        del row['client_away']
+        self.assertEqual(row['client_nickname'], 'C:\\s')
+        self.assertEqual(len(row), 5)
+        self.assertNotIn('client_away', row)
+
+        self.response.data[0]['extra'] = '1'
+        copy = self.response.copy()
+        copy.data[0]['clid'] = '7'
+        copy.data[1]['clid'] = '8'
+        self.assertEqual(copy.data[0]['extra'], '1')
+        self.assertEqual(self.response.data[0]['clid'], '1')
+        self.assertEqual(self.response.data[1]['clid'], '12')
+
+    def testRecords(self):
+        clients = self.response.records(ClientRecord)
+        self.assertEqual(clients[0].clid, 1)
+        self.assertEqual(clients[1].client_nickname, 'C:\\s|')
+        dict(self.response.rows[0])
+        self.assertEqual(self.response.records(ClientRecord)[0].client_nickname, 'Bob the Builder')
+
+
+class SnapshotDiffTests(unittest.TestCase):
+
+    def rows(self, *clients):
+        return [{'clid': clid, 'cid': cid, 'client_nickname': nick, 'client_away': away}
+                for clid, cid, nick, away in clients]
+
+    def testChanges(self):
+        diff = SnapshotDiff.clients(fields=['client_away'])
+        changes = diff.update(self.rows(('1', '1', 'Bob', '0'), ('2', '1', 'Alice', '0')))
+        self.assertEqual([(c.kind, c.key) for c in changes], [('joined', '1'), ('joined', '2')])
+        self.assertEqual(diff.update(self.rows(('2', '1', 'Alice', '0'), ('1', '1', 'Bob', '0'))), [])
+
+        changes = diff.update(self.rows(('1', '2', 'Bobby', '1'), ('3', '1', 'Eve', '0')))
+        self.assertEqual([(c.kind, c.key, c.fields) for c in changes], [
+            ('moved', '1', ('cid',)), ('renamed', '1', ('client_nickname',)),
+            ('changed', '1', ('client_away',)), ('joined', '3', ('cid', 'client_nickname', 'client_away')),
+            ('left', '2', ('cid', 'client_nickname', 'client_away'))])
+        self.assertEqual(changes[0].old['cid'], '1')
+        self.assertEqual(changes[0].new['cid'], '2')
+        self.assertEqual(changes[4].new, None)
+        self.assertEqual(len(diff), 2)
+        self.assertEqual(diff.get('3')['client_nickname'], 'Eve')
+
+    def testOnlyComparedFields(self):
+        diff = SnapshotDiff.clients()
+        diff.prime(self.rows(('1', '1', 'Bob', '0')))
+        self.assertEqual(diff.update(self.rows(('1', '1', 'Bob', '1'))), [])
+
+        diff = SnapshotDiff('clid', moved=None, renamed=None, fields=['client_away'])
+        diff.prime(self.rows(('1', '1', 'Bob', '0')))
+        self.assertEqual(diff.update(self.rows(('1', '5', 'Bobby', '0'))), [])
+
+    def testAbandonedFeed(self):
+        diff = SnapshotDiff.clients()
+        diff.prime(self.rows(('1', '1', 'Bob', '0'), ('2', '1', 'Alice', '0')))
+        feed = diff.feed(self.rows(('1', '2', 'Bob', '0')))
+        self.assertEqual(next(feed).kind, 'moved')
+        feed.close()
+        self.assertEqual(len(diff), 2)
+        self.assertEqual(diff.get('1')['cid'], '1')
+
+    def testStreamAndRecords(self):
+        server = ServerQueryEmulator().populate(clients=50, channels=5)
+        try:
+            ts3 = TS3Server('127.0.0.1', server.port)
+            diff = SnapshotDiff.clients()
+            self.assertEqual(len(diff.update(ts3.stream_command('clientlist'))), 50)
+            self.assertEqual(diff.update(ts3.send_command('clientlist').data), [])
+
+            channels = SnapshotDiff.channels()
+            channels.prime(ts3.send_command('channellist').records(ChannelRecord))
+            self.assertIn(1, channels)
+            self.assertEqual(channels.update(ts3.stream_command('channellist', record=ChannelRecord)), [])
+        finally:
+            server.close()
+
+
+def echo_response(line):
+    return ['clid=%s' % line.split('clid=')[1], 'error id=0 msg=ok']
+
+
+class TS3MultiplexerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerQueryEmulator({'clientinfo': echo_response})
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def testConcurrentWorkers(self):
+        errors = []
+
+        def worker(n):
+            for i in range(50):
+                clid = '%d%03d' % (n, i)
+                if self.ts3.send_command('clientinfo', keys={'clid': clid}).data[0]['clid'] != clid:
+                    errors.append(clid)
+
+        with self.ts3.multiplex(window=4) as mux:
+            self.assertIsInstance(mux, TS3Multiplexer)
+            threads = [threading.Thread(target=worker, args=(n,)) for n in range(1, 9)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.server.received), 400)
+
+        # The connection is handed back afterwards
+        self.assertEqual(len(list(self.ts3.stream_command('clientinfo', keys={'clid': 5}))), 1)
+
+    def testSubmit(self):
+        with self.ts3.multiplex() as mux:
+            futures = [mux.submit('clientinfo', keys={'clid': i}) for i in range(20)]
+            used = mux.submit('use', keys={'sid': 3})
+            self.assertEqual([f.result().data[0]['clid'] for f in futures], [str(i) for i in range(20)])
+            self.assertTrue(used.result().is_successful)
+        self.assertEqual(self.ts3._sid, 3)
+        self.assertRaises(NoConnectionError, mux.submit, 'whoami')
+
+    def testPipelinesAndStreams(self):
+        self.server.populate(clients=20, dbclients=120)
+        results = {}
+
+        def run():
+            with self.ts3.multiplex():
+                with self.ts3.pipeline() as pipe:
+                    futures = [pipe.send_command('clientinfo', keys={'clid': clid}) for clid in range(10)]
+                results['pipeline'] = [future.result().data[0]['clid'] for future in futures]
+                stream = self.ts3.stream_command('clientinfo', keys={'clid': 42})
+                results['stream'] = [row['clid'] for row in stream]
+                results['stream_ok'] = stream.is_successful
+                results['records'] = len(self.ts3.clientlist(records=True))
+                results['pokes'] = self.ts3.clientpoke_many([1, 2, 3], 'hi')
+                results['pager'] = len(list(self.ts3.iter_clientdblist(page_size=50)))
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        # Waiting for io_lock, which the multiplexer holds, would hang here
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results, {'pipeline': [str(clid) for clid in range(10)], 'stream': ['42'], 'stream_ok': True,
+                                   'records': 20, 'pokes': {1: True, 2: True, 3: True}, 'pager': 120})
+
+    def testNotificationsAndListener(self):
+        received = threading.Event()
+        self.ts3.on('notifyclientmoved', lambda event: received.set())
+        self.ts3.start_event_listener(interval=0.05)
+        with self.ts3.multiplex():
+            self.assertEqual(self.ts3._listener, None)
+            self.server.emit('clientmoved', [{'clid': 1, 'ctid': 2}])
+            self.assertTrue(received.wait(2))
+            self.assertTrue(self.ts3.send_command('whoami').is_successful)
+        self.assertNotEqual(self.ts3._listener, None)
+        self.ts3.stop_event_listener()
+
+    def testInstruments(self):
+        counter = self.ts3.add_instrument(CounterCollector())
+        with self.ts3.multiplex():
+            response = self.ts3.send_command('clientinfo', keys={'clid': 5})
+        # The reader counts the rows without decoding them
+        self.assertIsNone(response._data)
+        self.assertEqual(counter.stats()['clientinfo']['rows'], 1)
+
+    def testFloodRetry(self):
+        self.ts3.enable_rate_limit(commands=100, period=1, backoff=0.01)
+        self.server.responses['clientpoke'] = FloodingResponder(1)
+        with self.ts3.multiplex():
+            self.assertTrue(self.ts3.send_command('clientpoke', keys={'clid': 1, 'msg': 'hi'}).is_successful)
+        self.assertEqual(self.server.received.count('clientpoke clid=1 msg=hi'), 2)
+
+    def testConnectionLost(self):
+        self.server.responses['gm'] = lambda line: self.server.drop() or []
+        policy = self.ts3.enable_reconnect(backoff=0.01)
+        mux = self.ts3.multiplex()
+        pending = mux.submit('gm', keys={'msg': 'hi'})
+        self.assertIsInstance(pending.exception(2), EOFError)
+        self.assertRaises(NoConnectionError, mux.submit, 'whoami')
+        mux.stop()
+
+        self.assertTrue(self.ts3.send_command('whoami').is_successful)
+        self.assertEqual(policy.stats()['reconnects'], 1)
+
+
+class TS3PagerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerQueryEmulator().populate(dbclients=250)
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def pages(self):
+        return [parse_line(line)[1] for line in self.server.received if line.startswith('clientdblist')]
+
+    def testWalk(self):
+        pager = self.ts3.iter_clientdblist(page_size=40)
+        self.assertIsInstance(pager, TS3Pager)
+        rows = [row['cldbid'] for row in pager]
+        self.assertEqual(rows, [str(i) for i in range(1001, 1251)])
+        self.assertTrue(pager.is_successful)
+        self.assertEqual(pager.pages, 7)
+        # The short last page is followed by a request answered with 1281
+        self.assertEqual([(keys['start'], keys['duration']) for keys in self.pages()],
+                         [(str(i), '40') for i in range(0, 250, 40)] + [('250', '40')])
+        self.assertEqual(pager.response['id'], '1281')
+
+    def testEmptyLastPage(self):
+        pager = self.ts3.iter_clientdblist(page_size=50, records=True)
+        clients = list(pager)
+        self.assertEqual(len(clients), 250)
+        self.assertIsInstance(clients[0], ClientDBRecord)
+        self.assertEqual(clients[-1].cldbid, 1250)
+        # The request past the end answers "database empty result set"
+        self.assertTrue(pager.is_successful)
+        self.assertEqual(pager.response['id'], '1281')
+        self.assertEqual(pager.pages, 5)
+
+    def testCappedDuration(self):
+        self.server.close()
+        self.server = ServerQueryEmulator().populate(dbclients=250, max_duration=100)
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+        pager = self.ts3.iter_clientdblist(page_size=150)
+        rows = [row['cldbid'] for row in pager]
+        self.assertEqual(rows, [str(i) for i in range(1001, 1251)])
+        self.assertTrue(pager.is_successful)
+        self.assertEqual(pager.pages, 3)
+        self.assertEqual([keys['start'] for keys in self.pages()], ['0', '100', '200', '250'])
+
+    def testPrefetch(self):
+        pager = iter(self.ts3.iter_clientdblist(page_size=40))
+        next(pager)
+        deadline = time.time() + 2
+        while len(self.pages()) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        # The second page was requested while the first is still being read
+        self.assertEqual(self.pages()[1]['start'], '40')
+        self.assertEqual(len(self.pages()), 2)
+        self.assertEqual(len(list(pager)), 249)
+
+    def testWithoutPrefetch(self):
+        pager = iter(self.ts3.iter_clientdblist(page_size=40, prefetch=False))
+        next(pager)
+        time.sleep(0.05)
+        self.assertEqual(len(self.pages()), 1)
+        self.assertEqual(len(list(pager)), 249)
+
+    def testStartAndError(self):
+        rows = list(self.ts3.paginate('clientdblist', keys={'start': 200}, page_size=30))
+        self.assertEqual(rows[0]['cldbid'], '1201')
+        self.assertEqual(len(rows), 50)
+
+        self.server.responses['banlist'] = ['error id=2568 msg=insufficient\\sclient\\spermissions']
+        pager = self.ts3.iter_banlist(page_size=10)
+        self.assertEqual(list(pager), [])
+        self.assertFalse(pager.is_successful)
+        self.assertRaises(InvalidArguments, list, pager)
+        self.assertRaises(InvalidArguments, self.ts3.paginate, 'banlist', page_size=0)
+
+    def testComplainList(self):
+        self.server.responses['complainlist'] = ['tcldbid=5 fcldbid=7 message=spam|tcldbid=5 fcldbid=8 message=spam', 'error id=0 msg=ok']
+        pager = self.ts3.iter_complainlist(tcldbid=5)
+        self.assertEqual([row['fcldbid'] for row in pager], ['7', '8'])
+        self.assertTrue(pager.is_successful)
+        self.assertEqual(self.server.received[-1], 'complainlist tcldbid=5')
+
+
+class PermissionTables():
+    """ Answers the permission listings from a fixed set of tables """
+
+    default_tables = {
+        'permissionlist': 'permid=1 permname=b_client_kick_from_channel|permid=2 permname=i_channel_join_power'
+                          '|permid=3 permname=i_channel_needed_join_power|permid=4 permname=i_client_talk_power',
+        'serverinfo': 'virtualserver_name=Test virtualserver_default_channel_group=8',
+        'servergrouplist': 'sgid=6 name=Admin|sgid=7 name=Member|sgid=9 name=Muted',
+        'channelgrouplist': 'cgid=5 name=Channel\\sAdmin|cgid=8 name=Guest',
+        'channelgroupclientlist': 'cid=405 cldbid=20 cgid=5',
+        'servergrouppermlist sgid=6': 'permsid=i_channel_join_power permvalue=50 permnegated=0 permskip=0'
+                                      '|permsid=i_client_talk_power permvalue=75 permnegated=0 permskip=1',
+        'servergrouppermlist sgid=7': 'permsid=i_channel_join_power permvalue=20 permnegated=0 permskip=0'
+                                      '|permsid=i_client_talk_power permvalue=40 permnegated=0 permskip=0',
+        'servergrouppermlist sgid=9': 'permsid=i_client_talk_power permvalue=5 permnegated=1 permskip=0',
+        'channelgrouppermlist cgid=5': 'permsid=b_client_kick_from_channel permvalue=1 permnegated=0 permskip=0'
+                                       '|permsid=i_client_talk_power permvalue=90 permnegated=0 permskip=0',
+        'channelgrouppermlist cgid=8': 'permsid=b_client_kick_from_channel permvalue=0 permnegated=0 permskip=0',
+        'servergroupsbyclientid cldbid=20': 'name=Admin sgid=6 cldbid=20|name=Member sgid=7 cldbid=20',
+        'servergroupsbyclientid cldbid=30': 'name=Member sgid=7 cldbid=30|name=Muted sgid=9 cldbid=30',
+        'servergroupsbyclientid cldbid=40': 'name=Member sgid=7 cldbid=40',
+        'clientpermlist cldbid=40': 'cldbid=40 permsid=i_channel_join_power permvalue=60 permnegated=0 permskip=0',
+        'channelpermlist cid=405': 'cid=405 permsid=i_channel_needed_join_power permvalue=55',
+        'channelclientpermlist cid=405 cldbid=40': 'cid=405 cldbid=40 permsid=b_client_kick_from_channel permvalue=1',
+    }
+
+    def __init__(self):
+        self.tables = dict(self.default_tables)
+
+    def __call__(self, line):
+        command, keys, opts = parse_line(line)
+        key = ' '.join([command] + ['%s=%s' % item for item in sorted(keys.items())])
+        if key not in self.tables:
+            return ['error id=1281 msg=database\\sempty\\sresult\\sset']
+        return [self.tables[key], 'error id=0 msg=ok']
+
+
+class PermissionResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = tables = PermissionTables()
+        self.server = ServerQueryEmulator(dict((key.split(' ')[0], tables) for key in tables.tables))
+        self.server.responses['clientpermlist'] = tables
+        self.server.responses['channelclientpermlist'] = tables
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+        self.perms = PermissionResolver(self.ts3)
+        self.assertTrue(self.perms.load())
+
+    def tearDown(self):
+        self.server.close()
+
+    def testServerGroups(self):
+        # The highest value of all server groups
+        self.assertEqual(self.perms.resolve('i_channel_join_power', 20), (50, PERMGROUP_TYPE_SERVERGROUP))
+        self.assertEqual(self.perms.effective(2, 20), 50)
+        # Unless a group negates it
+        self.assertEqual(self.perms.effective('i_client_talk_power', 30), 5)
+        self.assertEqual(self.perms.resolve('b_client_kick_from_channel', 30), (None, None))
+        self.assertFalse(self.perms.check('b_client_kick_from_channel', 30))
+        self.assertRaises(InvalidArguments, self.perms.effective, 99, 30)
+
+    def testChannelLayers(self):
+        # Channel group permissions replace server group ones...
+        self.assertEqual(self.perms.resolve('b_client_kick_from_channel', 20, cid=405),
+                         (1, PERMGROUP_TYPE_CHANNELGROUP))
+        # ...except when they are skipped
+        self.assertEqual(self.perms.resolve('i_client_talk_power', 20, cid=405), (75, PERMGROUP_TYPE_SERVERGROUP))
+        # Clients without a channel group have the default one
+        self.assertEqual(self.perms.resolve('b_client_kick_from_channel', 30, cid=405), (0, PERMGROUP_TYPE_CHANNELGROUP))
+        # Channel client permissions come last
+        self.assertEqual(self.perms.resolve('b_client_kick_from_channel', 40, cid=405),
+                         (1, PERMGROUP_TYPE_CHANNELCLIENT))
+        self.assertEqual(self.perms.resolve('i_channel_needed_join_power', 40, cid=405), (55, PERMGROUP_TYPE_CHANNEL))
+
+    def testClientPermissions(self):
+        self.assertEqual(self.perms.resolve('i_channel_join_power', 40), (60, PERMGROUP_TYPE_GLOBALCLIENT))
+        self.assertTrue(self.perms.has_power('i_channel_join_power', 'i_channel_needed_join_power', 40, 405))
+        self.assertFalse(self.perms.has_power('i_channel_join_power', 'i_channel_needed_join_power', 20, 405))
+        self.assertTrue(self.perms.has_power('i_channel_join_power', 'i_channel_needed_join_power', 20, 1))
+
+    def testCached(self):
+        self.perms.check('b_client_kick_from_channel', 40, cid=405)
+        sent = len(self.server.received)
+        for i in range(10):
+            self.perms.check('b_client_kick_from_channel', 40, cid=405)
+            self.perms.check('i_client_talk_power', 40, cid=405)
+        self.assertEqual(len(self.server.received), sent)
+
+    def testRefresh(self):
+        self.assertEqual(self.perms.effective('i_channel_join_power', 20), 50)
+        self.tables.tables['servergrouppermlist sgid=6'] = 'permsid=i_channel_join_power permvalue=80 permnegated=0 permskip=0'
+        self.perms.refresh_servergroup(6)
+        self.assertEqual(self.perms.effective('i_channel_join_power', 20), 80)
+
+        # Group memberships of connecting clients come from the notification
+        self.perms.attach()
+        handled = threading.Event()
+        self.ts3.on('notifycliententerview', lambda event: handled.set())
+        self.server.emit('cliententerview', [{'clid': 3, 'ctid': 405, 'client_database_id': 30,
+                                              'client_servergroups': '6', 'client_channel_group_id': 5}])
+        self.assertTrue(self.ts3.send_command('whoami').is_successful)
+        self.assertTrue(handled.wait(2))
+        self.assertEqual(self.perms.effective('i_channel_join_power', 30), 80)
+        self.assertEqual(self.perms.resolve('b_client_kick_from_channel', 30, cid=405), (1, PERMGROUP_TYPE_CHANNELGROUP))
+
+        self.perms.refresh_client(30)
+        self.assertEqual(self.perms.effective('i_client_talk_power', 30), 5)
+
+
+class FileTransferTests(unittest.TestCase):
+
+    data = bytes(bytearray(i % 251 for i in range(300000)))
+
+    def setUp(self):
+        self.server = ServerQueryEmulator()
+        self.files = self.server.enable_file_transfer().files
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def path(self, name, data=None):
+        path = os.path.join(self.dir, name)
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testUploadDownload(self):
+        transfer = self.ts3.upload_file(self.path('icon', self.data), '/icon_1234')
+        self.assertIsInstance(transfer, FileTransfer)
+        self.assertEqual(transfer.transferred, len(self.data))
+        self.assertEqual(self.files[(0, '\\/icon_1234')], self.data)
+        self.assertEqual(self.ts3.upload_file(b'hello', '/readme.txt', cid=5).transferred, 5)
+
+        path = self.path('copy')
+        self.assertEqual(self.ts3.download_file('/icon_1234', path).transferred, len(self.data))
+        self.assertEqual(self.read(path), self.data)
+
+        # Received straight into a buffer, or written to a file object
+        buffer = bytearray(len(self.data))
+        self.ts3.download_file('/icon_1234', buffer)
+        self.assertEqual(bytes(buffer), self.data)
+        target = io.BytesIO()
+        self.ts3.download_file('/readme.txt', target, cid=5)
+        self.assertEqual(target.getvalue(), b'hello')
+
+        self.assertEqual([row['name'] for row in self.ts3.ftgetfilelist(cid=5)], ['readme.txt'])
+        self.assertEqual(self.ts3.ftlist(), [])
+
+    def testResume(self):
+        self.files[(0, '\\/big')] = self.data[:1000]
+        transfer = self.ts3.upload_file(self.data, '/big', resume=True)
+        self.assertEqual((transfer.seekpos, transfer.transferred), (1000, len(self.data) - 1000))
+        self.assertEqual(self.files[(0, '\\/big')], self.data)
+
+        path = self.path('partial', self.data[:5000])
+        transfer = self.ts3.download_file('/big', path, resume=True)
+        self.assertEqual((transfer.seekpos, transfer.transferred), (5000, len(self.data) - 5000))
+        self.assertEqual(self.read(path), self.data)
+
+    def testRefused(self):
+        with self.assertRaises(FileTransferError) as cm:
+            self.ts3.download_file('/missing', self.path('missing'))
+        self.assertEqual(cm.exception.response['id'], '2051')
+
+        self.ts3.upload_file(b'one', '/file')
+        self.assertRaises(FileTransferError, self.ts3.upload_file, b'two', '/file', overwrite=False)
+        self.assertEqual(self.files[(0, '\\/file')], b'one')
+
+    def testConcurrent(self):
+        self.server.file_transfer.delay = 0.2
+        start = time.time()
+        with FileTransfers(self.ts3, max_workers=4) as transfers:
+            futures = [transfers.upload(self.data, '/file%d' % i) for i in range(4)]
+        self.assertTrue(all(f.result().transferred == len(self.data) for f in futures))
+        self.assertLess(time.time() - start, 0.7)
+        self.assertEqual(self.server.file_transfer.peak, 4)
+        # Every transfer on a connection has its own clientftfid
+        self.assertEqual(len(set(f.result().clientftfid for f in futures)), 4)
+
+
+class PreparedCommandTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerQueryEmulator({'clientinfo': echo_response})
+        self.ts3 = TS3Server('127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def assertRenders(self, command, keys, opts, values):
+        prepared = self.ts3.prepare(command, keys=keys, opts=opts)
+        full = dict(keys)
+        full.update(values)
+        expected = self.ts3.construct_command(command, keys=full, opts=opts)
+        self.assertEqual(prepared.render(**values), expected.encode('utf-8') + b"\n\r")
+
+    def testRender(self):
+        self.assertRenders('clientmove', {'cid': 405, 'clid': None}, None, {'clid': 7})
+        self.assertRenders('clientmove', {'clid': None, 'cid': 405}, ['continueonerror'], {'clid': [1, 2, 3]})
+        self.assertRenders('clientpoke', {'clid': None, 'msg': 'Change your name | now/please'}, None, {'clid': 5})
+        self.assertRenders('sendtextmessage', {'targetmode': 2, 'target': 1, 'msg': None}, None,
+                           {'msg': u'Hello wörld\n\\s'})
+        self.assertRenders('servergroupaddclient', {'sgid': 6, 'cldbid': [1, 'a b']}, None, {})
+        self.assertRenders('whoami', {}, None, {})
+
+        prepared = self.ts3.prepare('clientmove', keys={'cid': 405, 'clid': None})
+        self.assertIsInstance(prepared, PreparedCommand)
+        self.assertRaises(InvalidArguments, prepared.render)
+        self.assertRaises(InvalidArguments, prepared.render, clid=1, cid=2)
+
+    def testSend(self):
+        info = self.ts3.prepare('clientinfo', keys={'clid': None})
+        self.assertEqual([info(clid=i).data[0]['clid'] for i in range(5)], [str(i) for i in range(5)])
+        self.assertEqual(self.server.received, ['clientinfo clid=%d' % i for i in range(5)])
+
+        # Session state and the cache work as with send_command
+        use = self.ts3.prepare('use', keys={'sid': None})
+        self.assertTrue(use.send(sid=3).is_successful)
+        self.assertEqual(self.ts3._sid, 3)
+        self.ts3.enable_cache(ttls={'clientinfo': 60})
+        info(clid=9)
+        info(clid=9)
+        self.assertEqual(self.server.received.count('clientinfo clid=9'), 1)
+
+    def testPipeline(self):
+        move = self.ts3.prepare('clientmove', keys={'clid': None, 'cid': 405})
+        with self.ts3.pipeline() as pipe:
+            futures = [pipe.send_prepared(move, clid=clid) for clid in range(10)]
+        self.assertTrue(all(future.result().is_successful for future in futures))
+        self.assertEqual(self.server.received, ['clientmove clid=%d cid=405' % clid for clid in range(10)])
+
+
+def count_clients(server, target):
+    return (os.getpid(), len(server.clientlist()))
+
+
+def crash_once(server, target):
+    # Set by the test, the worker processes are forked
+    marker = ShardedRunnerTests.marker
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(3)
+    return target
+
+
+def fail_task(server, target):
+    raise ValueError('no %s' % target[2])
+
+
+def register_server(server, target):
+    server.servernotifyregister('server')
+
+
+def fail_setup(server, target):
+    raise ValueError('setup %s' % target[2])
+
+
+class ShardedRunnerTests(unittest.TestCase):
+
+    marker = None
+
+    def setUp(self):
+        self.server = ServerQueryEmulator().populate(clients=25)
+        self.targets = [('127.0.0.1', self.server.port, sid) for sid in range(1, 5)]
+        self.context = multiprocessing.get_context('fork')
+
+    def tearDown(self):
+        self.server.close()
+
+    def runner(self, task, **kwargs):
+        return ShardedRunner('serveradmin', 'secret', self.targets, task, context=self.context, **kwargs)
+
+    def testShardTargets(self):
+        self.assertEqual(shard_targets([(1,), (2,), (3,), (4,), (5,)], 2), [[(1,), (3,), (5,)], [(2,), (4,)]])
+        self.assertEqual(shard_targets([(1,), (2,)], 4), [[(1,)], [(2,)]])
+
+    def testResults(self):
+        with self.runner(count_clients, processes=2) as runner:
+            messages = list(runner.messages(timeout=10))
+        self.assertEqual(sorted(m.target for m in messages), self.targets)
+        self.assertTrue(all(m.kind == 'result' and m.value[1] == 25 for m in messages))
+        # Each shard works in its own process
+        self.assertEqual(len(set(m.value[0] for m in messages)), 2)
+        self.assertTrue(os.getpid() not in set(m.value[0] for m in messages))
+
+        stats = runner.stats()
+        self.assertEqual([s['state'] for s in stats], ['finished', 'finished'])
+        self.assertEqual([(s['targets'], s['tasks'], s['rounds']) for s in stats], [(2, 2, 1), (2, 2, 1)])
+        self.assertEqual(self.server.received.count('login client_login_name=serveradmin client_login_password=secret'), 4)
+        self.assertEqual(sorted(line for line in self.server.received if line.startswith('use')),
+                         ['use sid=%d' % sid for sid in range(1, 5)])
+
+    def testRestartOnCrash(self):
+        directory = tempfile.mkdtemp()
+        ShardedRunnerTests.marker = os.path.join(directory, 'crashed')
+        try:
+            with self.runner(crash_once, processes=2) as runner:
+                messages = list(runner.messages(timeout=10))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(sorted(m.target for m in messages if m.kind == 'result'), self.targets)
+        stats = runner.stats()
+        self.assertEqual(sum(s['restarts'] for s in stats), 1)
+        self.assertEqual([s['state'] for s in stats], ['finished', 'finished'])
+
+    def testErrorsAndIntervals(self):
+        with self.runner(fail_task, processes=2, interval=0.05) as runner:
+            errors = []
+            for message in runner.messages(timeout=5):
+                errors.append(message)
+                if len(errors) == 8:
+                    break
+        self.assertTrue(all(m.kind == 'error' and m.value == 'ValueError: no %d' % m.target[2] for m in errors))
+        stats = runner.stats()
+        self.assertEqual([s['state'] for s in stats], ['stopped', 'stopped'])
+        self.assertTrue(all(s['errors'] >= 2 and s['rounds'] >= 1 for s in stats))
+        # Connections are kept across rounds
+        self.assertEqual(self.server.received.count('login client_login_name=serveradmin client_login_password=secret'), 4)
+
+    def testFailedConnectIsClosed(self):
+        with self.runner(count_clients, processes=2, setup=fail_setup) as runner:
+            messages = list(runner.messages(timeout=10))
+        self.assertTrue(all(m.kind == 'error' and m.value == 'ValueError: setup %d' % m.target[2] for m in messages))
+        self.assertEqual(len(messages), 4)
+        # The connections were closed instead of left to the garbage collector
+        self.assertEqual(self.server.received.count('quit'), 4)
+
+    def testEvents(self):
+        self.targets = self.targets[:2]
+        with self.runner(count_clients, processes=2, interval=0.2, setup=register_server,
+                         events=['notifyclientmoved']) as runner:
+            deadline = time.time() + 5
+            while self.server.received.count('servernotifyregister event=server') < 2 and time.time() < deadline:
+                time.sleep(0.02)
+            self.server.emit('clientmoved', [{'clid': 5, 'ctid': 2}])
+            events = []
+            for message in runner.messages(timeout=5):
+                if message.kind == 'event':
+                    events.append(message)
+                    if len(events) == 2:
+                        break
+        self.assertEqual(sorted(m.target for m in events), self.targets)
+        self.assertEqual(events[0].value, ('notifyclientmoved', [{'clid': '5', 'ctid': '2'}]))
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TS3ProtoTest))
     suite.addTest(unittest.makeSuite(TS3ProtoNetworkTests))
+    suite.addTest(unittest.makeSuite(TS3PipelineTests))
+    suite.addTest(unittest.makeSuite(AsyncTS3Tests))
+    suite.addTest(unittest.makeSuite(TS3RowStreamTests))
+    suite.addTest(unittest.makeSuite(TelnetTransportTests))
+    suite.addTest(unittest.makeSuite(SocketTransportTests))
+    suite.addTest(unittest.makeSuite(TS3ServerPoolTests))
+    suite.addTest(unittest.makeSuite(TS3EventTests))
+    suite.addTest(unittest.makeSuite(ServerStateMirrorTests))
+    suite.addTest(unittest.makeSuite(ResponseCacheTests))
+    suite.addTest(unittest.makeSuite(RateLimiterTests))
+    suite.addTest(unittest.makeSuite(BatchCommandTests))
+    suite.addTest(unittest.makeSuite(RecordTests))
+    suite.addTest(unittest.makeSuite(FanOutTests))
+    suite.addTest(unittest.makeSuite(ServerQueryEmulatorTests))
+    suite.addTest(unittest.makeSuite(InstrumentTests))
+    suite.addTest(unittest.makeSuite(ReconnectTests))
+    suite.addTest(unittest.makeSuite(KeepaliveTests))
+    suite.addTest(unittest.makeSuite(TS3RowTests))
+    suite.addTest(unittest.makeSuite(SnapshotDiffTests))
+    suite.addTest(unittest.makeSuite(TS3MultiplexerTests))
+    suite.addTest(unittest.makeSuite(TS3PagerTests))
+    suite.addTest(unittest.makeSuite(PermissionResolverTests))
+    suite.addTest(unittest.makeSuite(FileTransferTests))
+    suite.addTest(unittest.makeSuite(PreparedCommandTests))
+    suite.addTest(unittest.makeSuite(ShardedRunnerTests))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+# Python TS3 Library (python-ts3)
+#
+# Copyright (c) 2011, Andrew Williams
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Transports carry the raw ServerQuery byte stream for L{TS3Proto}.
+
+A transport is created with C{transport(ip, port, timeout)}, which raises
+C{socket.error} when the connection fails, and provides C{write(data)},
+C{read_until(delims, timeout)}, C{has_data(timeout)} and C{close()}.
+"""
+
+import re
+import select
+import socket
+import time
+
+
+class SocketTransport():
+    """
+    Plain socket transport with a bytearray receive buffer.
+
+    Delimiter searches resume where the previous search stopped, so reading
+    a reply costs time linear in its size however it arrives.
+    """
+
+    def __init__(self, ip, port, timeout=None, chunk_size=65536):
+        """
+        @param ip: IP Address
+        @type ip: str
+        @param port: Port Number
+        @type port: int
+        @param timeout: Connection timeout in seconds
+        @type timeout: float
+        @param chunk_size: Maximum number of bytes read from the socket at once
+        @type chunk_size: int
+        """
+        self.sock = socket.create_connection((ip, port), timeout or None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = bytearray()
+        self._chunk = bytearray(chunk_size)
+        self._chunk_view = memoryview(self._chunk)
+        self._eof = False
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def read_until(self, delims, timeout=None):
+        """
+        Reads until and including the first of the given delimiters. If the
+        timeout expires or the connection is closed first, whatever has been
+        received is returned instead. Raises C{EOFError} when the connection
+        is closed and nothing is buffered.
+
+        @param delims: Delimiter or tuple of delimiters
+        @type delims: bytes/tuple
+        @param timeout: Timeout in seconds, None or 0 waits forever
+        @type timeout: float
+        """
+        if isinstance(delims, bytes):
+            delims = (delims,)
+        overlap = max(len(d) for d in delims) - 1
+        deadline = time.time() + timeout if timeout else None
+
+        start = 0
+
+        while True:
+            end = self._find(delims, start)
+            if end is not None:
+                return self._consume(end)
+
+            # Only rescan what may hold a delimiter spanning the new data
+            start = max(0, len(self._buffer) - overlap)
+
+            if self._eof or not self._fill(deadline):
+                if not self._buffer and self._eof:
+                    raise EOFError('Connection closed')
+                return self._consume(len(self._buffer))
+
+    def has_data(self, timeout=0):
+        """
+        Returns True when data can be read without blocking, waiting up to
+        timeout seconds for some to arrive
+        """
+        if self._buffer or self._eof:
+            return True
+        return bool(select.select([self.sock], [], [], timeout)[0])
+
+    def _find(self, delims, start):
+        buf = self._buffer
+        end = None
+        for delim in delims:
+            # Bounding each search by the best match so far keeps the scan
+            # from running past an earlier delimiter
+            pos = buf.find(delim, start, len(buf) if end is None else end)
+            if pos != -1:
+                end = pos + len(delim)
+        return end
+
+    def _fill(self, deadline):
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.sock.settimeout(remaining)
+        else:
+            self.sock.settimeout(None)
+
+        try:
+            n = self.sock.recv_into(self._chunk)
+        except socket.timeout:
+            return False
+
+        if not n:
+            self._eof = True
+            return False
+
+        self._buffer += self._chunk_view[:n]
+        return True
+
+    def _consume(self, end):
+        data = bytes(self._buffer[:end])
+        # Deleting from the front of a bytearray does not move the rest
+        del self._buffer[:end]
+        return data
+
+    def close(self):
+        self.sock.close()
+
+
+class TelnetTransport():
+    """
+    Transport built on telnetlib, the original implementation, kept as an
+    optional fallback. Not available on Python 3.13 or later, where
+    telnetlib was removed from the standard library.
+    """
+
+    def __init__(self, ip, port, timeout=None):
+        import telnetlib
+        self._telnet = telnetlib.Telnet(ip, port, timeout or socket._GLOBAL_DEFAULT_TIMEOUT)
+        self.sock = self._telnet.sock
+        self._patterns = {}
+
+    def write(self, data):
+        self._telnet.write(data)
+
+    def read_until(self, delims, timeout=None):
+        if isinstance(delims, bytes):
+            return self._telnet.read_until(delims, timeout or None)
+
+        pattern = self._patterns.get(delims)
+        if pattern is None:
+            pattern = self._patterns[delims] = re.compile(b"|".join(re.escape(d) for d in delims))
+        return self._telnet.expect([pattern], timeout or None)[2]
+
+    def has_data(self, timeout=0):
+        if self._telnet.cookedq or self._telnet.rawq:
+            return True
+        return bool(select.select([self._telnet], [], [], timeout)[0])
+
+    def close(self):
+        self._telnet.close()